@@ -55,6 +55,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # first so it times the whole request, see synaiapp/metrics.py
+    'synaiapp.metrics.TimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -62,6 +64,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    # the Spotify rate limits are answered 503 with a Retry-After header
+    'synaiapp.middleware.SpotifyThrottledMiddleware',
     'debug_toolbar.middleware.DebugToolbarMiddleware',
 ]
 
@@ -69,7 +73,8 @@ ROOT_URLCONF = 'Synai.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # the Django backend, timing the rendering for the Server-Timing header
+        'BACKEND': 'synaiapp.metrics.TimedDjangoTemplates',
         'DIRS': [
             os.path.join(BASE_DIR, 'templates')
         ],
@@ -102,6 +107,25 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/2.1/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # API responses, a file or memcached backend can be used to share them between processes
+    'spotify': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'spotify',
+        'TIMEOUT': 3600,
+        'OPTIONS': {
+            'MAX_ENTRIES': 5000,
+        },
+    },
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/2.1/ref/settings/#auth-password-validators
 
@@ -149,6 +173,44 @@ SPOTIFY_BASE_URL = "https://api.spotify.com/v1/"
 MAX_REQ_IDS = 50
 FEATURES_DELTA = 0.3
 MAX_SEED_OBJECTS = 5
+# "spotify" requests the recommendations to the API, "local" takes the closest songs of the DB (see similarity.py)
+# "box" takes songs of the DB within FEATURES_DELTA of the analysis and requests the API only if there aren't enough
+RECOMMENDATIONS_SOURCE = 'spotify'
+# HTTP connections to the API are pooled and shared by the whole process
+SPOTIFY_POOL_CONNECTIONS = 4
+SPOTIFY_POOL_MAXSIZE = 10
+SPOTIFY_POOL_BLOCK = False
+SPOTIFY_TIMEOUT = 10
+# maximum number of requests sent at the same time by a request manager
+SPOTIFY_MAX_CONCURRENCY = 4
+SPOTIFY_PLAYLIST_PAGE_SIZE = 100
+# rate limit shared by all the requests of the process (requests per second and burst size)
+SPOTIFY_RATE_LIMIT = 10
+SPOTIFY_RATE_BURST = 20
+# throttled requests (429, 503) are retried after the "Retry-After" delay or an exponential backoff (seconds)
+SPOTIFY_MAX_RETRIES = 3
+SPOTIFY_RETRY_BACKOFF = 0.5
+SPOTIFY_MAX_RETRY_DELAY = 10
+# total seconds a request may wait for its retries, below the timeout of the HTTP server (30 s for gunicorn)
+SPOTIFY_MAX_RETRY_WAIT = 20
+# time to live in seconds of the cached responses by endpoint (regex on the query path, the first match is used)
+# the endpoints that don't match any pattern are not cached
+SPOTIFY_CACHE_ALIAS = 'spotify'
+SPOTIFY_CACHE_MAX_ITEM_SIZE = 256 * 1024
+SPOTIFY_CACHE_TTLS = [
+    (r'^me/', 0),
+    (r'^artists/[^/]+/top-tracks', 6 * 3600),
+    (r'^albums/', 24 * 3600),
+    (r'^artists', 24 * 3600),
+    (r'^search\?', 5 * 60),
+    (r'^recommendations\?', 5 * 60),
+]
+# number of spotify ids resolved to DB primary keys kept in memory by model
+SPOTIFY_ID_CACHE_SIZE = 20000
+# a chunk of songs racing with another request on the spotify ids is inserted again this number of times at most
+SPOTIFY_UPSERT_ATTEMPTS = 3
+# the access token is refreshed when it expires in less than this number of seconds
+SPOTIFY_TOKEN_REFRESH_MARGIN = 60
 SOCIAL_AUTH_SPOTIFY_KEY = os.environ.get('SPOTIFY_KEY', '')
 SOCIAL_AUTH_SPOTIFY_SECRET = os.environ.get('SPOTIFY_SECRET', '')
 SOCIAL_AUTH_SPOTIFY_SCOPE = [
@@ -160,6 +222,29 @@ SOCIAL_AUTH_SPOTIFY_SCOPE = [
     ]
 
 
+# Analysis jobs
+
+# "thread" runs the analyses in ANALYSIS_JOBS_WORKERS threads of the web process,
+# "worker" leaves them to the run_analysis_jobs command and "sync" runs them in the request
+ANALYSIS_JOBS_MODE = 'thread'
+ANALYSIS_JOBS_WORKERS = 2
+# the pending or running jobs without any progress for this number of seconds are failed (IE lost by a restart)
+ANALYSIS_JOBS_STALE_AFTER = 15 * 60
+
+
+# History
+
+# number of analyses by page of the history, the datasets of their graphs can be cached by the browser (seconds)
+HISTORY_PAGE_SIZE = 10
+HISTORY_DATASET_MAX_AGE = 30 * 24 * 3600
+
+
+# Metrics
+
+# token of the Prometheus scraper, sent as "Authorization: Bearer <token>" to /metrics, the metrics are not exposed without it
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+
 # Internationalization
 # https://docs.djangoproject.com/en/2.1/topics/i18n/
 
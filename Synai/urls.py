@@ -26,12 +26,15 @@ urlpatterns = [
     path('', views.home, name='home'),
     path('feed', views.FeedView.as_view(), name='feed'),
     path('history', views.HistoryView.as_view(), name='history'),
+    path('history/<int:analysis_id>/dataset', views.AnalysisDatasetView.as_view(), name='history_dataset'),
     path('dashboard', views.DashboardView.as_view(), name='dashboard'),
     path('about', TemplateView.as_view(template_name="about.html"), name="about"),
+    path('metrics', views.MetricsView.as_view(), name='metrics'),
 
     # Partial views
     path('search_results', views.SearchResultsView.as_view(), name='search_results'),
-    path('analyse', views.AnalyseResultsView.as_view(), name='analyse'),
+    path('analyse', views.AnalyseView.as_view(), name='analyse'),
+    path('analyse/<int:job_id>', views.AnalyseJobView.as_view(), name='analyse_job'),
     path('playlist_entries', views.PlaylistEntriesView.as_view(), name='playlist_entries'),
 
     # social auth app
@@ -0,0 +1,144 @@
+from django.conf import settings
+from django.db import connection, transaction
+from concurrent.futures import ThreadPoolExecutor, Future
+from .models import Analysis, AnalysisJob
+from .services import SpotifyRequestManager
+import threading
+
+# Logger & debug
+import logging
+logger = logging.getLogger(__name__)
+
+class SingleFlight:
+    """
+    Runs a function only once for the concurrent callers using the same key
+    The first caller runs it, the others wait for it and share its result (or its exception)
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, function):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call == None
+            if(leader):
+                call = self.calls[key] = Future()
+
+        if(not leader):
+            return call.result()
+
+        try:
+            result = function()
+            call.set_result(result)
+            return result
+        except Exception as e:
+            call.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+class AnalysisWorker:
+    """
+    This class runs the analysis jobs in the background
+    Depending on ANALYSIS_JOBS_MODE, a job is run:
+    - "thread": by a pool of ANALYSIS_JOBS_WORKERS threads of the web process
+    - "worker": by a separate process started with the run_analysis_jobs command, the job only stays in the table
+    - "sync": right away in the request (IE for the tests)
+    The jobs of a thread lost by a restart are failed once stale, by run_analysis_jobs or when they are polled
+    """
+    _executor = None
+    _lock = threading.Lock()
+    # the concurrent jobs analysing the same datasource share its fetch and ingestion
+    fetches = SingleFlight()
+
+    @classmethod
+    def get_executor(cls):
+        """
+        Returns the thread pool shared by the process, it is built the first time it is needed
+        """
+        if(cls._executor == None):
+            with cls._lock:
+                if(cls._executor == None):
+                    cls._executor = ThreadPoolExecutor(max_workers=settings.ANALYSIS_JOBS_WORKERS)
+        return cls._executor
+
+    @classmethod
+    def enqueue(cls, user, datasource_type, datasource_id, datasource_name):
+        """
+        Creates a job and dispatches it depending on the mode
+        Returns the job
+        """
+        job = AnalysisJob.create(user, datasource_type, datasource_id, datasource_name)
+
+        if(settings.ANALYSIS_JOBS_MODE == "sync"):
+            cls.run(job)
+        elif(settings.ANALYSIS_JOBS_MODE == "thread"):
+            # the job must be committed before the thread reads it
+            transaction.on_commit(lambda: cls.get_executor().submit(cls.run_in_thread, job.pk))
+        return job
+
+    @classmethod
+    def run_in_thread(cls, job_id):
+        try:
+            cls.run(AnalysisJob.manager.get(pk=job_id))
+        finally:
+            # each thread has its own DB connection
+            connection.close()
+
+    @classmethod
+    def run_pending(cls):
+        """
+        Runs the oldest pending job, returns False if there is none
+        """
+        job = AnalysisJob.manager.filter(status=AnalysisJob.PENDING).order_by('created').first()
+        if(job == None):
+            return False
+        cls.run(job)
+        return True
+
+    @classmethod
+    def run(cls, job):
+        """
+        Fetches the songs of the job's datasource, analyses them and requests the recommendations
+        The job is skipped if another worker already took it
+        """
+        if(not job.claim()):
+            return
+
+        try:
+            social = job.user.social_auth.get(provider="spotify")
+            manager = SpotifyRequestManager(social, progress=job.add_progress)
+
+            # the history is specific to the user, it can't be shared
+            if(job.datasource_type == "history"):
+                songs = cls.fetch_songs(manager, job.datasource_type, job.datasource_id)
+            else:
+                fetch = lambda: cls.fetch_songs(manager, job.datasource_type, job.datasource_id)
+                songs = list(cls.fetches.do((job.datasource_type, job.datasource_id), fetch))
+            # the recommendations are not part of the progress
+            manager.progress = None
+
+            analysis, audio_features = Analysis.analyse_songs_for_user(songs, job.user, job.datasource_type)
+            recommendations = manager.get_recommendations(analysis)
+
+            job.finish(analysis, recommendations)
+        except Exception:
+            # the details of the error are logged, not shown to the user
+            logger.exception("Analysis job %d failed", job.pk)
+            job.fail(AnalysisJob.FAILED_MESSAGE)
+
+    @classmethod
+    def fetch_songs(cls, manager, datasource_type, datasource_id):
+        """
+        Request the songs depending the datasource
+        """
+        request_type = {
+            'song': lambda song_id: manager.get_songs([song_id]),
+            'playlist': lambda playlist_id: manager.get_playlist(playlist_id),
+            'artist': lambda artist_id: manager.get_artist_top_songs(artist_id),
+            'history': lambda history_id: manager.get_current_user_history(),
+            'album': lambda album_id: manager.get_album_tracks(album_id)
+        }
+        return request_type[datasource_type](datasource_id)
@@ -0,0 +1,93 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count
+from django.utils import timezone
+from synaiapp.models import AudioFeatures, Song, Analysis
+import json
+import numpy as np
+import time
+
+class Command(BaseCommand):
+    help = "Times the models layer (summaries, graphs datasets, history) on the data of the DB, see generate_synthetic_data"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000, 100000], help="Numbers of audio features summarised")
+        parser.add_argument('--repeat', type=int, default=5, help="Number of runs by benchmark")
+        parser.add_argument('--output', help="Writes the results as JSON into this file")
+        parser.add_argument('--compare', help="JSON file of a previous run to compare the results with")
+
+    def handle(self, *args, **options):
+        self.repeat = options['repeat']
+        songs_count = Song.objects.count()
+        if(songs_count == 0):
+            raise CommandError("The DB has no song, run generate_synthetic_data first")
+
+        results = []
+        for size in sorted(set(min(size, songs_count) for size in options['sizes'])):
+            queryset = AudioFeatures.manager.filter(song__isnull=False).order_by('pk')[:size]
+            audio_features = list(queryset)
+            results.append(self.measure("AudioFeatures.summarise", size, lambda: AudioFeatures.summarise(audio_features)))
+            results.append(self.measure("AudioFeatures.summarise (queryset)", size, lambda: AudioFeatures.summarise(queryset)))
+            results.append(self.measure("AudioFeatures.prepare_data_for_linegraph", size, lambda: AudioFeatures.prepare_data_for_linegraph(audio_features)))
+            results.append(self.measure("AudioFeatures.prepare_data_for_linegraph (vectors)", size,
+                lambda: AudioFeatures.prepare_data_for_linegraph(AudioFeatures.load_vectors(queryset))))
+
+        # the user with the longest history and the analysis with the most songs
+        user = Analysis.manager.values('user').annotate(count=Count('pk')).order_by('-count').first()
+        if(user != None):
+            user_id, analyses_count = user['user'], user['count']
+            analysis = Analysis.manager.filter(user_id=user_id).order_by('-songs_len').first()
+            results.append(self.measure("Analysis.get_user_history", analyses_count, lambda: Analysis.get_user_history(analysis.user)))
+            results.append(self.measure("Analysis.get_user_history_page", analyses_count,
+                lambda: Analysis.get_user_history_page(analysis.user, analysis.pk, page_size=settings.HISTORY_PAGE_SIZE)))
+            results.append(self.measure("Analysis.get_user_summarised_data", analyses_count, lambda: Analysis.get_user_summarised_data(analysis.user)))
+            entry = Analysis.get_history_entry(analysis.user, analysis.pk)
+            results.append(self.measure("Analysis.history_dataset", len(entry.songs), lambda: analysis.history_dataset(entry.songs)))
+            results.append(self.measure("Analysis.history_dataset (vectors)", len(entry.songs), lambda: analysis.history_dataset()))
+
+        previous = self.load_previous(options['compare'])
+        for result in results:
+            self.stdout.write(self.format_result(result, previous.get((result['name'], result['size']))))
+
+        if(options['output']):
+            report = {
+                'created': timezone.now().isoformat(),
+                'database': connection.vendor,
+                'songs': songs_count,
+                'analyses': Analysis.manager.count(),
+                'results': results,
+            }
+            with open(options['output'], 'w') as output:
+                json.dump(report, output, indent=2)
+
+    def measure(self, name, size, function):
+        timings = []
+        for run in range(self.repeat):
+            start = time.perf_counter()
+            function()
+            timings.append(time.perf_counter() - start)
+        timings = np.array(timings) * 1000
+        return {
+            'name': name,
+            'size': size,
+            'repeat': self.repeat,
+            'min_ms': round(float(timings.min()), 3),
+            'median_ms': round(float(np.median(timings)), 3),
+            'p95_ms': round(float(np.percentile(timings, 95)), 3),
+        }
+
+    def load_previous(self, path):
+        """
+        Returns the results of a previous run by name and size
+        """
+        if(path == None):
+            return {}
+        with open(path) as previous:
+            return {(result['name'], result['size']) : result for result in json.load(previous)['results']}
+
+    def format_result(self, result, previous=None):
+        line = "%-52s %8d  median %10.3f ms  min %10.3f ms  p95 %10.3f ms" % (result['name'], result['size'], result['median_ms'], result['min_ms'], result['p95_ms'])
+        if(previous != None and previous['median_ms'] > 0):
+            line += "  x%.2f" % (result['median_ms'] / previous['median_ms'])
+        return line
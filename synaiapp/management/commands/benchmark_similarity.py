@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+from synaiapp.models import AudioFeatures
+from synaiapp.similarity import SongSimilarityIndex
+import numpy as np
+import time
+
+class Command(BaseCommand):
+    help = "Times the building and the queries of the similarity index over random songs (100k and 1M by default)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[100000, 1000000], help="Numbers of songs in the index")
+        parser.add_argument('--queries', type=int, default=100, help="Number of queries per size")
+        parser.add_argument('--limit', type=int, default=10, help="Number of songs returned by a query")
+        parser.add_argument('--chunk', type=int, default=50, help="Number of songs added at once, like an ingested chunk")
+
+    def handle(self, *args, **options):
+        random = np.random.RandomState(0)
+        features = len(AudioFeatures.FEATURES)
+        # the features are between 0 and 1 but the tempo, which is between 0 and 200
+        scale = np.array([200 if feature == 'tempo' else 1 for feature in AudioFeatures.FEATURES])
+
+        for size in options['sizes']:
+            matrix = random.rand(size, features) * scale
+            index = SongSimilarityIndex()
+
+            start = time.perf_counter()
+            index.add(np.arange(1, size + 1), matrix)
+            build = time.perf_counter() - start
+
+            chunk = options['chunk']
+            start = time.perf_counter()
+            index.add(np.arange(size + 1, size + chunk + 1), random.rand(chunk, features) * scale)
+            add = time.perf_counter() - start
+
+            timings = []
+            for query in random.rand(options['queries'], features) * scale:
+                start = time.perf_counter()
+                index.nearest(query, options['limit'])
+                timings.append(time.perf_counter() - start)
+            timings = np.array(timings) * 1000
+
+            self.stdout.write("%d songs: build %.1f ms, add %d songs %.2f ms, query p50 %.2f ms, p95 %.2f ms, max %.2f ms" % (
+                size, build * 1000, chunk, add * 1000, np.percentile(timings, 50), np.percentile(timings, 95), timings.max()))
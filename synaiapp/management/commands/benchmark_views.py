@@ -0,0 +1,137 @@
+from django.core.management.base import BaseCommand
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings, setup_test_environment, teardown_test_environment
+from social_django.models import UserSocialAuth
+from synaiapp.testing.fakespotify import FakeSpotifyServer, FakeSpotifyCatalogue
+from synaiapp.models import SpotifyIdCache
+from synaiapp.services import SpotifySession, SpotifyRequestScheduler
+from synaiapp.similarity import SongSimilarityIndex
+import json
+import numpy as np
+import time
+
+class Command(BaseCommand):
+    help = "Times the views against a local fake Spotify API and reports their latency, Spotify calls and DB queries by playlist size"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 10000], help="Numbers of tracks of the analysed playlists")
+        parser.add_argument('--iterations', type=int, default=5, help="Number of requests by view and size")
+        parser.add_argument('--latency', type=float, default=0.02, help="Seconds the fake API waits before each response")
+        parser.add_argument('--throttle-rate', type=float, default=0, help="Share of the API responses that are 429")
+        parser.add_argument('--retry-after', type=int, default=0, help="Retry-After of the 429 responses, in seconds")
+        parser.add_argument('--rate-limit', type=float, default=None, help="Overrides SPOTIFY_RATE_LIMIT (requests per second)")
+        parser.add_argument('--warm', action='store_true', help="Analyse the same playlist each time instead of a new one (songs already in the DB)")
+        parser.add_argument('--output', help="Writes the results as JSON into this file")
+
+    def handle(self, *args, **options):
+        overrides = {'ANALYSIS_JOBS_MODE': "sync", 'DEBUG': False}
+        if(options['rate_limit'] != None):
+            overrides['SPOTIFY_RATE_LIMIT'] = options['rate_limit']
+            overrides['SPOTIFY_RATE_BURST'] = max(options['rate_limit'], 1)
+
+        server = FakeSpotifyServer(options['latency'], options['throttle_rate'], options['retry_after']).start()
+        overrides['SPOTIFY_BASE_URL'] = server.url
+
+        # the benchmark runs in a test database so the real one is never touched
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            with override_settings(**overrides):
+                self.reset_caches()
+                results = self.run_benchmarks(server, options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+            server.stop()
+
+        self.print_results(results)
+        if(options['output']):
+            with open(options['output'], 'w') as output:
+                json.dump(results, output, indent=2)
+
+    def reset_caches(self):
+        SpotifySession.close()
+        SpotifyRequestScheduler.reset()
+        SpotifyIdCache.clear_all()
+        SongSimilarityIndex.reset()
+        caches['spotify'].clear()
+
+    def build_client(self):
+        user = User.objects.create(username="benchmark")
+        UserSocialAuth.objects.create(user=user, provider="spotify", uid="benchmark",
+            extra_data={'access_token': 'token', 'auth_time': int(time.time()), 'expires': 3600 * 24})
+        client = Client()
+        client.force_login(user)
+        return client
+
+    def run_benchmarks(self, server, options):
+        client = self.build_client()
+        results = []
+        variant = 0
+        for size in options['sizes']:
+            def analyse():
+                nonlocal variant
+                if(not options['warm']):
+                    variant += 1
+                playlist_id = FakeSpotifyCatalogue.playlist_id(size, variant)
+                response = client.get('/analyse', {'type': 'playlist', 'id': playlist_id, 'name': "%d tracks" % size})
+                job = client.get(response.json()['status_url']).json()
+                if(job['status'] != "done"):
+                    raise RuntimeError("The analysis of %d tracks failed: %s" % (size, job.get('error')))
+                return response
+
+            def dataset():
+                response = client.get('/history')
+                analysis = response.context['analysis'][0]
+                return client.get('/history/%d/dataset' % analysis.pk)
+
+            views = [
+                ('/analyse', analyse),
+                ('/feed', lambda: client.get('/feed')),
+                ('/search_results', lambda: client.get('/search_results', {'search_input': "query %d" % size})),
+                ('/history', lambda: client.get('/history')),
+                ('/history/<id>/dataset', dataset),
+            ]
+            for name, request in views:
+                results.append(self.measure(server, name, size, request, options['iterations']))
+                self.stdout.write(self.format_result(results[-1]))
+        return results
+
+    def measure(self, server, name, size, request, iterations):
+        latencies, calls, queries, throttled = [], [], [], []
+        for iteration in range(iterations):
+            server.reset_counters()
+            with CaptureQueriesContext(connection) as context:
+                start = time.perf_counter()
+                response = request()
+                latencies.append(time.perf_counter() - start)
+            if(response.status_code >= 400):
+                raise RuntimeError("%s answered %d" % (name, response.status_code))
+            calls.append(server.calls_count())
+            throttled.append(sum(server.throttled.values()))
+            queries.append(len(context.captured_queries))
+
+        latencies = np.array(latencies) * 1000
+        return {
+            'view': name,
+            'size': size,
+            'iterations': iterations,
+            'p50_ms': round(float(np.percentile(latencies, 50)), 2),
+            'p95_ms': round(float(np.percentile(latencies, 95)), 2),
+            'spotify_calls': round(float(np.mean(calls)), 1),
+            'throttled_calls': round(float(np.mean(throttled)), 1),
+            'db_queries': round(float(np.mean(queries)), 1),
+        }
+
+    def format_result(self, result):
+        return "%(view)-24s %(size)6d tracks  p50 %(p50_ms)9.2f ms  p95 %(p95_ms)9.2f ms  spotify %(spotify_calls)7.1f (%(throttled_calls).1f 429)  queries %(db_queries)7.1f" % result
+
+    def print_results(self, results):
+        self.stdout.write("")
+        self.stdout.write("%-24s %6s  %12s  %12s  %10s  %10s" % ("view", "size", "p50 (ms)", "p95 (ms)", "spotify", "queries"))
+        for result in results:
+            self.stdout.write("%-24s %6d  %12.2f  %12.2f  %10.1f  %10.1f" % (result['view'], result['size'], result['p50_ms'], result['p95_ms'],
+                result['spotify_calls'], result['db_queries']))
@@ -0,0 +1,136 @@
+from django.core.management.base import BaseCommand
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.utils import timezone
+from django_seed import Seed
+from synaiapp.models import AudioFeatures, Artist, Album, Song, Analysis, UserFeatureStats, bulk_insert
+from datetime import timedelta
+import numpy as np
+import time
+
+class Command(BaseCommand):
+    help = "Generates a synthetic catalogue (songs, audio features, artists, albums) and users with their analyses history, with bulk inserts"
+
+    DATASOURCE_TYPES = ['song', 'playlist', 'artist', 'history', 'album']
+
+    def add_arguments(self, parser):
+        parser.add_argument('--songs', type=int, default=100000, help="Number of songs of the catalogue")
+        parser.add_argument('--users', type=int, default=100, help="Number of users")
+        parser.add_argument('--analyses', type=int, default=100, help="Number of analyses by user")
+        parser.add_argument('--analysis-songs', type=int, default=50, help="Mean number of songs by analysis")
+        parser.add_argument('--days', type=int, default=365, help="The analyses are spread over this number of days")
+        parser.add_argument('--batch', type=int, default=10000, help="Number of rows inserted by transaction")
+        parser.add_argument('--seed', type=int, default=0, help="Seed of the random generators")
+
+    def handle(self, *args, **options):
+        self.random = np.random.RandomState(options['seed'])
+        self.batch = options['batch']
+        # Faker is too slow to name millions of rows, the names are drawn from a pool of words it gives
+        faker = Seed.faker()
+        faker.seed_instance(options['seed'])
+        self.words = np.array(sorted(set(faker.words(2000))))
+
+        start = time.perf_counter()
+        song_ids, features = self.generate_catalogue(options['songs'])
+        self.log("%d songs", len(song_ids), start)
+
+        start = time.perf_counter()
+        user_ids = self.generate_users(options['users'])
+        analyses = self.generate_history(user_ids, song_ids, features, options['analyses'], options['analysis_songs'], options['days'])
+        self.log("%d users with %d analyses", len(user_ids), start, analyses)
+
+        start = time.perf_counter()
+        UserFeatureStats.rebuild()
+        self.log("users statistics rebuilt", None, start)
+
+    def log(self, message, count, start, *args):
+        values = tuple(value for value in (count,) + args if value != None)
+        self.stdout.write(message % values + " in %.1f s" % (time.perf_counter() - start))
+
+    def names(self, count, words=2):
+        names = self.words[self.random.randint(len(self.words), size=(count, words))]
+        return [' '.join(name).title() for name in names]
+
+    def features_matrix(self, count):
+        """
+        Random features looking like Spotify ones: most of them between 0 and 1, few instrumental or spoken songs, tempos from 60 to 200
+        """
+        matrix = self.random.beta(2, 2, size=(count, len(AudioFeatures.FEATURES)))
+        matrix[:, AudioFeatures.FEATURES.index('instrumentalness')] **= 6
+        matrix[:, AudioFeatures.FEATURES.index('speechiness')] /= 3
+        matrix[:, AudioFeatures.FEATURES.index('tempo')] = 60 + matrix[:, AudioFeatures.FEATURES.index('tempo')] * 140
+        return matrix.round(4)
+
+    def generate_catalogue(self, songs_count):
+        """
+        Inserts the songs by batches with their audio features, albums (12 songs each) and artists (1 or 2 by song)
+        Returns the primary keys of the songs and the matrix of their features
+        """
+        first = Song.objects.count()
+        song_ids = []
+        features = []
+        for offset in range(0, songs_count, self.batch):
+            count = min(self.batch, songs_count - offset)
+            matrix = self.features_matrix(count)
+            with transaction.atomic():
+                albums = bulk_insert(Album.objects, [Album.create("synth_album_%d" % (first + offset + index), name)
+                    for index, name in enumerate(self.names((count + 11) // 12))], 'spotify_id')
+                artists = bulk_insert(Artist.objects, [Artist.create("synth_artist_%d" % (first + offset + index), name)
+                    for index, name in enumerate(self.names(count // 4 + 1))], 'spotify_id')
+
+                audio_features = AudioFeatures.bulk_save([AudioFeatures(spotify_id="synth_song_%d" % (first + offset + index), **dict(zip(AudioFeatures.FEATURES, row)))
+                    for index, row in enumerate(matrix.tolist())])
+
+                songs = bulk_insert(Song.objects, [Song(spotify_id="synth_song_%d" % (first + offset + index), name=name,
+                    audio_features_id=af.pk, album_id=albums[index // 12].pk)
+                    for index, (name, af) in enumerate(zip(self.names(count, 3), audio_features))], 'spotify_id')
+
+                links = set()
+                for song in songs:
+                    for artist in self.random.randint(len(artists), size=self.random.randint(1, 3)):
+                        links.add((song.pk, artists[artist].pk))
+                Song.artists.through.objects.bulk_create([Song.artists.through(song_id=song_id, artist_id=artist_id)
+                    for song_id, artist_id in links], batch_size=500)
+            song_ids.extend(song.pk for song in songs)
+            features.append(matrix)
+        return np.array(song_ids), np.concatenate(features)
+
+    def generate_users(self, users_count):
+        first = User.objects.count()
+        users = bulk_insert(User.objects, [User(username="synth_user_%d" % (first + index), first_name=name)
+            for index, name in enumerate(self.names(users_count, 1))], 'username')
+        return [user.pk for user in users]
+
+    def generate_history(self, user_ids, song_ids, features, analyses_count, analysis_songs, days):
+        """
+        Inserts the analyses of each user, their songs are drawn from the generated catalogue and they are spread over the last days
+        The songs of the analyses of a batch of users are linked with bulk inserts
+        Returns the number of analyses
+        """
+        now = timezone.now()
+        users_by_batch = max(1, self.batch // max(1, analyses_count * analysis_songs))
+        total = 0
+        for offset in range(0, len(user_ids), users_by_batch):
+            with transaction.atomic():
+                summaries, analyses, songs_by_analysis = [], [], []
+                for user_id in user_ids[offset:offset + users_by_batch]:
+                    for index in range(analyses_count):
+                        # drawn without replacement, an analysis links each of its songs once
+                        size = min(len(song_ids), max(1, self.random.poisson(analysis_songs)))
+                        songs = self.random.choice(len(song_ids), size=size, replace=False)
+                        songs_by_analysis.append(song_ids[songs])
+                        mean = features[songs].mean(axis=0).round(2)
+                        summaries.append(AudioFeatures(**dict(zip(AudioFeatures.FEATURES, mean.tolist()))))
+                        created = now - timedelta(seconds=int(self.random.randint(days * 24 * 3600)))
+                        analyses.append(Analysis(user_id=user_id, songs_len=len(songs), created=created,
+                            datasource_type=self.DATASOURCE_TYPES[self.random.randint(len(self.DATASOURCE_TYPES))]))
+
+                AudioFeatures.bulk_save(summaries)
+                for analysis, summary in zip(analyses, summaries):
+                    analysis.summarised_audio_features_id = summary.pk
+                analyses = bulk_insert(Analysis.manager, analyses)
+
+                links = [link for analysis, songs in zip(analyses, songs_by_analysis) for link in analysis.songs_links([Song(pk=pk) for pk in songs.tolist()])]
+                Analysis.songs.through.objects.bulk_create(links, batch_size=500)
+            total += len(analyses)
+        return total
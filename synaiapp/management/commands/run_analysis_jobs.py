@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from synaiapp.jobs import AnalysisWorker
+from synaiapp.models import AnalysisJob
+import time
+
+class Command(BaseCommand):
+    help = "Runs the pending analysis jobs (to use with ANALYSIS_JOBS_MODE = 'worker')"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Run the pending jobs then exit")
+        parser.add_argument('--interval', type=float, default=1, help="Seconds to wait when there is no pending job")
+
+    def handle(self, *args, **options):
+        while(True):
+            # the jobs lost by a restart of a web process or of a worker
+            stale = AnalysisJob.fail_stale()
+            if(stale > 0):
+                self.stderr.write("%d stale job(s) failed" % stale)
+            while(AnalysisWorker.run_pending()):
+                pass
+            if(options['once']):
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,198 @@
+from django.db import connection
+from django.template.backends.django import DjangoTemplates, Template
+from collections import defaultdict
+import bisect
+import threading
+import time
+
+class Histogram:
+    """
+    A Prometheus-like histogram: the number of observations below each bucket, their count and their sum, by labels
+    """
+    def __init__(self, name, help, label, buckets):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.series = {}
+
+    def observe(self, label_value, value):
+        with self.lock:
+            series = self.series.get(label_value)
+            if(series == None):
+                series = self.series[label_value] = {'buckets': [0] * len(self.buckets), 'count': 0, 'sum': 0}
+            # an observation is counted in its bucket only, the buckets are summed when exposed
+            index = bisect.bisect_left(self.buckets, value)
+            if(index < len(self.buckets)):
+                series['buckets'][index] += 1
+            series['count'] += 1
+            series['sum'] += value
+
+    def clear(self):
+        with self.lock:
+            self.series = {}
+
+    def expose(self):
+        """
+        Returns the lines of the histogram in the Prometheus text format
+        """
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s histogram" % self.name]
+        with self.lock:
+            for label_value, series in sorted(self.series.items()):
+                label = '%s="%s"' % (self.label, label_value)
+                cumulative = 0
+                for bound, count in zip(self.buckets, series['buckets']):
+                    cumulative += count
+                    lines.append('%s_bucket{%s,le="%g"} %d' % (self.name, label, bound, cumulative))
+                lines.append('%s_bucket{%s,le="+Inf"} %d' % (self.name, label, series['count']))
+                lines.append('%s_count{%s} %d' % (self.name, label, series['count']))
+                lines.append('%s_sum{%s} %.6f' % (self.name, label, series['sum']))
+        return lines
+
+SECONDS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+QUERIES = [1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500]
+
+class Metrics:
+    """
+    The histograms of the process, exposed by MetricsView
+    """
+    request_duration = Histogram("synai_request_duration_seconds", "Duration of the requests by view", "view", SECONDS)
+    spotify_duration = Histogram("synai_spotify_request_duration_seconds", "Duration of the Spotify API calls by endpoint", "endpoint", SECONDS)
+    spotify_calls = Histogram("synai_spotify_calls_per_request", "Number of Spotify API calls of the requests by view", "view", QUERIES)
+    db_duration = Histogram("synai_db_duration_seconds", "Time spent in DB queries by the requests by view", "view", SECONDS)
+    db_queries = Histogram("synai_db_queries_per_request", "Number of DB queries of the requests by view", "view", QUERIES)
+    template_duration = Histogram("synai_template_duration_seconds", "Time spent rendering templates by the requests by view", "view", SECONDS)
+
+    @classmethod
+    def histograms(cls):
+        return [cls.request_duration, cls.spotify_duration, cls.spotify_calls, cls.db_duration, cls.db_queries, cls.template_duration]
+
+    @classmethod
+    def expose(cls):
+        return "\n".join(line for histogram in cls.histograms() for line in histogram.expose()) + "\n"
+
+    @classmethod
+    def clear(cls):
+        for histogram in cls.histograms():
+            histogram.clear()
+
+class RequestTimings:
+    """
+    The time spent by a request in Spotify API calls (by endpoint), DB queries and template rendering
+    The recorder of the current request is found by its thread, the threads working for the request
+    (IE the ones of SpotifyRequestManager.execute_queries) must be given it explicitly and install record_query on their own connection
+    """
+    _local = threading.local()
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.spotify = defaultdict(lambda: [0, 0.0])
+        self.db = [0, 0.0]
+        self.template = 0.0
+
+    @classmethod
+    def current(cls):
+        return getattr(cls._local, 'timings', None)
+
+    @classmethod
+    def activate(cls, timings):
+        cls._local.timings = timings
+
+    @classmethod
+    def record_spotify(cls, timings, endpoint, duration):
+        """
+        Records a Spotify API call, into the timings of a request if there is one
+        """
+        Metrics.spotify_duration.observe(endpoint, duration)
+        if(timings != None):
+            with timings.lock:
+                timings.spotify[endpoint][0] += 1
+                timings.spotify[endpoint][1] += duration
+
+    def record_query(self, execute, sql, params, many, context):
+        """
+        Times the DB queries, to install with connection.execute_wrapper
+        """
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            with self.lock:
+                self.db[0] += 1
+                self.db[1] += time.perf_counter() - start
+
+    def record_template(self, duration):
+        with self.lock:
+            self.template += duration
+
+    def server_timing(self, total):
+        """
+        Returns the value of the Server-Timing header, the durations are in milliseconds
+        """
+        with self.lock:
+            spotify_calls = sum(calls for calls, duration in self.spotify.values())
+            metrics = [
+                'db;dur=%.1f;desc="%d queries"' % (self.db[1] * 1000, self.db[0]),
+                'spotify;dur=%.1f;desc="%d calls"' % (sum(duration for calls, duration in self.spotify.values()) * 1000, spotify_calls),
+            ]
+            metrics.extend('spotify-%s;dur=%.1f;desc="%d calls"' % (endpoint, duration * 1000, calls)
+                for endpoint, (calls, duration) in sorted(self.spotify.items()))
+            metrics.append('template;dur=%.1f' % (self.template * 1000))
+        metrics.append('total;dur=%.1f' % (total * 1000))
+        return ', '.join(metrics)
+
+    def observe(self, view, total):
+        Metrics.request_duration.observe(view, total)
+        with self.lock:
+            Metrics.spotify_calls.observe(view, sum(calls for calls, duration in self.spotify.values()))
+            Metrics.db_queries.observe(view, self.db[0])
+            Metrics.db_duration.observe(view, self.db[1])
+            Metrics.template_duration.observe(view, self.template)
+
+class TimingMiddleware:
+    """
+    Records where the time of each request goes, sends it in a Server-Timing header and adds it to the Metrics histograms
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        timings = RequestTimings()
+        RequestTimings.activate(timings)
+        try:
+            with connection.execute_wrapper(timings.record_query):
+                response = self.get_response(request)
+        finally:
+            RequestTimings.activate(None)
+
+        total = time.perf_counter() - timings.start
+        response['Server-Timing'] = timings.server_timing(total)
+
+        match = request.resolver_match
+        view = match.url_name if match != None and match.url_name else "other"
+        timings.observe(view, total)
+        return response
+
+class TimedTemplate(Template):
+    def render(self, context=None, request=None):
+        start = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            timings = RequestTimings.current()
+            if(timings != None):
+                timings.record_template(time.perf_counter() - start)
+
+class TimedDjangoTemplates(DjangoTemplates):
+    """
+    The Django templates backend, the rendering of the templates is recorded in the timings of the request
+    The included templates are rendered by their parent so they are not counted twice
+    """
+    def from_string(self, template_code):
+        return TimedTemplate(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        template = super().get_template(template_name)
+        return TimedTemplate(template.template, self)
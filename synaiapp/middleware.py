@@ -0,0 +1,25 @@
+from django.http import HttpResponse
+from .services import SpotifyAPIError
+import logging
+logger = logging.getLogger(__name__)
+
+class SpotifyThrottledMiddleware:
+    """
+    Answers 503 with a "Retry-After" header when a view gives up because the Spotify API throttles us (429 or 503)
+    instead of a generic server error
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        return self.get_response(request)
+
+    def process_exception(self, request, exception):
+        if(not isinstance(exception, SpotifyAPIError) or exception.status_code not in (429, 503)):
+            return None
+
+        logger.warning("Spotify API throttled %s: %s", request.path, exception)
+        retry_after = exception.retry_after or 1
+        response = HttpResponse("Spotify is busy, please retry in %d seconds" % retry_after, status=503, content_type="text/plain")
+        response['Retry-After'] = str(retry_after)
+        return response
@@ -0,0 +1,39 @@
+# Generated by Django 2.1.7 on 2026-10-18 16:51
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.db.models.manager
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('synaiapp', '0010_analysis_datasource_type'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnalysisJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('datasource_type', models.CharField(max_length=30)),
+                ('datasource_id', models.CharField(blank=True, max_length=100)),
+                ('datasource_name', models.CharField(blank=True, max_length=255)),
+                ('status', models.CharField(default='pending', max_length=10)),
+                ('pages_fetched', models.IntegerField(default=0)),
+                ('songs_ingested', models.IntegerField(default=0)),
+                ('error', models.TextField(blank=True)),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('analysis', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='synaiapp.Analysis')),
+                ('recommendations', models.ManyToManyField(blank=True, to='synaiapp.Song')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            managers=[
+                ('manager', django.db.models.manager.Manager()),
+            ],
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 2.1.7 on 2026-10-18 16:53
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.db.models.manager
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('synaiapp', '0011_analysisjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AudioFeaturesSummary',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('songs_hash', models.CharField(max_length=64, unique=True)),
+                ('stats', models.TextField()),
+                ('audio_features', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='synaiapp.AudioFeatures')),
+            ],
+            managers=[
+                ('manager', django.db.models.manager.Manager()),
+            ],
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 2.1.7 on 2026-10-18 16:56
+
+from django.db import migrations, models
+
+
+# frozen copies of AudioFeatures.GRID_FEATURES, GRID_BUCKETS and grid_cell_of at the time of this migration
+GRID_FEATURES = ['acousticness', 'danceability', 'energy', 'valence']
+GRID_BUCKETS = 4
+
+
+def grid_cell_of(audio_features):
+    cell = 0
+    for feature in reversed(GRID_FEATURES):
+        value = getattr(audio_features, feature)
+        cell = cell * GRID_BUCKETS + min(max(int(value * GRID_BUCKETS), 0), GRID_BUCKETS - 1)
+    return cell
+
+
+def set_grid_cells(apps, schema_editor):
+    AudioFeatures = apps.get_model('synaiapp', 'AudioFeatures')
+    pks_by_cell = {}
+    for af in AudioFeatures._default_manager.only(*GRID_FEATURES).iterator():
+        pks_by_cell.setdefault(grid_cell_of(af), []).append(af.pk)
+    # one update by cell, by chunks to stay under the limit of parameters of SQLite
+    for cell, pks in pks_by_cell.items():
+        for start in range(0, len(pks), 500):
+            AudioFeatures._default_manager.filter(pk__in=pks[start:start + 500]).update(grid_cell=cell)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('synaiapp', '0012_audiofeaturessummary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='audiofeatures',
+            name='grid_cell',
+            field=models.PositiveSmallIntegerField(db_index=True, default=0),
+        ),
+        migrations.RunPython(set_grid_cells, migrations.RunPython.noop),
+    ]
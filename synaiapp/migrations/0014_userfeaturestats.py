@@ -0,0 +1,77 @@
+# Generated by Django 2.1.7 on 2026-10-18 16:57
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.db.models.manager
+from django.db.models import F, Sum, Count, FloatField, ExpressionWrapper
+from django.db.models.functions import TruncDate
+
+
+FEATURES = ['acousticness', 'danceability', 'energy', 'instrumentalness', 'liveness', 'valence', 'speechiness', 'tempo']
+
+
+def backfill_stats(apps, schema_editor):
+    Analysis = apps.get_model('synaiapp', 'Analysis')
+    UserFeatureStats = apps.get_model('synaiapp', 'UserFeatureStats')
+
+    sums = {}
+    for feature in FEATURES:
+        value = F('song__audio_features__' + feature)
+        sums[feature + '_sum'] = Sum(value)
+        sums[feature + '_sumsq'] = Sum(ExpressionWrapper(value * value, output_field=FloatField()))
+    days = Analysis.songs.through._default_manager.filter(song__audio_features__isnull=False) \
+        .annotate(day=TruncDate('analysis__created')) \
+        .values('analysis__user', 'day') \
+        .annotate(count=Count('pk'), **sums) \
+        .order_by()
+
+    stats = []
+    for day in days:
+        user_id = day.pop('analysis__user')
+        stats.append(UserFeatureStats(user_id=user_id, **day))
+    UserFeatureStats._default_manager.bulk_create(stats, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('synaiapp', '0013_audiofeatures_grid_cell'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserFeatureStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('acousticness_sum', models.FloatField(default=0)),
+                ('acousticness_sumsq', models.FloatField(default=0)),
+                ('danceability_sum', models.FloatField(default=0)),
+                ('danceability_sumsq', models.FloatField(default=0)),
+                ('energy_sum', models.FloatField(default=0)),
+                ('energy_sumsq', models.FloatField(default=0)),
+                ('instrumentalness_sum', models.FloatField(default=0)),
+                ('instrumentalness_sumsq', models.FloatField(default=0)),
+                ('liveness_sum', models.FloatField(default=0)),
+                ('liveness_sumsq', models.FloatField(default=0)),
+                ('valence_sum', models.FloatField(default=0)),
+                ('valence_sumsq', models.FloatField(default=0)),
+                ('speechiness_sum', models.FloatField(default=0)),
+                ('speechiness_sumsq', models.FloatField(default=0)),
+                ('tempo_sum', models.FloatField(default=0)),
+                ('tempo_sumsq', models.FloatField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            managers=[
+                ('manager', django.db.models.manager.Manager()),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='userfeaturestats',
+            unique_together={('user', 'day')},
+        ),
+        migrations.RunPython(backfill_stats, migrations.RunPython.noop),
+    ]
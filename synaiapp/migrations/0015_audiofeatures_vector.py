@@ -0,0 +1,42 @@
+# Generated by Django 2.1.7 on 2026-10-18 16:59
+
+from django.db import migrations, models
+from django.db.models import Case, When, Value
+import numpy as np
+
+
+FEATURES = ['acousticness', 'danceability', 'energy', 'instrumentalness', 'liveness', 'valence', 'speechiness', 'tempo']
+# rows by update, 3 parameters each to stay under the limit of parameters of SQLite
+CHUNK = 250
+
+
+def pack_vectors(apps, schema_editor):
+    AudioFeatures = apps.get_model('synaiapp', 'AudioFeatures')
+    rows = AudioFeatures._default_manager.filter(vector__isnull=True).order_by('pk').values_list('pk', *FEATURES)
+    last = 0
+    while True:
+        chunk = list(rows.filter(pk__gt=last)[:CHUNK])
+        if len(chunk) == 0:
+            break
+        # one update by chunk, a CASE gives each row its vector
+        vectors = [When(pk=row[0], then=Value(np.asarray(row[1:], dtype=np.float32).tobytes(), output_field=models.BinaryField()))
+            for row in chunk]
+        AudioFeatures._default_manager.filter(pk__in=[row[0] for row in chunk]) \
+            .update(vector=Case(*vectors, output_field=models.BinaryField()))
+        last = chunk[-1][0]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('synaiapp', '0014_userfeaturestats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='audiofeatures',
+            name='vector',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.RunPython(pack_vectors, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 2.1.7 on 2026-10-18 17:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('synaiapp', '0015_audiofeatures_vector'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='analysis',
+            index=models.Index(fields=['user', 'created'], name='analysis_user_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='analysis',
+            index=models.Index(fields=['user', 'datasource_type', 'created'], name='analysis_user_type_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='analysisjob',
+            index=models.Index(fields=['status', 'created'], name='analysisjob_status_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.1.7 on 2026-10-18 17:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('synaiapp', '0016_analysis_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='audiofeatures',
+            name='spotify_id',
+            field=models.CharField(db_index=True, max_length=100, null=True),
+        ),
+    ]
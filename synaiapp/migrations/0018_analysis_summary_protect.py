@@ -0,0 +1,19 @@
+# Generated by Django 2.1.7 on 2026-10-18 17:36
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('synaiapp', '0017_audiofeatures_spotify_id'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='analysis',
+            name='summarised_audio_features',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='synaiapp.AudioFeatures'),
+        ),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 2.1.7 on 2026-10-18 18:02
+
+from django.db import migrations, models
+from django.db.models import Case, When, Value
+import numpy as np
+
+
+# frozen copies of AudioFeatures.FEATURES, GRID_FEATURES, GRID_BUCKETS, grid_cell_of and pack at the time of this migration
+FEATURES = ['acousticness', 'danceability', 'energy', 'instrumentalness', 'liveness', 'valence', 'speechiness', 'tempo']
+GRID_FEATURES = ['acousticness', 'danceability', 'energy', 'valence']
+GRID_BUCKETS = 4
+# rows by update, 5 parameters each to stay under the limit of parameters of SQLite
+CHUNK = 150
+
+
+def grid_cell_of(values):
+    cell = 0
+    for feature in reversed(GRID_FEATURES):
+        value = values[FEATURES.index(feature)]
+        cell = cell * GRID_BUCKETS + min(max(int(value * GRID_BUCKETS), 0), GRID_BUCKETS - 1)
+    return cell
+
+
+def repair_index_fields(apps, schema_editor):
+    """
+    The rows loaded with loaddata before AudioFeatures set its index fields on raw saves have no vector and are in the grid cell 0
+    """
+    AudioFeatures = apps.get_model('synaiapp', 'AudioFeatures')
+    rows = AudioFeatures._default_manager.filter(vector__isnull=True).order_by('pk').values_list('pk', *FEATURES)
+    last = 0
+    while True:
+        chunk = list(rows.filter(pk__gt=last)[:CHUNK])
+        if len(chunk) == 0:
+            break
+        vectors = [When(pk=row[0], then=Value(np.asarray(row[1:], dtype=np.float32).tobytes(), output_field=models.BinaryField()))
+            for row in chunk]
+        cells = [When(pk=row[0], then=Value(grid_cell_of(row[1:]))) for row in chunk]
+        AudioFeatures._default_manager.filter(pk__in=[row[0] for row in chunk]).update(
+            vector=Case(*vectors, output_field=models.BinaryField()),
+            grid_cell=Case(*cells, output_field=models.PositiveSmallIntegerField()))
+        last = chunk[-1][0]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('synaiapp', '0018_analysis_summary_protect'),
+    ]
+
+    operations = [
+        migrations.RunPython(repair_index_fields, migrations.RunPython.noop),
+    ]
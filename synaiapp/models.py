@@ -1,14 +1,181 @@
 from django.db import models
 from django.contrib.auth.models import User
-from functools import reduce
 from django.utils import timezone
-from django.db.models import prefetch_related_objects
+from django.db.models import prefetch_related_objects, Prefetch, F, Q, Sum, Count, FloatField, ExpressionWrapper
+from django.db.models.functions import TruncDate
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.db import connections, transaction, IntegrityError
+from django.conf import settings
+from collections import OrderedDict, namedtuple
+from datetime import timedelta
+from operator import attrgetter
+import numpy as np
+import hashlib
 import json
+import threading
 
 # Logger & debug
 import logging
 logger = logging.getLogger(__name__)
 
+def bulk_insert(manager, objects, key=None):
+    """
+    Saves a list of new objects of the manager's model with bulk inserts and sets their primary keys
+    The backends returning the ids of a bulk insert (IE PostgreSQL) set them, on the others (IE SQLite) they are read back
+    by key, a field naming the content of a row (IE its spotify id), without key the objects are saved one by one
+    """
+    connection = connections[manager.db]
+    if(len(objects) == 0 or connection.features.can_return_ids_from_bulk_insert):
+        return manager.bulk_create(objects)
+
+    with transaction.atomic(using=manager.db):
+        if(key == None):
+            for obj in objects:
+                obj.save(force_insert=True, using=manager.db)
+            return objects
+
+        objects = manager.bulk_create(objects)
+        # another session may have inserted a row of the same key meanwhile, it has the same content so either one is right
+        pks = dict(manager.filter(**{key + '__in': [getattr(obj, key) for obj in objects]}).values_list(key, 'pk'))
+        for obj in objects:
+            obj.pk = pks[getattr(obj, key)]
+    return objects
+
+class SpotifyIdCache:
+    """
+    A bounded LRU cache of the primary keys of a model by spotify id (SPOTIFY_ID_CACHE_SIZE entries)
+    The entries are updated when an object is saved or deleted
+    The missing ids are not cached: another process may insert them at any time
+    """
+    caches = []
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        SpotifyIdCache.caches.append(self)
+
+    def get(self, spotify_id):
+        """
+        Returns the primary key of the object or None if it is not cached
+        """
+        with self.lock:
+            pk = self.entries.get(spotify_id)
+            if(pk != None):
+                self.entries.move_to_end(spotify_id)
+            return pk
+
+    def add(self, spotify_id, pk):
+        """
+        Caches the primary key of an object
+        """
+        with self.lock:
+            self.entries[spotify_id] = pk
+            self.entries.move_to_end(spotify_id)
+            while(len(self.entries) > settings.SPOTIFY_ID_CACHE_SIZE):
+                self.entries.popitem(last=False)
+
+    def discard(self, spotify_id):
+        with self.lock:
+            self.entries.pop(spotify_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    @classmethod
+    def clear_all(cls):
+        for cache in cls.caches:
+            cache.clear()
+
+class SpotifyIdMixin:
+    """
+    Helpers to resolve the spotify ids of a model (Artist, Album, Song) through its id_cache before querying the DB
+    """
+    @classmethod
+    def lookup_queryset(cls):
+        """
+        Returns the queryset the objects are looked up with, a model can join the relations its objects are always read with
+        """
+        return cls.objects.all()
+
+    @classmethod
+    def get_by_spotify_id(cls, spotify_id):
+        """
+        Returns the object with the given spotify id or None
+        """
+        obj = cls.lookup_queryset().filter(spotify_id=spotify_id).first()
+        if(obj != None):
+            cls.id_cache.add(spotify_id, obj.pk)
+        return obj
+
+    @classmethod
+    def get_by_spotify_ids(cls, spotify_ids):
+        """
+        Returns a dictionary of the existing objects by spotify id with at most one query
+        """
+        objects = cls.lookup_queryset().in_bulk(list(set(spotify_ids)), field_name='spotify_id')
+        for spotify_id, obj in objects.items():
+            cls.id_cache.add(spotify_id, obj.pk)
+        return objects
+
+    @classmethod
+    def resolve_ids(cls, spotify_ids):
+        """
+        Returns a dictionary of the primary keys of the existing objects by spotify id
+        Only the ids that are not cached are queried, with at most one query
+        """
+        pks = {}
+        unknown_ids = []
+        for spotify_id in set(spotify_ids):
+            pk = cls.id_cache.get(spotify_id)
+            if(pk == None):
+                unknown_ids.append(spotify_id)
+            else:
+                pks[spotify_id] = pk
+
+        if(len(unknown_ids) != 0):
+            found = dict(cls.objects.filter(spotify_id__in=unknown_ids).values_list('spotify_id', 'pk'))
+            for spotify_id, pk in found.items():
+                cls.id_cache.add(spotify_id, pk)
+            pks.update(found)
+        return pks
+
+    @classmethod
+    def forget_ids(cls, spotify_ids):
+        """
+        Drops the cached ids that are about to be inserted in bulk (bulk inserts don't send the post_save signal)
+        or whose insert was rolled back
+        """
+        for spotify_id in spotify_ids:
+            cls.id_cache.discard(spotify_id)
+
+class AudioFeaturesStats:
+    """
+    Statistics of a set of audio features computed from a (N, 8) matrix of their values
+    Each statistic is a dictionary of values by feature, the percentiles are given by rank (IE percentiles[25])
+    """
+    PERCENTILES = [0, 25, 50, 75, 100]
+
+    def __init__(self, matrix):
+        features = AudioFeatures.FEATURES
+        percentiles = np.percentile(matrix, self.PERCENTILES, axis=0)
+
+        self.count = len(matrix)
+        self.mean = dict(zip(features, matrix.mean(axis=0).tolist()))
+        self.std = dict(zip(features, matrix.std(axis=0).tolist()))
+        self.percentiles = {rank : dict(zip(features, values.tolist())) for rank, values in zip(self.PERCENTILES, percentiles)}
+        self.min = self.percentiles[0]
+        self.median = self.percentiles[50]
+        self.max = self.percentiles[100]
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'mean': self.mean,
+            'std': self.std,
+            'percentiles': self.percentiles,
+        }
+
 class AudioFeatures(models.Model):
     acousticness = models.FloatField()
     danceability = models.FloatField()
@@ -18,30 +185,142 @@ class AudioFeatures(models.Model):
     valence = models.FloatField()
     speechiness = models.FloatField()
     tempo = models.FloatField()
+    # the cell of the grid index the features are in, see grid_cell_of
+    grid_cell = models.PositiveSmallIntegerField(default=0, db_index=True)
+    # the features packed as 8 float32, see load_vectors
+    vector = models.BinaryField(null=True)
+    # the spotify id of the track the features are of (None for a summary), bulk_save reads the primary keys back by it
+    spotify_id = models.CharField(max_length=100, null=True, db_index=True)
 
     manager = models.Manager()
 
+    FEATURES = [
+        'acousticness',
+        'danceability',
+        'energy',
+        'instrumentalness',
+        'liveness',
+        'valence',
+        'speechiness',
+        'tempo',
+    ]
+
+    # the grid index splits each of these features (between 0 and 1) in GRID_BUCKETS buckets
+    GRID_FEATURES = ['acousticness', 'danceability', 'energy', 'valence']
+    GRID_BUCKETS = 4
+
+    @classmethod
+    def grid_bucket(cls, value):
+        return min(max(int(value * cls.GRID_BUCKETS), 0), cls.GRID_BUCKETS - 1)
+
+    @classmethod
+    def grid_cell_of(cls, audio_features):
+        """
+        Returns the number of the grid cell of audio features, IE the buckets of its GRID_FEATURES as digits in base GRID_BUCKETS
+        """
+        cell = 0
+        for feature in reversed(cls.GRID_FEATURES):
+            cell = cell * cls.GRID_BUCKETS + cls.grid_bucket(getattr(audio_features, feature))
+        return cell
+
+    @classmethod
+    def grid_cells(cls, bounds):
+        """
+        Returns the numbers of the grid cells overlapping a box of features
+        bounds is a dictionary of (min, max) by feature, the GRID_FEATURES without bounds span all their buckets
+        """
+        cells = [0]
+        for feature in reversed(cls.GRID_FEATURES):
+            low, high = bounds.get(feature, (0, 1))
+            buckets = range(cls.grid_bucket(low), cls.grid_bucket(high) + 1)
+            cells = [cell * cls.GRID_BUCKETS + bucket for cell in cells for bucket in buckets]
+        return cells
+
+    @classmethod
+    def pack(cls, values):
+        """
+        Packs the 8 values of the features (in the FEATURES order) as float32 bytes
+        """
+        return np.asarray(values, dtype=np.float32).tobytes()
+
+    @classmethod
+    def unpack_vectors(cls, blobs):
+        """
+        Unpacks a list of packed vectors into a (N, 8) float32 matrix
+        """
+        return np.frombuffer(b''.join(blobs), dtype=np.float32).reshape(-1, len(cls.FEATURES))
+
+    @classmethod
+    def load_vectors(cls, queryset, field='vector'):
+        """
+        Loads the packed vectors of a queryset into a (N, 8) float32 matrix without building any model instance
+        field is the path of the vector from the model of the queryset, IE 'audio_features__vector' for songs
+        The rows whose vector isn't packed yet are read from their columns
+        """
+        blobs = list(queryset.values_list(field, flat=True))
+        if(None in blobs):
+            prefix = field[:-len('vector')]
+            rows = queryset.values_list(*[prefix + feature for feature in cls.FEATURES])
+            return np.array(list(rows), dtype=np.float32).reshape(-1, len(cls.FEATURES))
+        return cls.unpack_vectors(blobs)
+
+    @classmethod
+    def features_matrix(cls, audio_features):
+        """
+        Loads the values of a list (or a queryset) of audio features into a (N, 8) float matrix, a row by audio features
+        A queryset is read from the packed vectors so no model instance is built
+        A None in the list (IE a song without audio features) is a row of zeros
+        """
+        if(isinstance(audio_features, models.QuerySet)):
+            return cls.load_vectors(audio_features).astype(np.float64)
+        getter = attrgetter(*cls.FEATURES)
+        zeros = (0,) * len(cls.FEATURES)
+        rows = [zeros if af == None else getter(af) for af in audio_features]
+        return np.array(rows, dtype=np.float64).reshape(-1, len(cls.FEATURES))
+
+    @classmethod
+    def statistics(cls, audio_features):
+        """
+        Returns the statistics (mean, median, std, percentiles) of a list or a queryset of audio features
+        """
+        matrix = cls.features_matrix(audio_features)
+        if(len(matrix) == 0):
+            raise ValueError("Cannot compute the statistics of an empty list of audio features")
+        return AudioFeaturesStats(matrix)
+
+    @classmethod
+    def summarise_with_stats(cls, audio_features_list):
+        """
+        Returns the summary of a list of audio features (their means) and their statistics
+        """
+        stats = cls.statistics(audio_features_list)
+        summary = AudioFeatures(**{feature : round(value, 2) for feature, value in stats.mean.items()})
+        return summary, stats
+
     @classmethod
     def summarise(cls, audio_features_list):
-        summary = AudioFeatures()
-        summary.acousticness = AudioFeatures.mean("acousticness", audio_features_list)
-        summary.danceability = AudioFeatures.mean("danceability", audio_features_list)
-        summary.energy = AudioFeatures.mean("energy", audio_features_list)
-        summary.instrumentalness = AudioFeatures.mean("instrumentalness", audio_features_list)
-        summary.liveness = AudioFeatures.mean("liveness", audio_features_list)
-        summary.valence = AudioFeatures.mean("valence", audio_features_list)
-        summary.speechiness = AudioFeatures.mean("speechiness", audio_features_list)
-        summary.tempo = AudioFeatures.mean("tempo", audio_features_list)
+        summary, stats = cls.summarise_with_stats(audio_features_list)
         return summary
 
-    
     @classmethod
     def mean(cls, attribute, audio_features_list):
-        return round(reduce(lambda a, b: a+b, [getattr(x, attribute, 0) for x in audio_features_list]) /len(audio_features_list), 2)
+        return round(float(np.mean([getattr(x, attribute, 0) for x in audio_features_list])), 2)
     
+    @classmethod
+    def bulk_save(cls, audio_features_list):
+        """
+        Saves a list of audio features with a single bulk insert and sets their primary keys
+        The features of tracks are read back by their spotify id, the summaries are saved one by one (see bulk_insert)
+        """
+        for af in audio_features_list:
+            af.set_index_fields()
+        key = 'spotify_id' if all(af.spotify_id != None for af in audio_features_list) else None
+        return bulk_insert(cls.manager, audio_features_list, key)
+
     @classmethod
     def create(cls, audio_features):
         af = cls()
+        af.spotify_id = audio_features.get('id')
         af.acousticness = audio_features['acousticness']
         af.danceability = audio_features['danceability']
         af.energy = audio_features['energy']
@@ -53,19 +332,36 @@ class AudioFeatures(models.Model):
 
         return af
 
+    @classmethod
+    def round_significant(cls, matrix, digits):
+        """
+        Rounds each value of a matrix to a number of significant digits
+        """
+        magnitude = np.floor(np.log10(np.abs(np.where(matrix == 0, 1, matrix))))
+        scale = 10 ** (digits - 1 - magnitude)
+        return np.round(matrix * scale) / scale
+
     @classmethod
     def prepare_data_for_linegraph(cls, audio_features):
+        """
+        Builds a line by feature (but the tempo) of a list of audio features or of a (N, 8) matrix of their values (IE from load_vectors)
+        """
+        if(isinstance(audio_features, np.ndarray)):
+            matrix = audio_features
+            if(matrix.dtype == np.float32):
+                # a float32 has 7 significant digits, the others are noise (IE 0.30000001192092896 instead of 0.3)
+                matrix = cls.round_significant(matrix.astype(np.float64), 7)
+        else:
+            matrix = np.array([[getattr(af, feature, 0) for feature in cls.FEATURES] for af in audio_features], dtype=np.float64)
+            matrix = matrix.reshape(-1, len(cls.FEATURES))
+
         graph_data = []
         # Foreach feature (acousticness, livness, valence,...)
         features_attributes = [attr.lower() for attr in cls.features_headers()[:-1]]
-        for feature in features_attributes:
-            # Add the title
+        for column, feature in enumerate(features_attributes):
+            # Add the title and the value of each audio features
             line = [feature]
-            
-            # Get the attrib value of each audio features
-            for af in audio_features:
-                value = getattr(af, feature, 0)
-                line.append(value)
+            line.extend(matrix[:, column].tolist())
             # Add the line to the dataset
             graph_data.append(line)
         return graph_data
@@ -84,6 +380,17 @@ class AudioFeatures(models.Model):
             "Tempo"
         ]
 
+    def set_index_fields(self):
+        """
+        Sets the fields derived from the features: the grid cell and the packed vector
+        """
+        self.grid_cell = self.grid_cell_of(self)
+        self.vector = self.pack([getattr(self, feature) for feature in self.FEATURES])
+
+    def save(self, *args, **kwargs):
+        self.set_index_fields()
+        super().save(*args, **kwargs)
+
     def as_array(self):
         return [
             self.acousticness,
@@ -96,13 +403,58 @@ class AudioFeatures(models.Model):
             self.tempo/100,
         ]
 
-class Artist(models.Model):
+class AudioFeaturesSummary(models.Model):
+    """
+    The summarised audio features of a list of songs and their statistics (as JSON)
+    It is keyed by the hash of the sorted ids of the songs so analysing the same songs again reuses it
+    """
+    songs_hash = models.CharField(max_length=64, unique=True)
+    audio_features = models.ForeignKey(AudioFeatures, on_delete=models.CASCADE)
+    stats = models.TextField()
+
+    manager = models.Manager()
+
+    @classmethod
+    def hash_songs(cls, songs):
+        """
+        Hash of the sorted primary keys of the songs, a song listed twice counts twice in the summary so it is kept twice
+        """
+        song_ids = ','.join(str(pk) for pk in sorted(song.pk for song in songs))
+        return hashlib.sha256(song_ids.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def get_or_create(cls, songs):
+        """
+        Return the summary of the songs, it is computed and saved only if these songs were never summarised
+        """
+        songs_hash = cls.hash_songs(songs)
+        summary = cls.manager.select_related('audio_features').filter(songs_hash=songs_hash).first()
+        if summary != None:
+            return summary
+
+        audio_features, stats = AudioFeatures.summarise_with_stats([song.audio_features for song in songs])
+        try:
+            with transaction.atomic():
+                audio_features.save()
+                summary = cls(songs_hash=songs_hash, audio_features=audio_features, stats=json.dumps(stats.as_dict()))
+                summary.save()
+        except IntegrityError:
+            # another request summarised the same songs meanwhile
+            summary = cls.manager.select_related('audio_features').get(songs_hash=songs_hash)
+        return summary
+
+    def get_stats(self):
+        return json.loads(self.stats)
+
+class Artist(SpotifyIdMixin, models.Model):
     spotify_id = models.CharField(max_length=100, unique=True)
     name = models.CharField(max_length=255)
 
+    id_cache = SpotifyIdCache()
+
     @classmethod
     def get_artist(cls, artist_id):
-        artist = Artist.objects.filter(spotify_id=artist_id).first()
+        artist = Artist.get_by_spotify_id(artist_id)
         return artist
     
     @classmethod
@@ -110,13 +462,15 @@ class Artist(models.Model):
         artist = cls(spotify_id=spotify_id, name=name)
         return artist
 
-class Album(models.Model):
+class Album(SpotifyIdMixin, models.Model):
     spotify_id = models.CharField(max_length=100, unique=True)
     name = models.CharField(max_length=255)
 
+    id_cache = SpotifyIdCache()
+
     @classmethod
     def get_album(cls, album_id):
-        album = Album.objects.filter(spotify_id=album_id).first()
+        album = Album.get_by_spotify_id(album_id)
         return album
 
     @classmethod
@@ -127,22 +481,41 @@ class Album(models.Model):
     def get_songs(self):
         return self.selected_related()
 
-class Song(models.Model):
+class Song(SpotifyIdMixin, models.Model):
     spotify_id = models.CharField(max_length=100, unique=True)
     name = models.CharField(max_length=255)
     artists = models.ManyToManyField(Artist)
     album = models.ForeignKey(Album, null=True, on_delete=models.SET_NULL)
     audio_features = models.ForeignKey(AudioFeatures, null=True, on_delete=models.SET_NULL)
 
+    id_cache = SpotifyIdCache()
+
+    @classmethod
+    def lookup_queryset(cls):
+        # the audio features of the songs are read by every analysis
+        return cls.objects.select_related('audio_features')
+
     @classmethod
     def get_song(cls, song_req_id):
-        return cls.objects.filter(spotify_id=song_req_id).first()
+        return cls.get_by_spotify_id(song_req_id)
 
     @classmethod
     def create(cls, song_id, name, audio_features, album):
         song = cls(spotify_id = song_id, name=name, audio_features=audio_features, album = album)
         return song
 
+    @classmethod
+    def in_feature_box(cls, bounds):
+        """
+        Returns the songs whose audio features are in a box, bounds is a dictionary of (min, max) by feature
+        Only the rows of the grid cells overlapping the box are read thanks to the index on the grid cell
+        """
+        filters = {'audio_features__%s__range' % feature : (low, high) for feature, (low, high) in bounds.items()}
+        cells = AudioFeatures.grid_cells(bounds)
+        if(len(cells) < AudioFeatures.GRID_BUCKETS ** len(AudioFeatures.GRID_FEATURES)):
+            filters['audio_features__grid_cell__in'] = cells
+        return cls.objects.filter(**filters)
+
     @classmethod
     def get_songs_with_artists_and_album_names(cls, songs):
         """
@@ -154,7 +527,6 @@ class Song(models.Model):
 
         # gets the artists on an already fetched queryset
         prefetch_related_objects(songs, 'artists', 'album')
-        albums = Album.objects.filter(spotify_id__in=(song.id for song in songs))
 
         for song in songs:
             songs_name.append(song.name)
@@ -167,110 +539,174 @@ class Song(models.Model):
         songs_dataset = zip(songs_name, artists_names, album_names)
         return songs_dataset
 
+def update_id_cache(sender, instance, **kwargs):
+    sender.id_cache.add(instance.spotify_id, instance.pk)
+
+def discard_id_cache(sender, instance, **kwargs):
+    sender.id_cache.discard(instance.spotify_id)
+
+for model in (Artist, Album, Song):
+    post_save.connect(update_id_cache, sender=model)
+    post_delete.connect(discard_id_cache, sender=model)
+
+def set_raw_index_fields(sender, instance, raw, **kwargs):
+    # loaddata saves the rows without AudioFeatures.save, the fields of the grid index and the vector are set here
+    if raw:
+        instance.set_index_fields()
+
+pre_save.connect(set_raw_index_fields, sender=AudioFeatures)
+
 class Analysis(models.Model):
     songs = models.ManyToManyField(Song)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
-    summarised_audio_features = models.ForeignKey(AudioFeatures, on_delete=models.CASCADE)
+    # protected, the summary of the same songs is shared by the analyses of every user (see AudioFeaturesSummary)
+    summarised_audio_features = models.ForeignKey(AudioFeatures, on_delete=models.PROTECT)
     songs_len = models.IntegerField()
     datasource_type = models.CharField(max_length=30, default="unknown")
     created = models.DateTimeField(default=timezone.now)
 
     manager = models.Manager()
 
+    class Meta:
+        # the analyses are always read by user in chronological order, the history can be filtered by datasource type
+        indexes = [
+            models.Index(fields=['user', 'created'], name='analysis_user_created_idx'),
+            models.Index(fields=['user', 'datasource_type', 'created'], name='analysis_user_type_idx'),
+        ]
+
     @classmethod
     def create(cls, songs, user, summarised_audio_features, datasource_type):
-        analysis = cls(user=user, summarised_audio_features=summarised_audio_features, songs_len=len(songs), datasource_type=datasource_type)
-        analysis.save()
-        for song in songs:
-            analysis.songs.add(song)
+        with transaction.atomic():
+            analysis = cls(user=user, summarised_audio_features=summarised_audio_features, songs_len=len(songs), datasource_type=datasource_type)
+            analysis.save()
+            Analysis.songs.through.objects.bulk_create(analysis.songs_links(songs))
         return analysis
 
     @classmethod
-    def get_user_history(cls, user, order=1):
+    def create_many(cls, analysis_list):
         """
-        Get the full analysis history of a user
+        Create many analysis at once (IE for backfills) with bulk inserts
+        analysis_list is a list of tuples (songs, user, summarised_audio_features, datasource_type) like the create parameters
+        The summarised audio features that are not saved yet are saved as well
+        The statistics of the users are not updated, UserFeatureStats.rebuild must be called afterwards
         """
-        analysis = Analysis.manager.filter(user=user).prefetch_related('songs__audio_features').select_related('summarised_audio_features')
-        
-        # yeah lazy load that analysis
-        if order < 1:
-            analysis = analysis.order_by('-created')
+        with transaction.atomic():
+            AudioFeatures.bulk_save([summary for songs, user, summary, datasource_type in analysis_list if summary.pk == None])
 
-        # get all songs of the analysis
-        songs = [ana.songs for ana in analysis]
+            analysis = bulk_insert(Analysis.manager, [cls(user=user, summarised_audio_features=summary, songs_len=len(songs), datasource_type=datasource_type)
+                for songs, user, summary, datasource_type in analysis_list])
 
-        # get the summarised audio features of each analysis
-        audio_features = [ana.summarised_audio_features for ana in analysis]
+            songs_links = [link for analy, (songs, user, summary, datasource_type) in zip(analysis, analysis_list) for link in analy.songs_links(songs)]
+            Analysis.songs.through.objects.bulk_create(songs_links, batch_size=500)
+        return analysis
 
-        return analysis, songs, audio_features
+    def songs_links(self, songs):
+        """
+        Build the rows of the many to many table between the analysis and its songs, a song is linked only once
+        """
+        song_ids = dict.fromkeys(song.pk for song in songs)
+        return [Analysis.songs.through(analysis_id=self.pk, song_id=song_id) for song_id in song_ids]
 
     @classmethod
-    def get_user_summarised_data(cls, user):
+    def history_queryset(cls, user):
         """
-        Get a summary of all the analysis done for a user as an AudioFeatures
+        Analysis of a user with their summary and their songs (with their audio features) in song_list
+        Everything is fetched with two queries whatever the number of analysis
         """
-        analysis, songs, audio_features = Analysis.get_user_history(user)
-        if len(analysis) < 1:
-            return None
+        songs = Song.objects.select_related('audio_features')
+        return Analysis.manager.filter(user=user) \
+            .select_related('summarised_audio_features') \
+            .prefetch_related(Prefetch('songs', queryset=songs, to_attr='song_list'))
 
-        # Prepare the header
-        graph_headers = ["Analysis"]
-
-        # Summarize the analysis of the same day
-        af_to_prepare = []
+    @classmethod
+    def get_user_history(cls, user, order=1):
+        """
+        Get the full analysis history of a user (IE for an export), the views read it a page at a time with get_user_history_page
+        Return a tuple of HistoryEntry (analysis, summarised audio features, songs)
+        """
+        analysis = Analysis.history_queryset(user)
         
-        # Add the first analysis
-        af_to_summarize = [audio_features[0]]
-        graph_headers.append(analysis[0].created.strftime('%d.%m.%Y'))
+        if order < 1:
+            analysis = analysis.order_by('-created', '-pk')
+        else:
+            analysis = analysis.order_by('created', 'pk')
 
-        # For all the other analysis
-        for i in range(1, len(analysis)):
+        return tuple(HistoryEntry.create(analy) for analy in analysis)
 
-            # If the date are diffrent
-            date_str = analysis[i].created.strftime('%d.%m.%Y')
-            if graph_headers[-1] != date_str:
+    @classmethod
+    def get_history_entry(cls, user, analysis_id):
+        """
+        Get an analysis of the user as a HistoryEntry, None if the user doesn't have this analysis
+        """
+        analysis = Analysis.history_queryset(user).filter(pk=analysis_id).first()
+        if analysis == None:
+            return None
+        return HistoryEntry.create(analysis)
 
-                # Summarize the af if there is more than one in the list
-                if len(af_to_summarize) > 1 :
-                    summarised_af = AudioFeatures.summarise(af_to_summarize)
+    @classmethod
+    def get_user_history_page(cls, user, cursor=None, order=-1, page_size=10, datasource_type=None):
+        """
+        Get a page of the analysis history of a user (newest first unless order is 1) without their songs
+        The page starts after the analysis whose id is the cursor (keyset pagination on created and id)
+        Only the analyses of a datasource type are given if there is one
+        Return the analysis of the page and the cursor of the next page (None on the last page)
+        """
+        analysis = Analysis.manager.filter(user=user).select_related('summarised_audio_features')
+        if datasource_type != None:
+            analysis = analysis.filter(datasource_type=datasource_type)
+
+        if cursor != None:
+            last = Analysis.manager.filter(user=user, pk=cursor).values('created', 'pk').first()
+            if last != None:
+                # the range on created lets the (user, created) index seek the cursor instead of walking the newer analyses
+                if order < 1:
+                    analysis = analysis.filter(Q(created__lt=last['created']) | Q(created=last['created'], pk__lt=last['pk']), created__lte=last['created'])
                 else:
-                    summarised_af = af_to_summarize[0]
+                    analysis = analysis.filter(Q(created__gt=last['created']) | Q(created=last['created'], pk__gt=last['pk']), created__gte=last['created'])
 
-                # Add the date in headers
-                graph_headers.append(date_str)
+        if order < 1:
+            analysis = analysis.order_by('-created', '-pk')
+        else:
+            analysis = analysis.order_by('created', 'pk')
 
-                # Add the summarize af in the "to prepare" list
-                af_to_prepare.append(summarised_af)
+        # one more analysis tells us if there is a next page
+        page = list(analysis[:page_size + 1])
+        next_cursor = page[page_size - 1].pk if len(page) > page_size else None
 
-                # Create the new list
-                af_to_summarize = [audio_features[i]]
+        return page[:page_size], next_cursor
 
-            # Else the date are the same
-            else:
-                # And add the current analysis to the af list to summarize
-                af_to_summarize.append(audio_features[i])
+    @classmethod
+    def get_user_summarised_data(cls, user):
+        """
+        Get a summary of all the analysis done for a user, day by day, as a graph dataset
+        The means of each day are read from the running statistics of the user, without walking the analyses
+        """
+        features_attributes = [attr.lower() for attr in AudioFeatures.features_headers()[:-1]]
 
-        # Summarize the last using the same test as above
+        days = UserFeatureStats.manager.filter(user=user, count__gt=0).order_by('day')
 
-        if len(af_to_summarize) > 1 :
-            summarised_af = AudioFeatures.summarise(af_to_summarize)
-        else:
-            summarised_af = af_to_summarize[0]
+        if len(days) < 1:
+            return None
 
-        # And add it to the lists
-        graph_headers.append(date_str)
-        af_to_prepare.append(summarised_af)
+        # Prepare the header
+        graph_headers = ["Analysis"]
+        graph_headers.extend(day.day.strftime('%d.%m.%Y') for day in days)
+
+        # Summarise each day
+        af_to_prepare = []
+        for day in days:
+            mean = day.mean()
+            af_to_prepare.append(AudioFeatures(**{feature : round(mean[feature], 2) for feature in features_attributes}))
 
         # Prepare the data
         graph_data = AudioFeatures.prepare_data_for_linegraph(af_to_prepare)
-        
+
         # Join
         graph_data.insert(0, graph_headers)
 
         # Return the dataset
         return graph_data
 
-    
     @classmethod
     def analyse_songs_for_user(cls, songs, user, datasource_type):
         """
@@ -280,27 +716,37 @@ class Analysis(models.Model):
         # Get the audio features
         audio_features = [song.audio_features for song in songs]
 
-        # Create the analysis using the summarised audio feature
-        summarised_af = AudioFeatures.summarise(audio_features)
-        summarised_af.save()
-        
-        analysis = Analysis.create(songs, user, summarised_af, datasource_type)
-        analysis.save()
+        # Create the analysis using the summarised audio feature, the same songs share the same summary
+        summary = AudioFeaturesSummary.get_or_create(songs)
+        with transaction.atomic():
+            analysis = Analysis.create(songs, user, summary.audio_features, datasource_type)
+            UserFeatureStats.add_analysis(analysis, songs)
         
         # Return the analysis and the related audio features
         return analysis, audio_features
 
-    def history_dataset(self, songs):
+    def history_dataset(self, songs=None):
         """
         Give an analysis as a dataset for history presentation
+        Without songs, the names and the packed audio features of the songs are read with one query, no model instance is built
         """
         # Get the datas
-        #songs = self.songs.select_related('audio_features').all()
-        audio_features_of_songs = [song.audio_features for song in songs]
+        if songs == None:
+            songs = self.songs.filter(audio_features__isnull=False).order_by('pk')
+            rows = list(songs.values_list('name', 'audio_features__vector'))
+            song_names = [name for name, vector in rows]
+            vectors = [vector for name, vector in rows]
+            if None in vectors:
+                audio_features_of_songs = AudioFeatures.load_vectors(songs, 'audio_features__vector')
+            else:
+                audio_features_of_songs = AudioFeatures.unpack_vectors(vectors)
+        else:
+            song_names = [song.name for song in songs]
+            audio_features_of_songs = [song.audio_features for song in songs]
 
         # Create the first line of the header
         features_headers = ["Feature"]
-        features_headers.extend(song.name for song in songs)
+        features_headers.extend(song_names)
 
         # Prepare datas
         features_data = AudioFeatures.prepare_data_for_linegraph(audio_features_of_songs)
@@ -310,3 +756,206 @@ class Analysis(models.Model):
 
         # Return the dataset
         return features_data
+
+class UserFeatureStats(models.Model):
+    """
+    Running statistics of the songs analysed by a user during a day: their number, and the sum and the sum of the squares of each feature
+    They are updated by each analysis so the mean and the variance are read without walking the history
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    day = models.DateField()
+    count = models.PositiveIntegerField(default=0)
+    acousticness_sum = models.FloatField(default=0)
+    acousticness_sumsq = models.FloatField(default=0)
+    danceability_sum = models.FloatField(default=0)
+    danceability_sumsq = models.FloatField(default=0)
+    energy_sum = models.FloatField(default=0)
+    energy_sumsq = models.FloatField(default=0)
+    instrumentalness_sum = models.FloatField(default=0)
+    instrumentalness_sumsq = models.FloatField(default=0)
+    liveness_sum = models.FloatField(default=0)
+    liveness_sumsq = models.FloatField(default=0)
+    valence_sum = models.FloatField(default=0)
+    valence_sumsq = models.FloatField(default=0)
+    speechiness_sum = models.FloatField(default=0)
+    speechiness_sumsq = models.FloatField(default=0)
+    tempo_sum = models.FloatField(default=0)
+    tempo_sumsq = models.FloatField(default=0)
+
+    manager = models.Manager()
+
+    class Meta:
+        unique_together = ('user', 'day')
+
+    @classmethod
+    def add(cls, user, day, stats):
+        """
+        Adds songs to the statistics of a user's day, stats is the dictionary of their statistics (see AudioFeaturesStats.as_dict)
+        The row is updated by the DB so concurrent analyses don't lose each other's songs
+        """
+        count = stats['count']
+        increments = {'count': F('count') + count}
+        for feature in AudioFeatures.FEATURES:
+            mean = stats['mean'][feature]
+            std = stats['std'][feature]
+            increments[feature + '_sum'] = F(feature + '_sum') + count * mean
+            # the sum of the squares is n * (variance + mean^2)
+            increments[feature + '_sumsq'] = F(feature + '_sumsq') + count * (std * std + mean * mean)
+
+        with transaction.atomic():
+            row, created = cls.manager.get_or_create(user=user, day=day)
+            cls.manager.filter(pk=row.pk).update(**increments)
+
+    @classmethod
+    def add_analysis(cls, analysis, songs):
+        """
+        Adds the songs of an analysis to the statistics of its day
+        Like rebuild, each song is counted once and the songs without audio features are left out
+        """
+        songs = {song.pk: song for song in songs}.values()
+        audio_features = [song.audio_features for song in songs if song.audio_features != None]
+        if(len(audio_features) == 0):
+            return
+        cls.add(analysis.user, timezone.localdate(analysis.created), AudioFeatures.statistics(audio_features).as_dict())
+
+    @classmethod
+    def rebuild(cls, user=None):
+        """
+        Computes the statistics again from the songs of the analyses (of a user or of everyone)
+        IE after analyses were created with Analysis.create_many
+        The songs are the distinct ones linked to each analysis, those without audio features are left out
+        """
+        links = Analysis.songs.through.objects.all()
+        rows = cls.manager.all()
+        if(user != None):
+            links = links.filter(analysis__user=user)
+            rows = rows.filter(user=user)
+
+        sums = {}
+        for feature in AudioFeatures.FEATURES:
+            value = F('song__audio_features__' + feature)
+            sums[feature + '_sum'] = Sum(value)
+            sums[feature + '_sumsq'] = Sum(ExpressionWrapper(value * value, output_field=FloatField()))
+        days = links.filter(song__audio_features__isnull=False) \
+            .annotate(day=TruncDate('analysis__created')) \
+            .values('analysis__user', 'day') \
+            .annotate(count=Count('pk'), **sums) \
+            .order_by()
+
+        with transaction.atomic():
+            rows.delete()
+            stats = []
+            for day in days:
+                user_id = day.pop('analysis__user')
+                stats.append(cls(user_id=user_id, **day))
+            cls.manager.bulk_create(stats, batch_size=500)
+
+    def mean(self):
+        """
+        Returns the mean of each feature
+        """
+        return {feature : getattr(self, feature + '_sum') / self.count for feature in AudioFeatures.FEATURES}
+
+    def variance(self):
+        """
+        Returns the variance of each feature
+        """
+        mean = self.mean()
+        return {feature : max(getattr(self, feature + '_sumsq') / self.count - mean[feature] ** 2, 0) for feature in AudioFeatures.FEATURES}
+
+class AnalysisJob(models.Model):
+    """
+    An analysis requested by a user, it is run in the background by an AnalysisWorker (see jobs.py)
+    The progress is updated while the songs are fetched and the analysis and its recommendations are linked once done
+    """
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    # the error shown to the user, the exception itself is only logged
+    FAILED_MESSAGE = "The analysis failed, please retry later"
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    datasource_type = models.CharField(max_length=30)
+    datasource_id = models.CharField(max_length=100, blank=True)
+    datasource_name = models.CharField(max_length=255, blank=True)
+    status = models.CharField(max_length=10, default=PENDING)
+    pages_fetched = models.IntegerField(default=0)
+    songs_ingested = models.IntegerField(default=0)
+    analysis = models.ForeignKey(Analysis, null=True, on_delete=models.SET_NULL)
+    recommendations = models.ManyToManyField(Song, blank=True)
+    error = models.TextField(blank=True)
+    created = models.DateTimeField(default=timezone.now)
+    updated = models.DateTimeField(auto_now=True)
+
+    manager = models.Manager()
+
+    class Meta:
+        # the worker takes the oldest pending job
+        indexes = [models.Index(fields=['status', 'created'], name='analysisjob_status_idx')]
+
+    @classmethod
+    def create(cls, user, datasource_type, datasource_id, datasource_name):
+        job = cls(user=user, datasource_type=datasource_type, datasource_id=datasource_id or "", datasource_name=datasource_name or "")
+        job.save()
+        return job
+
+    @classmethod
+    def stale_limit(cls):
+        return timezone.now() - timedelta(seconds=settings.ANALYSIS_JOBS_STALE_AFTER)
+
+    @classmethod
+    def fail_stale(cls):
+        """
+        Fail the pending or running jobs without any progress for ANALYSIS_JOBS_STALE_AFTER seconds
+        (IE the ones of a thread lost by a restart) so they are not polled forever, return their number
+        """
+        return cls.manager.filter(status__in=[cls.PENDING, cls.RUNNING], updated__lt=cls.stale_limit()) \
+            .update(status=cls.FAILED, error=cls.FAILED_MESSAGE, updated=timezone.now())
+
+    def is_stale(self):
+        return self.status in (AnalysisJob.PENDING, AnalysisJob.RUNNING) and self.updated < AnalysisJob.stale_limit()
+
+    def claim(self):
+        """
+        Mark a pending job as running, return False if another worker already took it
+        """
+        claimed = AnalysisJob.manager.filter(pk=self.pk, status=AnalysisJob.PENDING).update(status=AnalysisJob.RUNNING, updated=timezone.now())
+        if claimed:
+            self.status = AnalysisJob.RUNNING
+        return claimed == 1
+
+    def add_progress(self, pages_fetched=0, songs_ingested=0):
+        """
+        Add the pages fetched and songs ingested to the job's progress
+        """
+        AnalysisJob.manager.filter(pk=self.pk).update(
+            pages_fetched=F('pages_fetched') + pages_fetched,
+            songs_ingested=F('songs_ingested') + songs_ingested,
+            updated=timezone.now(),
+        )
+
+    def finish(self, analysis, recommendations):
+        with transaction.atomic():
+            self.analysis = analysis
+            self.status = AnalysisJob.DONE
+            self.save(update_fields=['analysis', 'status', 'updated'])
+            self.recommendations.set(recommendations)
+
+    def fail(self, error):
+        self.status = AnalysisJob.FAILED
+        self.error = error
+        self.save(update_fields=['status', 'error', 'updated'])
+
+class HistoryEntry(namedtuple('HistoryEntry', ['analysis', 'summarised_audio_features', 'songs'])):
+    """
+    An analysis of the history with its summarised audio features and its songs (a tuple, with their audio features loaded)
+    """
+    __slots__ = ()
+
+    @classmethod
+    def create(cls, analysis):
+        return cls(analysis, analysis.summarised_audio_features, tuple(analysis.song_list))
+
+    def history_dataset(self):
+        return self.analysis.history_dataset(self.songs)
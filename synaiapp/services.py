@@ -1,9 +1,293 @@
 from django.conf import settings
+from django.core.cache import caches
+from django.db import connection, transaction, IntegrityError
+from django.db.models import F, Value, FloatField, ExpressionWrapper
 from urllib.parse import urlencode
 from social_django.utils import load_strategy
 from .models import Song, Artist, AudioFeatures, Album
+from .similarity import SongSimilarityIndex
+from .metrics import RequestTimings
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import hashlib
+import math
 import random
+import re
 import requests
+import threading
+import time
+
+# Logger & debug
+import logging
+logger = logging.getLogger(__name__)
+
+class SpotifySession:
+    """
+    This class holds the HTTP session shared by every SpotifyRequestManager of the process
+    The connections to the Spotify API are pooled and kept alive so a request doesn't pay a new TCP+TLS handshake
+    The pool sizes are set in the settings (SPOTIFY_POOL_CONNECTIONS, SPOTIFY_POOL_MAXSIZE, SPOTIFY_POOL_BLOCK)
+    """
+    _session = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def get_session(cls):
+        """
+        Returns the shared session, it is built the first time it is needed
+        """
+        if(cls._session == None):
+            with cls._lock:
+                if(cls._session == None):
+                    cls._session = cls.build_session()
+        return cls._session
+
+    @classmethod
+    def build_session(cls):
+        """
+        Builds a session whose adapter keeps up to SPOTIFY_POOL_MAXSIZE connections alive per host
+        """
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=settings.SPOTIFY_POOL_CONNECTIONS,
+            pool_maxsize=settings.SPOTIFY_POOL_MAXSIZE,
+            pool_block=settings.SPOTIFY_POOL_BLOCK,
+        )
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.headers['Connection'] = 'keep-alive'
+        return session
+
+    @classmethod
+    def close(cls):
+        """
+        Closes the shared session and its pooled connections, the next call to get_session will build a new one
+        """
+        with cls._lock:
+            if(cls._session != None):
+                cls._session.close()
+            cls._session = None
+
+    @classmethod
+    def pool_stats(cls):
+        """
+        Returns the pool counters of the shared session
+        A miss is a request that had to open a new connection, a hit is a request that reused a kept-alive one
+        """
+        stats = {'hits': 0, 'misses': 0, 'hosts': 0}
+        if(cls._session == None):
+            return stats
+
+        for adapter in set(cls._session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if(pool == None):
+                    continue
+                stats['hosts'] += 1
+                stats['misses'] += pool.num_connections
+                stats['hits'] += max(pool.num_requests - pool.num_connections, 0)
+        return stats
+
+class SpotifyAPIError(Exception):
+    """
+    Raised when the API answers with an error status
+    retry_after is the number of seconds to wait before asking again when the API throttles us (429, 503)
+    """
+    def __init__(self, message, status_code=None, retry_after=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+class SpotifyRequestScheduler:
+    """
+    This class schedules the requests sent to the API by every worker of the process
+    A token bucket limits the rate of the requests (SPOTIFY_RATE_LIMIT per second, bursts of SPOTIFY_RATE_BURST)
+    When the API answers 429 or 503 every worker waits for the "Retry-After" delay (or an exponential backoff),
+    plus some jitter, and the request is retried up to SPOTIFY_MAX_RETRIES times
+    A request doesn't wait more than SPOTIFY_MAX_RETRY_WAIT seconds in total for its retries, so a web request isn't killed by its timeout
+    """
+    _scheduler = None
+    _lock = threading.Lock()
+
+    def __init__(self, rate, burst, max_retries, backoff, max_delay, max_wait=None):
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.max_wait = max_wait
+
+        self.lock = threading.Lock()
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.throttled_until = 0
+        self.metrics = {
+            'requests': 0,
+            'retries': 0,
+            'throttled': 0,
+            'throttled_seconds': 0.0,
+            'waiting_seconds': 0.0,
+        }
+
+    @classmethod
+    def get_scheduler(cls):
+        """
+        Returns the scheduler shared by the process, it is built from the settings the first time it is needed
+        """
+        if(cls._scheduler == None):
+            with cls._lock:
+                if(cls._scheduler == None):
+                    cls._scheduler = cls(
+                        settings.SPOTIFY_RATE_LIMIT,
+                        settings.SPOTIFY_RATE_BURST,
+                        settings.SPOTIFY_MAX_RETRIES,
+                        settings.SPOTIFY_RETRY_BACKOFF,
+                        settings.SPOTIFY_MAX_RETRY_DELAY,
+                        settings.SPOTIFY_MAX_RETRY_WAIT,
+                    )
+        return cls._scheduler
+
+    @classmethod
+    def reset(cls):
+        """
+        Drops the shared scheduler, the next call to get_scheduler will build a new one
+        """
+        with cls._lock:
+            cls._scheduler = None
+
+    def acquire(self):
+        """
+        Blocks until a token is available and the API is not throttling us anymore
+        """
+        while(True):
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                wait = self.throttled_until - now
+                if(wait <= 0):
+                    if(self.tokens >= 1):
+                        self.tokens -= 1
+                        self.metrics['requests'] += 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+                self.metrics['waiting_seconds'] += wait
+            time.sleep(wait)
+
+    def throttle(self, delay):
+        """
+        Makes every worker wait for delay seconds before sending its next request
+        """
+        with self.lock:
+            self.throttled_until = max(self.throttled_until, time.monotonic() + delay)
+            self.metrics['throttled'] += 1
+            self.metrics['throttled_seconds'] += delay
+
+    def is_throttled(self):
+        """
+        Checks if the API asked us to wait
+        """
+        return time.monotonic() < self.throttled_until
+
+    def retry_after(self, response):
+        """
+        Returns the number of seconds to wait before asking again after a throttled response (at least 1)
+        The "Retry-After" header is used if given, else the time the workers still have to wait
+        """
+        try:
+            delay = float(response.headers['Retry-After'])
+        except (KeyError, ValueError):
+            delay = self.throttled_until - time.monotonic()
+        return max(1, math.ceil(delay))
+
+    def retry_delay(self, response, attempt):
+        """
+        Returns the number of seconds to wait before retrying a request, the "Retry-After" header is used if given
+        """
+        try:
+            delay = float(response.headers['Retry-After'])
+        except (KeyError, ValueError):
+            delay = self.backoff * 2 ** attempt
+        # the jitter prevents all the workers from retrying at the same time
+        return delay + random.uniform(0, self.backoff)
+
+    def execute(self, send):
+        """
+        Sends a request with the send callable when allowed to and retries it while the API throttles us
+        The last response is returned if the retries are exhausted or if the API asks us to wait too long
+        """
+        attempt = 0
+        waited = 0
+        while(True):
+            self.acquire()
+            response = send()
+            if(response.status_code not in (429, 503) or attempt >= self.max_retries):
+                return response
+
+            delay = self.retry_delay(response, attempt)
+            if(delay > self.max_delay or (self.max_wait != None and waited + delay > self.max_wait)):
+                self.throttle(delay)
+                return response
+
+            self.throttle(delay)
+            with self.lock:
+                self.metrics['retries'] += 1
+            waited += delay
+            attempt += 1
+
+    def stats(self):
+        """
+        Returns a copy of the scheduler's metrics
+        """
+        with self.lock:
+            return dict(self.metrics)
+
+class SpotifyResponseCache:
+    """
+    This class caches the API responses of catalogue lookups (albums, artists, search, ...) in a Django cache
+    The key is built from the query path and parameters, without the access token so every user shares the entries
+    The time to live of an entry depends on the endpoint (SPOTIFY_CACHE_TTLS), endpoints without TTL are never cached
+    The backend (SPOTIFY_CACHE_ALIAS in CACHES) handles the eviction and the size of the cache
+    """
+    _counters_lock = threading.Lock()
+    counters = {'hits': 0, 'misses': 0}
+
+    @classmethod
+    def get_ttl(cls, query_path):
+        """
+        Returns the time to live in seconds of the responses of an endpoint, the first matching pattern is used
+        """
+        for pattern, ttl in settings.SPOTIFY_CACHE_TTLS:
+            if(re.match(pattern, query_path)):
+                return ttl
+        return 0
+
+    @classmethod
+    def get_key(cls, query_path, query_dict=None):
+        """
+        Builds the key of a query, the parameters are sorted so their order doesn't matter
+        """
+        query = query_path + '?' + urlencode(sorted((query_dict or {}).items()))
+        return 'spotify:' + hashlib.sha1(query.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def get(cls, query_path, query_dict=None):
+        """
+        Returns the cached response of a query or None
+        """
+        response = caches[settings.SPOTIFY_CACHE_ALIAS].get(cls.get_key(query_path, query_dict))
+        with cls._counters_lock:
+            cls.counters['hits' if response != None else 'misses'] += 1
+        return response
+
+    @classmethod
+    def set(cls, query_path, query_dict, response, ttl):
+        """
+        Caches the JSON response of a query for ttl seconds
+        """
+        caches[settings.SPOTIFY_CACHE_ALIAS].set(cls.get_key(query_path, query_dict), response, ttl)
 
 class SpotifyRequestManager:
     """
@@ -15,9 +299,17 @@ class SpotifyRequestManager:
     """
     This is a helper dictionary that builds the API path of the different resources 
     """
-    def __init__(self, social):
+    # concurrent requests of the same user refresh the token only once, the users share a fixed pool of locks
+    REFRESH_LOCKS = 64
+    _refresh_locks = [threading.Lock() for i in range(REFRESH_LOCKS)]
+
+    def __init__(self, social, progress=None):
         self.social = social
-        self.refresh_access_token()
+        # optional callable receiving the number of pages fetched and songs ingested as they go (IE by an AnalysisJob)
+        self.progress = progress
+        # the timings of the request using the manager, the calls made by its threads are recorded into them as well
+        self.timings = RequestTimings.current()
+        self.ensure_access_token()
         
         self.p_builder = {
             "album" : lambda album_id : "albums/" + album_id,
@@ -39,10 +331,38 @@ class SpotifyRequestManager:
         # it builds the list of items using the JSON and methods in the class
         self.search_builder = {
             "tracks" : lambda r_data : self.get_songs([json['id'] for json in r_data['items']]),
-            "albums" : lambda r_data : [self.get_album(json['id']) for json in r_data['items']],
+            "albums" : lambda r_data : self.get_albums(r_data['items']),
             "artists" : lambda r_data : self.get_artists([json['id'] for json in r_data['items']], r_data['items']),
         }
 
+    # the p_builder key of the paths, for the metrics
+    ENDPOINT_KEYS = [
+        (r'^albums/[^/]+/tracks', 'album_tracks'),
+        (r'^albums/', 'album'),
+        (r'^tracks/', 'track'),
+        (r'^tracks\?', 'tracks'),
+        (r'^audio-features/', 'audio-features'),
+        (r'^audio-features\?', 'audio-features-multiple'),
+        (r'^artists/[^/]+/top-tracks', 'artist_top'),
+        (r'^artists/', 'artist'),
+        (r'^artists\?', 'artists'),
+        (r'^playlists/', 'playlist'),
+        (r'^search\?', 'search'),
+        (r'^recommendations\?', 'recommendations'),
+        (r'^users/[^/]+/playlists', 'user_playlists'),
+        (r'^me/player/recently-played', 'current_user_history'),
+    ]
+
+    @classmethod
+    def get_endpoint_key(cls, query_path):
+        """
+        Returns the p_builder key of a query path, "other" if it doesn't match any
+        """
+        for pattern, key in cls.ENDPOINT_KEYS:
+            if(re.match(pattern, query_path)):
+                return key
+        return "other"
+
     def refresh_access_token(self):
         """
         A simple function that refreshes the Spotify access token provided to the object using social_django
@@ -50,32 +370,93 @@ class SpotifyRequestManager:
         strategy = load_strategy()
         self.social.refresh_token(strategy)
 
+    def report_progress(self, pages_fetched=0, songs_ingested=0):
+        """
+        Gives the progress of the current fetch to the progress callable if there is one
+        """
+        if(self.progress != None):
+            self.progress(pages_fetched, songs_ingested)
+
+    @classmethod
+    def get_refresh_lock(cls, social):
+        """
+        Returns the lock used to refresh the token of the user owning the social auth
+        A few users share each lock so the pool doesn't grow with the number of users
+        """
+        return cls._refresh_locks[social.pk % cls.REFRESH_LOCKS]
+
+    def access_token_expired(self):
+        """
+        Checks if the access token stored in the social auth extra_data expires in less than SPOTIFY_TOKEN_REFRESH_MARGIN seconds
+        A token without any expiration info is considered expired
+        """
+        expiration = self.social.expiration_timedelta()
+        return expiration == None or expiration.total_seconds() <= settings.SPOTIFY_TOKEN_REFRESH_MARGIN
+
+    def ensure_access_token(self, force=False):
+        """
+        Refreshes the access token only if it is about to expire (or if force is set)
+        The refresh is done under a per-user lock, a request that waited for it reloads the token refreshed by the other one
+        """
+        if(not force and not self.access_token_expired()):
+            return
+
+        stale_token = self.social.extra_data.get('access_token')
+        with self.get_refresh_lock(self.social):
+            # another request may have refreshed the token while we were waiting for the lock
+            if(self.social.pk != None):
+                self.social.refresh_from_db()
+            refreshed = self.social.extra_data.get('access_token') != stale_token
+            if(not refreshed and (force or self.access_token_expired())):
+                self.refresh_access_token()
+
     def query_executor(self, query_path, query_dict=None):
         """
         This method executes a query given the adress's path (IE .../album/)
         The query_dict is the list of parameters that can be added and encoded in the query
         It returns the response's text in a JSON encoded form
         """
-        query = settings.SPOTIFY_BASE_URL + query_path
+        # catalogue data rarely changes, it may already be in the cache
+        ttl = SpotifyResponseCache.get_ttl(query_path)
+        if(ttl > 0):
+            cached_response = SpotifyResponseCache.get(query_path, query_dict)
+            if(cached_response != None):
+                return cached_response
 
+        query = settings.SPOTIFY_BASE_URL + query_path
 
         if(query_dict != None):
             query += '?' if query[-1:] != '?' else ''
             query += urlencode(query_dict)
 
-        if(settings.DEBUG):
-            print("Querying " + query)
-
-        response = requests.get(query, params={'access_token' : self.social.extra_data['access_token']})
-        
-        if(response.status_code == 503):
-            raise Exception("Spotify API is temporarily unavailable. Please retry in a few minutes")
-        if(response.status_code == 429):
-            raise Exception("Spotify API rate limit reached. Check the \"Retry-After\" header to check how many seconds you have to wait.")
+        logger.debug("Querying %s", query)
+
+        session = SpotifySession.get_session()
+        scheduler = SpotifyRequestScheduler.get_scheduler()
+        send = lambda: session.get(query, params={'access_token' : self.social.extra_data['access_token']}, timeout=settings.SPOTIFY_TIMEOUT)
+        start = time.perf_counter()
+        response = scheduler.execute(send)
+
+        # the token may have been revoked or expired earlier than announced, we refresh it and retry once
+        if(response.status_code == 401):
+            self.ensure_access_token(force=True)
+            response = scheduler.execute(send)
+        RequestTimings.record_spotify(self.timings, self.get_endpoint_key(query_path), time.perf_counter() - start)
+
+        if(response.status_code in (429, 503)):
+            retry_after = scheduler.retry_after(response)
+            if(response.status_code == 503):
+                raise SpotifyAPIError("Spotify API is temporarily unavailable. Please retry in a few minutes", 503, retry_after)
+            raise SpotifyAPIError("Spotify API rate limit reached. Check the \"Retry-After\" header to check how many seconds you have to wait.", 429, retry_after)
         if(response.status_code != 200):
-            raise Exception(f"Something went wrong...\nError: {response.status_code}\nMessage: {response.text}")
-        
-        return response.json()
+            raise SpotifyAPIError(f"Something went wrong...\nError: {response.status_code}\nMessage: {response.text}", response.status_code)
+
+        json_response = response.json()
+        # huge responses would evict too many entries
+        if(ttl > 0 and len(response.content) <= settings.SPOTIFY_CACHE_MAX_ITEM_SIZE):
+            SpotifyResponseCache.set(query_path, query_dict, json_response, ttl)
+
+        return json_response
 
     def get_songs(self, spotify_ids, album=None, songs_payload=None):
         """
@@ -86,31 +467,71 @@ class SpotifyRequestManager:
 
         spotify_ids = [id.split(':')[-1] for id in spotify_ids]
 
-        songs = list(Song.objects.filter(spotify_id__in=spotify_ids))
+        # the missing ids are remembered by the id cache so the ingestion doesn't look them up again
+        songs = list(Song.get_by_spotify_ids(spotify_ids).values())
 
         missing_ids = list(set(spotify_ids) - set([song.spotify_id for song in songs]))
         # if we have missing ids we query the API
         if(len(missing_ids) != 0):
             # we subdivide the missing ids list into chunks because the API can give up to 50 tracks at the same time
             sub_lists = [missing_ids[id:id+settings.MAX_REQ_IDS] for id in range(0, len(missing_ids), settings.MAX_REQ_IDS)]
+
+            # for each chunk we request the tracks and their audio features, we can use the same query dict for both
+            queries = []
             for sub_list_ids in sub_lists:
                 query_dict = {
                     'ids': ','.join(sub_list_ids)
                 }
-                response = self.query_executor(self.p_builder['tracks'], query_dict)
+                queries.append((self.p_builder['tracks'], query_dict))
+                queries.append((self.p_builder['audio-features-multiple'], query_dict))
+
+            responses = self.execute_queries(queries)
 
-                # request the audio features for every song we got, we can use the same query dict for the songs ids as well
-                audio_features_response = self.query_executor(self.p_builder['audio-features-multiple'], query_dict)
+            for response, audio_features_response in zip(responses[::2], responses[1::2]):
+                # the audio features are joined to their track by id, tracks without audio features can't be analysed
+                json_features = {json['id'] : json for json in audio_features_response['audio_features'] if json != None}
+                json_tracks = [json for json in response['tracks'] if json != None and json['id'] in json_features]
 
-                # builds each track for each json slice in the api response
-                missing_songs = [self.song_factory(json_track, json_features) for 
-                    json_track, json_features in zip(response['tracks'], audio_features_response['audio_features'])
-                ]
+                # builds every track of the chunk at once with its json slice in the api response
+                missing_songs = self.songs_bulk_factory(json_tracks, [json_features[json['id']] for json in json_tracks])
 
                 songs.extend(missing_songs)
 
+        self.report_progress(songs_ingested=len(songs))
         return songs
 
+    @classmethod
+    def is_throttled(cls):
+        """
+        Checks if the API recently answered with a rate limit error
+        """
+        return SpotifyRequestScheduler.get_scheduler().is_throttled()
+
+    def execute_queries(self, queries):
+        """
+        This method executes a list of queries (query_path, query_dict) and returns their responses in the same order
+        They are sent concurrently, SPOTIFY_MAX_CONCURRENCY at a time, unless the API is throttling us
+        """
+        if(len(queries) < 2 or settings.SPOTIFY_MAX_CONCURRENCY < 2 or self.is_throttled()):
+            return [self.query_executor(query_path, query_dict) for query_path, query_dict in queries]
+
+        with ThreadPoolExecutor(max_workers=settings.SPOTIFY_MAX_CONCURRENCY) as executor:
+            futures = [executor.submit(self.timed_query_executor, query_path, query_dict) for query_path, query_dict in queries]
+            return [future.result() for future in futures]
+
+    def timed_query_executor(self, query_path, query_dict):
+        """
+        query_executor for the threads of execute_queries and get_pages, their DB queries (IE a token refresh) are recorded in the timings of the request too
+        """
+        try:
+            if(self.timings == None):
+                return self.query_executor(query_path, query_dict)
+            with connection.execute_wrapper(self.timings.record_query):
+                return self.query_executor(query_path, query_dict)
+        finally:
+            # each thread has its own DB connection and the pool threads end with the request
+            connection.close()
+
     def get_audio_features(self, song_id):
         """
         This method should be called as you request a song to the API
@@ -134,16 +555,25 @@ class SpotifyRequestManager:
             album = self.album_factory(request_payload)
         return album
 
+    def get_albums(self, albums_payload):
+        """
+        This method returns the albums of a list of JSON payloads (IE the ones of a search) in the same order
+        The missing ones are built from their payload and bulk inserted, with a constant number of queries
+        """
+        albums = self.bulk_get_or_create_objects(Album, {album_dict['id'] : album_dict for album_dict in albums_payload})
+        return [albums[album_dict['id']] for album_dict in albums_payload]
+
     def get_album_tracks(self, album_id):
         """
         This method should be called as you request a song to the API
-        It requests the album tracks 
+        It requests the album tracks page by page
         The audio features object will then be built and returned
         Given the spotify unique ID (song_id)
         """
-        response = self.query_executor(self.p_builder['album_tracks'](album_id))
-        album = Album.get_album(album_id)
-        return self.get_songs([json_track['id'] for json_track in response['items']])
+        songs = []
+        for items in self.get_pages(self.p_builder['album_tracks'](album_id)):
+            songs.extend(self.get_songs([json_track['id'] for json_track in items]))
+        return songs
 
     def get_artists(self, artist_ids, request_payload = None):
         """
@@ -151,19 +581,19 @@ class SpotifyRequestManager:
         If they don't they are queried to the API
         The request_payload can be used to provide a previous request result that contains the data we need
         """
-        artists = []
-        
-        if(request_payload == None):
-            query_dict = {}
-            query_dict['ids'] = ','.join(artist_ids)
-            request_payload = self.query_executor(self.p_builder['artists'], query_dict)['artists']
-
-        for id, artist_payload in zip(artist_ids, request_payload):
-            artist = Artist.get_artist(id)
-            if(artist == None):
-                artist = self.artists_factory(id, artist_payload)
-            artists.append(artist)
-        return artists
+        artists = Artist.get_by_spotify_ids(artist_ids)
+        missing_ids = [id for id in artist_ids if id not in artists]
+
+        if(len(missing_ids) != 0):
+            if(request_payload == None):
+                query_dict = {}
+                query_dict['ids'] = ','.join(missing_ids)
+                request_payload = self.query_executor(self.p_builder['artists'], query_dict)['artists']
+
+            artists_payload = {artist_payload['id'] : artist_payload for artist_payload in request_payload}
+            artists.update(self.bulk_get_or_create_objects(Artist, {id : artists_payload[id] for id in missing_ids}))
+
+        return [artists[id] for id in artist_ids]
     
     def get_artist_top_songs(self, artist_id):
         """
@@ -181,13 +611,56 @@ class SpotifyRequestManager:
         return self.get_songs([json_track['id'] for json_track in response['tracks']])
 
 
+    def get_pages(self, query_path, query_dict=None, limit=50):
+        """
+        This generator yields the items of a paginated resource (IE the tracks of a playlist) page by page
+        The first page gives the total number of items, the next ones are then requested concurrently
+        with at most SPOTIFY_MAX_CONCURRENCY pages in flight, and yielded in order as soon as they are received
+        """
+        query_dict = dict(query_dict or {}, limit=limit, offset=0)
+        page = self.query_executor(query_path, query_dict)
+        self.report_progress(pages_fetched=1)
+        yield page['items']
+
+        if(page.get('total') == None):
+            # without the total we can only follow the next links one by one
+            while(page.get('next') != None):
+                query_dict['offset'] += limit
+                page = self.query_executor(query_path, query_dict)
+                self.report_progress(pages_fetched=1)
+                yield page['items']
+            return
+
+        offsets = iter(range(limit, page['total'], limit))
+        with ThreadPoolExecutor(max_workers=settings.SPOTIFY_MAX_CONCURRENCY) as executor:
+            in_flight = deque()
+            for offset in offsets:
+                in_flight.append(executor.submit(self.timed_query_executor, query_path, dict(query_dict, offset=offset)))
+                if(len(in_flight) == settings.SPOTIFY_MAX_CONCURRENCY):
+                    break
+
+            while(len(in_flight) != 0):
+                items = in_flight.popleft().result()['items']
+                # keep the pool busy while the caller handles this page
+                offset = next(offsets, None)
+                if(offset != None):
+                    in_flight.append(executor.submit(self.timed_query_executor, query_path, dict(query_dict, offset=offset)))
+                self.report_progress(pages_fetched=1)
+                yield items
+
     def get_playlist(self, playlist_id):
         """
         Get the songs of a playlist using the playlist id.
+        The playlist is read page by page and each page is given to get_songs as soon as it is received
         Builds and saves in the DB the artists and songs
         """
-        response = self.query_executor(self.p_builder['playlist'](playlist_id))
-        return self.get_songs([json_track['track']['id'] for json_track in response['items']])
+        # we only need the ids of the tracks
+        query_dict = {'fields': 'items(track(id)),total,next'}
+        songs = []
+        for items in self.get_pages(self.p_builder['playlist'](playlist_id), query_dict, settings.SPOTIFY_PLAYLIST_PAGE_SIZE):
+            # removed tracks don't have any track object anymore
+            songs.extend(self.get_songs([json_track['track']['id'] for json_track in items if json_track['track'] != None]))
+        return songs
 
 
     @classmethod
@@ -204,24 +677,40 @@ class SpotifyRequestManager:
         }
 
 
-    def get_user_playlists(self, user_id, limit=20):
+    def get_user_playlists(self, user_id, limit=50):
         """
-        Get the user's playlist using its uid.
+        Get all the user's playlists using its uid, they are requested by pages of limit (50 max) playlists.
         This method return a list of dictionnary of playlist
         """
-        query_dict = {
-            'limit': 50
-        }
-        response = self.query_executor(self.p_builder['user_playlists'](user_id), query_dict)
-        return [SpotifyRequestManager.get_playlist_json_as_dict(json_playlist) for json_playlist in response['items']]
+        return [SpotifyRequestManager.get_playlist_json_as_dict(json_playlist)
+            for items in self.get_pages(self.p_builder['user_playlists'](user_id), limit=limit)
+            for json_playlist in items
+        ]
 
     def get_recommendations(self, analysis, limit=10):
         """
         This method returns songs (10 by default) recommended by the API given some parameters
         It uses the analysed features and songs as seed to get them
+        If RECOMMENDATIONS_SOURCE is "local", they are the songs of the DB closest to the analysed features instead
+        If it is "box", they are the songs of the DB within the bounds of the analysed features closest to them,
+        the API is only requested if there aren't enough
         """
         songs = analysis.songs.all()
         audio_features = analysis.summarised_audio_features
+        if(settings.RECOMMENDATIONS_SOURCE == "local"):
+            exclude = [song.pk for song in songs]
+            return SongSimilarityIndex.get_index().nearest_songs(audio_features, limit, exclude)
+
+        bounds = self.get_features_bounds(audio_features)
+        if(settings.RECOMMENDATIONS_SOURCE == "box"):
+            # the squared distance to the analysed features, on the bounded features
+            distance = sum(((F('audio_features__' + feature) - getattr(audio_features, feature)) * (F('audio_features__' + feature) - getattr(audio_features, feature))
+                for feature in bounds), Value(0.0))
+            recommendations = list(Song.in_feature_box(bounds).exclude(analysis=analysis).select_related('audio_features')
+                .annotate(distance=ExpressionWrapper(distance, output_field=FloatField())).order_by('distance', 'pk')[:limit])
+            if(len(recommendations) >= limit):
+                return recommendations
+
         query_dict = {}
         #cant use generator unfortunately for memory it would be better
         sample_size = settings.MAX_SEED_OBJECTS if len(songs) >= settings.MAX_SEED_OBJECTS else len(songs)
@@ -231,16 +720,12 @@ class SpotifyRequestManager:
 
         query_dict['seed_tracks'] = ','.join(track_seeds)
 
-        # then for each feature we analyse, we use it to create bounds for the recommendations to be more "precise"
+        # then for each feature we analyse, we use its bounds for the recommendations to be more "precise"
         # currently the recommendations seem pretty dumb but Spotify probably has some black magic wizardry and uses the user's history to make them better
         # and it's quite surprisingly working well
-        for attr in audio_features.features_headers()[:-1]:
-            attr_lower = attr.lower()
-            val = getattr(audio_features, attr_lower)
-            val_min = val - settings.FEATURES_DELTA
-            val_max = val + settings.FEATURES_DELTA
-            query_dict['min_' + attr_lower] = 0 if val_min < 0 else val_min
-            query_dict['max_' + attr_lower] = 1 if val_max > 1 else val_max 
+        for feature, (val_min, val_max) in bounds.items():
+            query_dict['min_' + feature] = val_min
+            query_dict['max_' + feature] = val_max
 
         query_dict['limit'] = limit
 
@@ -248,6 +733,20 @@ class SpotifyRequestManager:
         songs = self.get_songs((track['id'] for track in recommended_tracks['tracks']))
         return songs
 
+    def get_features_bounds(self, audio_features):
+        """
+        This method returns the (min, max) bounds of the recommendations by feature, FEATURES_DELTA around the analysed features
+        The tempo isn't bounded
+        """
+        bounds = {}
+        for attr in audio_features.features_headers()[:-1]:
+            attr_lower = attr.lower()
+            val = getattr(audio_features, attr_lower)
+            val_min = val - settings.FEATURES_DELTA
+            val_max = val + settings.FEATURES_DELTA
+            bounds[attr_lower] = (0 if val_min < 0 else val_min, 1 if val_max > 1 else val_max)
+        return bounds
+
     def get_current_user_history(self):
         """
         Get the 20 recently played songs of the current user
@@ -298,12 +797,100 @@ class SpotifyRequestManager:
 
         return song
     
+    def songs_bulk_factory(self, json_tracks, json_features):
+        """
+        This method builds and saves the songs of a chunk (IE 50 tracks) with a constant number of queries
+        The artists and albums of all the tracks are resolved with at most one query each and the missing ones are bulk inserted
+        The audio features, the songs and the links between songs and artists are bulk inserted as well
+        If another request inserted some of the same rows meanwhile, the chunk is rolled back and tried again
+        so the rows it inserted are reused (SPOTIFY_UPSERT_ATTEMPTS times at most)
+        """
+        for attempt in range(settings.SPOTIFY_UPSERT_ATTEMPTS):
+            try:
+                with transaction.atomic():
+                    return self.insert_songs(json_tracks, json_features)
+            except IntegrityError:
+                # the ids cached during the attempt may be wrong now
+                Song.forget_ids([json_track['id'] for json_track in json_tracks])
+                Artist.forget_ids([json_artist['id'] for json_track in json_tracks for json_artist in json_track['artists']])
+                Album.forget_ids([json_track['album']['id'] for json_track in json_tracks])
+                if(attempt + 1 >= settings.SPOTIFY_UPSERT_ATTEMPTS):
+                    raise
+
+    def insert_songs(self, json_tracks, json_features):
+        """
+        This method inserts the songs of a chunk that are not in the DB yet and returns all of them
+        It must be called in a transaction
+        """
+        songs = Song.get_by_spotify_ids([json_track['id'] for json_track in json_tracks])
+        missing = [(json_track, json) for json_track, json in zip(json_tracks, json_features) if json_track['id'] not in songs]
+
+        if(len(missing) != 0):
+            artists_dict = {json_artist['id'] : json_artist for json_track, json in missing for json_artist in json_track['artists']}
+            albums_dict = {json_track['album']['id'] : json_track['album'] for json_track, json in missing}
+
+            artists = self.bulk_get_or_create(Artist, artists_dict)
+            albums = self.bulk_get_or_create(Album, albums_dict)
+
+            audio_features = AudioFeatures.bulk_save([AudioFeatures.create(json) for json_track, json in missing])
+
+            missing_songs = [Song(spotify_id=json_track['id'], name=json_track['name'], audio_features=af, album_id=albums[json_track['album']['id']])
+                for (json_track, json), af in zip(missing, audio_features)]
+            Song.forget_ids([song.spotify_id for song in missing_songs])
+            Song.objects.bulk_create(missing_songs)
+            # reload the songs to get their primary keys
+            songs.update(Song.get_by_spotify_ids([song.spotify_id for song in missing_songs]))
+            for song in missing_songs:
+                song.pk = songs[song.spotify_id].pk
+            SongSimilarityIndex.add_songs_on_commit(missing_songs)
+
+            # a set because an artist can be listed twice on a track
+            song_artists = {(songs[json_track['id']].pk, artists[json_artist['id']])
+                for json_track, json in missing for json_artist in json_track['artists']}
+            Song.artists.through.objects.bulk_create([Song.artists.through(song_id=song_id, artist_id=artist_id)
+                for song_id, artist_id in song_artists])
+
+        return [songs[json_track['id']] for json_track in json_tracks]
+
+    def bulk_get_or_create(self, model, payloads):
+        """
+        This method resolves the artists or albums (model) whose spotify id is a key of payloads with at most one query
+        The missing ones are built from their JSON payload and bulk inserted
+        It returns a dictionary of their primary keys by spotify id
+        """
+        pks = model.resolve_ids(payloads)
+        missing = [model.create(spotify_id, payload['name']) for spotify_id, payload in payloads.items() if spotify_id not in pks]
+        if(len(missing) != 0):
+            missing_ids = [obj.spotify_id for obj in missing]
+            model.forget_ids(missing_ids)
+            model.objects.bulk_create(missing)
+            pks.update(model.resolve_ids(missing_ids))
+        return pks
+
+    def bulk_get_or_create_objects(self, model, payloads):
+        """
+        This method returns a dictionary of the artists or albums (model) by spotify id, with a constant number of queries
+        The missing ones are built from their JSON payload and bulk inserted
+        If another request inserted some of them meanwhile, they are resolved again (SPOTIFY_UPSERT_ATTEMPTS times at most)
+        """
+        for attempt in range(settings.SPOTIFY_UPSERT_ATTEMPTS):
+            try:
+                with transaction.atomic():
+                    pks = self.bulk_get_or_create(model, payloads)
+                break
+            except IntegrityError:
+                model.forget_ids(list(payloads))
+                if(attempt + 1 >= settings.SPOTIFY_UPSERT_ATTEMPTS):
+                    raise
+        objects = model.objects.in_bulk(list(pks.values()))
+        return {spotify_id : objects[pk] for spotify_id, pk in pks.items()}
+
     def album_factory(self, album_dict):
         """
         This method build an album and saves it into the DB given a JSON Spotify API response
         """
-        album = Album.create(album_dict['id'], album_dict['name'])
-        album.save()
+        # get_or_create handles another request inserting the same album meanwhile
+        album, created = Album.objects.get_or_create(spotify_id=album_dict['id'], defaults={'name': album_dict['name']})
         return album
 
     def artists_factory(self, artist_id, artists_dict=None):
@@ -313,9 +900,7 @@ class SpotifyRequestManager:
         If they are not in the DB, they will saved into it
         It does not need to request further informations to the API 
         """
-        artist = None
-        artist = Artist.create(artists_dict['id'], artists_dict['name'])
-        artist.save()
+        artist, created = Artist.objects.get_or_create(spotify_id=artists_dict['id'], defaults={'name': artists_dict['name']})
         return artist
 
     def audio_features_factory(self, api_response):
@@ -0,0 +1,138 @@
+from django.db import transaction
+from .models import AudioFeatures, Song
+import numpy as np
+import threading
+
+class SongSimilarityIndex:
+    """
+    Nearest neighbours of the songs by their audio features, without any request to Spotify
+    The normalised features of the songs (see AudioFeatures.as_array) are kept in a float32 matrix
+    and a query computes the distance to all of them at once with a matrix product, which takes a few milliseconds for 1M songs
+    The index is loaded from the DB the first time it is used, then the songs are added when they are ingested
+    and the ones inserted by other processes are loaded before each query
+    """
+    _index = None
+    _lock = threading.Lock()
+
+    # the tempo is scaled down like in AudioFeatures.as_array
+    SCALE = np.array([100 if feature == 'tempo' else 1 for feature in AudioFeatures.FEATURES], dtype=np.float32)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.size = 0
+        self.song_ids = np.empty(0, dtype=np.int64)
+        self.vectors = np.empty((0, len(AudioFeatures.FEATURES)), dtype=np.float32)
+        # the squared norms of the vectors
+        self.norms = np.empty(0, dtype=np.float32)
+        # the highest song primary key loaded from the DB
+        self.last_id = 0
+
+    @classmethod
+    def get_index(cls):
+        """
+        Returns the index shared by the process, it is loaded the first time it is needed
+        """
+        if(cls._index == None):
+            with cls._lock:
+                if(cls._index == None):
+                    index = cls()
+                    index.refresh()
+                    cls._index = index
+        return cls._index
+
+    @classmethod
+    def reset(cls):
+        with cls._lock:
+            cls._index = None
+
+    @classmethod
+    def normalise(cls, matrix):
+        return np.asarray(matrix, dtype=np.float32) / cls.SCALE
+
+    @classmethod
+    def add_songs_on_commit(cls, songs):
+        """
+        Adds the songs to the index once the transaction inserting them is committed
+        Nothing is done if the index isn't loaded yet, it will load them with the rest
+        """
+        index = cls._index
+        if(index == None or len(songs) == 0):
+            return
+        song_ids = [song.pk for song in songs]
+        matrix = AudioFeatures.features_matrix([song.audio_features for song in songs])
+        transaction.on_commit(lambda: index.add(song_ids, matrix))
+
+    def refresh(self):
+        """
+        Loads the songs inserted since the last refresh
+        """
+        songs = Song.objects.filter(pk__gt=self.last_id, audio_features__isnull=False).order_by('pk')
+        # the packed vectors are read without building the audio features
+        rows = list(songs.values_list('pk', 'audio_features__vector'))
+        if(len(rows) == 0):
+            return
+        song_ids = [pk for pk, vector in rows]
+        vectors = [vector for pk, vector in rows]
+        if(None in vectors):
+            matrix = AudioFeatures.load_vectors(songs.filter(pk__lte=song_ids[-1]), 'audio_features__vector')
+        else:
+            matrix = AudioFeatures.unpack_vectors(vectors)
+        self.add(song_ids, matrix)
+        self.last_id = max(self.last_id, song_ids[-1])
+
+    def add(self, song_ids, matrix):
+        """
+        Adds the songs (their primary keys and their (N, 8) features matrix) the index doesn't have yet
+        """
+        song_ids = np.asarray(song_ids, dtype=np.int64)
+        vectors = self.normalise(matrix).reshape(-1, len(AudioFeatures.FEATURES))
+        if(len(song_ids) == 0):
+            return
+        with self.lock:
+            # only the songs with a greater primary key can be the same, the others are skipped without sorting them
+            known = self.song_ids[:self.size]
+            known = known[known >= song_ids.min()]
+            new = ~np.isin(song_ids, known)
+            song_ids, vectors = song_ids[new], vectors[new]
+            size = self.size + len(song_ids)
+            if(size > len(self.song_ids)):
+                # the buffers grow by doubling so adding a chunk doesn't copy the whole index every time
+                capacity = max(size, 2 * len(self.song_ids), 1024)
+                self.song_ids = np.resize(self.song_ids, capacity)
+                self.vectors = np.resize(self.vectors, (capacity, vectors.shape[1]))
+                self.norms = np.resize(self.norms, capacity)
+            self.song_ids[self.size:size] = song_ids
+            self.vectors[self.size:size] = vectors
+            self.norms[self.size:size] = np.square(vectors).sum(axis=1)
+            self.size = size
+
+    def nearest(self, features, limit=10, exclude=()):
+        """
+        Returns the primary keys of the limit songs closest to the features (a list of 8 values), the closest first
+        The songs whose primary key is in exclude are skipped
+        """
+        query = self.normalise(features)
+        with self.lock:
+            song_ids = self.song_ids[:self.size]
+            vectors = self.vectors[:self.size]
+            norms = self.norms[:self.size]
+        if(len(song_ids) == 0):
+            return []
+
+        # |v - q|^2 = |v|^2 - 2 v.q + |q|^2, the last term is the same for every song
+        distances = norms - 2 * vectors.dot(query)
+        count = min(limit + len(exclude), len(distances))
+        closest = np.argpartition(distances, count - 1)[:count]
+        closest = closest[np.argsort(distances[closest])]
+        exclude = set(exclude)
+        return [int(pk) for pk in song_ids[closest] if pk not in exclude][:limit]
+
+    def nearest_songs(self, audio_features, limit=10, exclude=()):
+        """
+        Returns the songs closest to the audio features (IE the summary of an analysis), the closest first
+        """
+        self.refresh()
+        features = [getattr(audio_features, feature) for feature in AudioFeatures.FEATURES]
+        song_ids = self.nearest(features, limit, exclude)
+        songs = Song.objects.select_related('audio_features').in_bulk(song_ids)
+        return [songs[pk] for pk in song_ids if pk in songs]
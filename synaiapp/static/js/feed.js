@@ -13,12 +13,81 @@ function analysisWait() {
 
 /**
  * Display an alert message and stop the loading spinner
+ * @param {*} message message of the alert
  */
-function analysisFail(){
-    alert("Oups ! Something went wrong... We cannot analyse your songs.");
+function analysisFail(message = "Oups ! Something went wrong... We cannot analyse your songs."){
+    alert(message);
     $("#analyse_results").html("");
 }
 
+/**
+ * Display the progress of an analysis under the load spinner
+ * @param {*} job status of the analysis job
+ */
+function analysisProgress(job) {
+    if ($("#analyse_progress").length === 0) {
+        $("#analyse_results").append('<p id="analyse_progress" class="text-center"></p>');
+    }
+    $("#analyse_progress").text(job.pages_fetched + " page(s) fetched, " + job.songs_ingested + " song(s) loaded");
+}
+
+// the polling stops after this number of attempts (one by second)
+const MAX_POLL_ATTEMPTS = 600;
+
+/**
+ * Poll the status of an analysis job until its results are ready
+ * @param {*} status_url url of the job status
+ * @param {*} attempt number of the attempt
+ */
+function pollAnalysis(status_url, attempt = 1) {
+    if (attempt > MAX_POLL_ATTEMPTS) {
+        analysisFail();
+        return;
+    }
+    $.ajax({
+        url: status_url,
+        type: 'GET',
+        dataType: 'json',
+        success: function(job) {
+            if (job.status === 'done') {
+                $("#analyse_results").html(job.html);
+            }
+            else if (job.status === 'failed') {
+                analysisFail(job.error);
+            }
+            else {
+                analysisProgress(job);
+                setTimeout(function() {
+                    pollAnalysis(status_url, attempt + 1);
+                }, 1000);
+            }
+        },
+        error: function (XMLHttpRequest, textStatus, errorThrown) {
+            analysisFail();
+        },
+    });
+}
+
+/**
+ * Request the analysis of a datasource, the results are then polled
+ * @param {*} data id, name and type of the datasource
+ */
+function requestAnalysis(data) {
+    analysisWait();
+    $.ajax({
+        url: "/analyse",
+        type: 'GET',
+        data: data,
+        dataType: 'json',
+        success: function(job) {
+            pollAnalysis(job.status_url);
+        },
+        error: function (XMLHttpRequest, textStatus, errorThrown) {
+            analysisFail();
+        },
+    });
+}
+
 /**
  * Load the user playlist when the pill tab of playlist
  * is clicked
@@ -71,22 +140,10 @@ $('#search_field').keypress(function (e) {
  * @param {*} playlist_name playlist name
  */
 function analysePlaylist(playlist_id, playlist_name) {
-    analysisWait();
-    $.ajax({
-        url: "/analyse",
-        type: 'GET',
-        data: {
-            'id': playlist_id,
-            'name': playlist_name,
-            'type' : 'playlist',
-        },
-        dataType: 'html',
-        success: function(data) {
-            $("#analyse_results").html(data);
-        },
-        error: function (XMLHttpRequest, textStatus, errorThrown) {
-            analysisFail();
-        },
+    requestAnalysis({
+        'id': playlist_id,
+        'name': playlist_name,
+        'type' : 'playlist',
     });
 }
 
@@ -95,20 +152,8 @@ function analysePlaylist(playlist_id, playlist_name) {
  * card of playlist is pressed
  */
 function analyseHistory() {
-    analysisWait();
-    $.ajax({
-        url: "/analyse",
-        type: 'GET',
-        data: {
-            'type' : 'history',
-        },
-        dataType: 'html',
-        success: function(data) {
-            $("#analyse_results").html(data);
-        },
-        error: function (XMLHttpRequest, textStatus, errorThrown) {
-            analysisFail();
-        },
+    requestAnalysis({
+        'type' : 'history',
     });
 }
 
@@ -118,22 +163,10 @@ function analyseHistory() {
  * @param {*} src_name 
  */
 function analyseArtist(artist_id, src_name) {
-    analysisWait();
-    $.ajax({
-        url: "/analyse",
-        type: 'GET',
-        data: {
-            'id': artist_id,
-            'name': src_name,
-            'type' : 'artist',
-        },
-        dataType: 'html',
-        success: function(data) {
-            $("#analyse_results").html(data);
-        },
-        error: function (XMLHttpRequest, textStatus, errorThrown) {
-            analysisFail();
-        },
+    requestAnalysis({
+        'id': artist_id,
+        'name': src_name,
+        'type' : 'artist',
     });
 }
 
@@ -143,22 +176,10 @@ function analyseArtist(artist_id, src_name) {
  * @param {*} src_name 
  */
 function analyseSong(song_id, src_name) {
-    analysisWait();
-    $.ajax({
-        url: "/analyse",
-        type: 'GET',
-        data: {
-            'id': song_id,
-            'name': src_name,
-            'type' : 'song',
-        },
-        dataType: 'html',
-        success: function(data) {
-            $("#analyse_results").html(data);
-        },
-        error: function (XMLHttpRequest, textStatus, errorThrown) {
-            analysisFail();
-        },
+    requestAnalysis({
+        'id': song_id,
+        'name': src_name,
+        'type' : 'song',
     });
 }
 
@@ -168,21 +189,9 @@ function analyseSong(song_id, src_name) {
  * @param {*} src_name 
  */
 function analyseAlbum(album_id, src_name) {
-    analysisWait();
-    $.ajax({
-        url: "/analyse",
-        type: 'GET',
-        data: {
-            'id': album_id,
-            'name': src_name,
-            'type' : 'album',
-        },
-        dataType: 'html',
-        success: function(data) {
-            $("#analyse_results").html(data);
-        },
-        error: function (XMLHttpRequest, textStatus, errorThrown) {
-            analysisFail();
-        },
+    requestAnalysis({
+        'id': album_id,
+        'name': src_name,
+        'type' : 'album',
     });
 }
\ No newline at end of file
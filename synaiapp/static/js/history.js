@@ -0,0 +1,38 @@
+/**
+ * History JS
+ * 
+ * This files contains all the java script code of the template history.html
+ */
+
+/**
+ * Request the dataset of an analysis and draw its chart
+ * @param {*} element graph element, its data-dataset-url attribute gives the dataset url
+ */
+function loadHistoryGraph(element) {
+    $.getJSON(element.dataset.datasetUrl, function(dataset) {
+        charts.push(new LinesChart(element.id, dataset, 'LinesChart'));
+    });
+}
+
+/**
+ * The charts are only requested when they are about to be displayed
+ */
+if ('IntersectionObserver' in window) {
+    let observer = new IntersectionObserver(function(entries) {
+        entries.forEach(function(entry) {
+            if (entry.isIntersecting) {
+                observer.unobserve(entry.target);
+                loadHistoryGraph(entry.target);
+            }
+        });
+    }, {'rootMargin': '200px'});
+
+    $('.history-graph').each(function() {
+        observer.observe(this);
+    });
+}
+else {
+    $('.history-graph').each(function() {
+        loadHistoryGraph(this);
+    });
+}
@@ -0,0 +1,218 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from collections import Counter
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+
+class FakeSpotifyCatalogue:
+    """
+    Generated payloads of the Spotify API endpoints used by SpotifyRequestManager
+    Every payload is derived from the ids so the same id always gives the same track, album or features
+    The playlists are named after their number of tracks: playlist_id(1000) has 1000 tracks
+    """
+    ALBUM_TRACKS = 12
+
+    @classmethod
+    def playlist_id(cls, size, variant=0):
+        # the ids must look like Spotify ones (15 to 30 alphanumeric characters) to be accepted by AnalyseView
+        return "fpl%08d%04d" % (size, variant)
+
+    @classmethod
+    def playlist_tracks(cls, playlist_id):
+        size, variant = int(playlist_id[3:11]), int(playlist_id[11:15])
+        return ["ftr%04d%08d" % (variant, index) for index in range(size)]
+
+    @classmethod
+    def random(cls, spotify_id):
+        seed = int(hashlib.md5(spotify_id.encode()).hexdigest()[:8], 16)
+        return random.Random(seed)
+
+    @classmethod
+    def album_id(cls, track_id):
+        return "fal%s%08d" % (track_id[3:7], int(track_id[7:] or 0) // cls.ALBUM_TRACKS)
+
+    @classmethod
+    def artist_ids(cls, track_id):
+        rand = cls.random(track_id)
+        return ["far%012d" % rand.randrange(10000) for i in range(rand.randint(1, 2))]
+
+    @classmethod
+    def track(cls, track_id):
+        album_id = cls.album_id(track_id)
+        return {
+            'id': track_id,
+            'name': "Track " + track_id,
+            'artists': [cls.artist(artist_id) for artist_id in cls.artist_ids(track_id)],
+            'album': cls.album(album_id),
+        }
+
+    @classmethod
+    def album(cls, album_id):
+        return {'id': album_id, 'name': "Album " + album_id}
+
+    @classmethod
+    def artist(cls, artist_id):
+        return {'id': artist_id, 'name': "Artist " + artist_id}
+
+    @classmethod
+    def features(cls, track_id):
+        rand = cls.random(track_id)
+        return {
+            'id': track_id,
+            'acousticness': round(rand.random(), 4),
+            'danceability': round(rand.random(), 4),
+            'energy': round(rand.random(), 4),
+            'instrumentalness': round(rand.random() ** 4, 6),
+            'liveness': round(rand.random(), 4),
+            'valence': round(rand.random(), 4),
+            'speechiness': round(rand.random() / 2, 4),
+            'tempo': round(rand.uniform(60, 200), 3),
+        }
+
+    @classmethod
+    def page(cls, items, params):
+        limit = int(params.get('limit', 20))
+        offset = int(params.get('offset', 0))
+        return {
+            'items': items[offset:offset + limit],
+            'total': len(items),
+            'next': "next" if offset + limit < len(items) else None,
+        }
+
+    @classmethod
+    def tracks_ids(cls, prefix, query, count):
+        rand = cls.random(query)
+        return ["%s%012d" % (prefix, rand.randrange(100000)) for i in range(count)]
+
+    @classmethod
+    def respond(cls, path, params):
+        """
+        Returns the endpoint key (like the SpotifyRequestManager.p_builder ones) and the payload of a request, None if it isn't known
+        """
+        ids = params['ids'].split(',') if 'ids' in params else []
+        routes = [
+            (r'^tracks$', 'tracks', lambda: {'tracks': [cls.track(track_id) for track_id in ids]}),
+            (r'^audio-features$', 'audio-features-multiple', lambda: {'audio_features': [cls.features(track_id) for track_id in ids]}),
+            (r'^playlists/(\w+)/tracks$', 'playlist', lambda playlist_id: cls.page(
+                [{'track': {'id': track_id}} for track_id in cls.playlist_tracks(playlist_id)], params)),
+            (r'^albums/(\w+)/tracks$', 'album_tracks', lambda album_id: cls.page(
+                [{'id': "ftr%s%08d" % (album_id[3:7], int(album_id[7:]) * cls.ALBUM_TRACKS + index)} for index in range(cls.ALBUM_TRACKS)], params)),
+            (r'^albums/(\w+)$', 'album', lambda album_id: cls.album(album_id)),
+            (r'^artists$', 'artists', lambda: {'artists': [cls.artist(artist_id) for artist_id in ids]}),
+            (r'^artists/(\w+)/top-tracks$', 'artist_top', lambda artist_id: {'tracks': [{'id': track_id} for track_id in cls.tracks_ids("ftp", artist_id, 10)]}),
+            (r'^artists/(\w+)$', 'artist', lambda artist_id: cls.artist(artist_id)),
+            (r'^recommendations$', 'recommendations', lambda: {'tracks': [{'id': track_id}
+                for track_id in cls.tracks_ids("frc", params.get('seed_tracks', ''), int(params.get('limit', 20)))]}),
+            (r'^search$', 'search', lambda: cls.search(params)),
+            (r'^me/player/recently-played$', 'current_user_history', lambda: {'items': [{'track': {'id': track_id}}
+                for track_id in cls.tracks_ids("fhi", "history", 20)]}),
+            (r'^users/(\w+)/playlists$', 'user_playlists', lambda user_id: cls.page([{'id': cls.playlist_id(size), 'images': [{'url': ""}],
+                'name': "%d tracks" % size, 'owner': {'display_name': user_id}, 'tracks': {'total': size}} for size in (10, 100, 1000, 10000)], params)),
+        ]
+        for pattern, key, payload in routes:
+            match = re.match(pattern, path)
+            if(match != None):
+                return key, payload(*match.groups())
+        return None, None
+
+    @classmethod
+    def search(cls, params):
+        query = params.get('q', '')
+        limit = int(params.get('limit', 20))
+        results = {}
+        types = params.get('type', '').split(',')
+        if('track' in types):
+            results['tracks'] = {'items': [{'id': track_id} for track_id in cls.tracks_ids("fse", query, limit)]}
+        if('album' in types):
+            results['albums'] = {'items': [cls.album(album_id) for album_id in cls.tracks_ids("fsa", query, limit)]}
+        if('artist' in types):
+            results['artists'] = {'items': [cls.artist(artist_id) for artist_id in cls.tracks_ids("fsr", query, limit)]}
+        return results
+
+class FakeSpotifyHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server.fake
+        url = urlparse(self.path)
+        params = {key : values[-1] for key, values in parse_qs(url.query).items()}
+        key, payload = FakeSpotifyCatalogue.respond(url.path.strip('/'), params)
+
+        if(server.latency > 0):
+            time.sleep(server.latency)
+
+        if(payload == None):
+            status = 404
+            payload = {'error': {'status': 404, 'message': "Not found"}}
+        elif(server.throttle()):
+            status = 429
+            payload = {'error': {'status': 429, 'message': "API rate limit exceeded"}}
+        else:
+            status = 200
+        server.record(key, status)
+
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        if(status == 429):
+            self.send_header("Retry-After", str(server.retry_after))
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class FakeSpotifyServer:
+    """
+    A local HTTP server standing in for the Spotify API (set SPOTIFY_BASE_URL to its url)
+    Each response is delayed by latency seconds and a share (throttle_rate) of them are 429 with a Retry-After of retry_after seconds
+    The requests are counted by endpoint key and status
+    """
+    def __init__(self, latency=0, throttle_rate=0, retry_after=0, seed=0):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.throttled = Counter()
+        self.httpd = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d/" % self.httpd.server_address[1]
+
+    def start(self):
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), FakeSpotifyHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.fake = self
+        threading.Thread(target=self.httpd.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def throttle(self):
+        with self.lock:
+            return self.throttle_rate > 0 and self.random.random() < self.throttle_rate
+
+    def record(self, key, status):
+        with self.lock:
+            self.calls[key] += 1
+            if(status == 429):
+                self.throttled[key] += 1
+
+    def reset_counters(self):
+        with self.lock:
+            self.calls.clear()
+            self.throttled.clear()
+
+    def calls_count(self):
+        with self.lock:
+            return sum(self.calls.values())
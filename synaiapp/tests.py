@@ -1,5 +1,33 @@
-from django.test import TestCase
-from synaiapp.models import AudioFeatures
+from django.test import TestCase, override_settings
+from django.conf import settings
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import Q, Sum, Count, ProtectedError
+from django.test.utils import CaptureQueriesContext
+from django.core.cache import caches
+from synaiapp.models import AudioFeatures, Song, Artist, Album, Analysis, AnalysisJob, AudioFeaturesSummary, UserFeatureStats, SpotifyIdCache, bulk_insert
+from synaiapp.jobs import AnalysisWorker, SingleFlight
+from synaiapp.similarity import SongSimilarityIndex
+from synaiapp.testing.fakespotify import FakeSpotifyServer, FakeSpotifyCatalogue
+from synaiapp.metrics import Metrics, RequestTimings
+from datetime import datetime, timedelta
+from django.utils import timezone
+from synaiapp.services import SpotifyRequestManager, SpotifySession, SpotifyRequestScheduler, SpotifyAPIError, SpotifyResponseCache
+from django.contrib.auth.models import User
+from social_django.models import UserSocialAuth
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock, skipUnless
+from collections import Counter
+from contextlib import contextmanager
+from importlib import import_module
+from django.apps import apps
+import io
+import json
+import re
+import tempfile
+import numpy as np
+import threading
+import time
 
 # Create your tests here.
 # https://docs.djangoproject.com/fr/2.1/topics/testing/overview/
@@ -61,3 +89,1449 @@ class AudioFeaturesTestCase(TestCase):
             self.assertAlmostEqual(mean_empirique, getattr(summary, attribute, 0))
 
         print("AudioFeatures summarise function passed")
+
+    def test_AudioFeatures_statistics(self):
+        """Test statistics function of AudioFeatures Model"""
+        stats = AudioFeatures.statistics(self.audiofeaturesList)
+
+        self.assertEqual(2, stats.count)
+        for attribute in AudioFeatures.FEATURES:
+            self.assertAlmostEqual(0.4, stats.mean[attribute])
+            self.assertAlmostEqual(0.4, stats.median[attribute])
+            self.assertAlmostEqual(0.2, stats.std[attribute])
+            self.assertAlmostEqual(0.2, stats.min[attribute])
+            self.assertAlmostEqual(0.6, stats.max[attribute])
+            self.assertAlmostEqual(0.3, stats.percentiles[25][attribute])
+
+    def test_AudioFeatures_statistics_queryset(self):
+        """Test statistics function of AudioFeatures Model on a queryset"""
+        AudioFeatures.bulk_save(self.audiofeaturesList)
+        summary, stats = AudioFeatures.summarise_with_stats(AudioFeatures.manager.all())
+
+        self.assertAlmostEqual(0.4, summary.energy)
+        self.assertAlmostEqual(0.6, stats.max['tempo'])
+
+    def test_AudioFeatures_statistics_empty(self):
+        """Test statistics function of AudioFeatures Model without audio features"""
+        with self.assertRaises(ValueError):
+            AudioFeatures.summarise([])
+
+
+class StubSpotifyHandler(BaseHTTPRequestHandler):
+    """Answers every GET with an empty JSON object and records the client port of each request"""
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.requests_ports.append(self.client_address[1])
+        body = json.dumps({}).encode()
+        status = self.server.statuses.pop(0) if self.server.statuses else 200
+        self.send_response(status)
+        if status == 429:
+            self.send_header("Retry-After", "0")
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubSpotifyServerTestCase(TestCase):
+    """Base test case that runs a local HTTP server standing in for SPOTIFY_BASE_URL"""
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StubSpotifyHandler)
+        self.server.requests_ports = []
+        self.server.statuses = []
+        self.server_thread = threading.Thread(target=self.server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True)
+        self.server_thread.start()
+
+        base_url = "http://127.0.0.1:%d/" % self.server.server_address[1]
+        self.settings_override = override_settings(SPOTIFY_BASE_URL=base_url)
+        self.settings_override.enable()
+        SpotifySession.close()
+        SpotifyRequestScheduler.reset()
+        caches['spotify'].clear()
+
+    def tearDown(self):
+        SpotifySession.close()
+        self.settings_override.disable()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def build_manager(self):
+        user = User.objects.create(username="user%d" % User.objects.count())
+        social = UserSocialAuth.objects.create(user=user, provider="spotify", uid=user.username,
+            extra_data={'access_token': 'token', 'auth_time': int(time.time()), 'expires': 3600})
+        return SpotifyRequestManager(social)
+
+
+class SpotifySessionTestCase(StubSpotifyServerTestCase):
+    """SpotifySession test case"""
+    def test_SpotifySession_shared_between_managers(self):
+        """Two managers use the same pooled session"""
+        first = self.build_manager()
+        second = self.build_manager()
+        first.query_executor("tracks?", {'ids': 'a'})
+        second.query_executor("tracks?", {'ids': 'b'})
+
+        self.assertIs(SpotifySession.get_session(), SpotifySession.get_session())
+        self.assertEqual(1, len(set(self.server.requests_ports)))
+
+    def test_SpotifySession_pool_stats(self):
+        """The connection is opened once then reused"""
+        manager = self.build_manager()
+        for i in range(5):
+            manager.query_executor("tracks?", {'ids': str(i)})
+
+        stats = SpotifySession.pool_stats()
+        self.assertEqual(1, stats['misses'])
+        self.assertEqual(4, stats['hits'])
+        self.assertEqual(1, stats['hosts'])
+
+    @override_settings(SPOTIFY_MAX_CONCURRENCY=4)
+    def test_execute_queries_threads_timed(self):
+        """The DB queries of the threads of execute_queries are recorded in the timings of the request"""
+        def query_executor(query_path, query_dict=None):
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            return {}
+
+        timings = RequestTimings()
+        RequestTimings.activate(timings)
+        try:
+            manager = self.build_manager()
+        finally:
+            RequestTimings.activate(None)
+        with mock.patch.object(manager, 'query_executor', side_effect=query_executor):
+            manager.execute_queries([("tracks?", {'ids': str(i)}) for i in range(3)])
+
+        self.assertEqual(3, timings.db[0])
+
+    @override_settings(SPOTIFY_MAX_CONCURRENCY=4)
+    def test_execute_queries_threads_close_connection(self):
+        """The pool threads close their DB connection once their query is done"""
+        manager = self.build_manager()
+        with mock.patch.object(manager, 'query_executor', return_value={}):
+            with mock.patch('synaiapp.services.connection') as thread_connection:
+                manager.execute_queries([("tracks?", {'ids': str(i)}) for i in range(3)])
+
+        self.assertEqual(3, thread_connection.close.call_count)
+
+
+class SpotifyTokenTestCase(StubSpotifyServerTestCase):
+    """SpotifyRequestManager access token test case"""
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username="token_user")
+        self.social = UserSocialAuth.objects.create(user=self.user, provider="spotify", uid="token_user",
+            extra_data={'access_token': 'token', 'auth_time': int(time.time()), 'expires': 3600})
+
+    def expire_token(self):
+        self.social.extra_data['auth_time'] = int(time.time()) - 3590
+        self.social.save()
+
+    def test_SpotifyRequestManager_fresh_token_not_refreshed(self):
+        """A token far from its expiry is used as is"""
+        with mock.patch.object(SpotifyRequestManager, 'refresh_access_token') as refresh:
+            SpotifyRequestManager(self.social)
+        refresh.assert_not_called()
+
+    def test_SpotifyRequestManager_expiring_token_refreshed(self):
+        """A token close to its expiry is refreshed on construction"""
+        self.expire_token()
+        with mock.patch.object(SpotifyRequestManager, 'refresh_access_token') as refresh:
+            SpotifyRequestManager(self.social)
+        refresh.assert_called_once_with()
+
+    def test_SpotifyRequestManager_token_refreshed_by_other_request(self):
+        """A stale social auth whose token was refreshed meanwhile does not refresh it again"""
+        stale_social = UserSocialAuth.objects.get(pk=self.social.pk)
+        self.expire_token()
+        stale_social.extra_data = dict(self.social.extra_data)
+
+        self.social.extra_data.update({'access_token': 'new_token', 'auth_time': int(time.time())})
+        self.social.save()
+
+        with mock.patch.object(SpotifyRequestManager, 'refresh_access_token') as refresh:
+            manager = SpotifyRequestManager(stale_social)
+        refresh.assert_not_called()
+        self.assertEqual('new_token', manager.social.extra_data['access_token'])
+
+    def test_SpotifyRequestManager_retry_on_401(self):
+        """A 401 refreshes the token and retries the query once"""
+        manager = SpotifyRequestManager(self.social)
+        self.server.statuses = [401]
+        with mock.patch.object(SpotifyRequestManager, 'refresh_access_token') as refresh:
+            self.assertEqual({}, manager.query_executor("tracks?", {'ids': 'a'}))
+        refresh.assert_called_once_with()
+        self.assertEqual(2, len(self.server.requests_ports))
+
+
+
+@override_settings(SPOTIFY_RETRY_BACKOFF=0.01)
+class SpotifyRequestSchedulerTestCase(StubSpotifyServerTestCase):
+    """SpotifyRequestScheduler test case"""
+    def test_SpotifyRequestScheduler_retries_throttled_requests(self):
+        """Requests answered with 429 or 503 are retried after the Retry-After delay"""
+        manager = self.build_manager()
+        self.server.statuses = [429, 503]
+
+        self.assertEqual({}, manager.query_executor("tracks?", {'ids': 'a'}))
+
+        stats = SpotifyRequestScheduler.get_scheduler().stats()
+        self.assertEqual(3, len(self.server.requests_ports))
+        self.assertEqual(2, stats['retries'])
+        self.assertEqual(2, stats['throttled'])
+
+    @override_settings(SPOTIFY_MAX_RETRIES=1)
+    def test_SpotifyRequestScheduler_bounded_retries(self):
+        """The error is raised once the retries are exhausted"""
+        manager = self.build_manager()
+        self.server.statuses = [429, 429, 429]
+
+        with self.assertRaises(SpotifyAPIError) as context:
+            manager.query_executor("tracks?", {'ids': 'a'})
+        self.assertEqual(429, context.exception.status_code)
+        self.assertEqual(1, context.exception.retry_after)
+        self.assertEqual(2, len(self.server.requests_ports))
+
+    @override_settings(SPOTIFY_MAX_RETRY_WAIT=0.001)
+    def test_SpotifyRequestScheduler_bounded_wait(self):
+        """A request doesn't wait for its retries longer than SPOTIFY_MAX_RETRY_WAIT"""
+        manager = self.build_manager()
+        self.server.statuses = [503, 503]
+
+        with self.assertRaises(SpotifyAPIError) as context:
+            manager.query_executor("tracks?", {'ids': 'a'})
+        self.assertEqual(503, context.exception.status_code)
+        self.assertEqual(1, len(self.server.requests_ports))
+
+    def test_SpotifyRequestScheduler_token_bucket(self):
+        """Requests beyond the burst wait for new tokens"""
+        scheduler = SpotifyRequestScheduler(rate=100, burst=2, max_retries=0, backoff=0, max_delay=0)
+        start = time.monotonic()
+        for i in range(6):
+            scheduler.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 0.035)
+        self.assertEqual(6, scheduler.stats()['requests'])
+
+
+
+class SpotifyResponseCacheTestCase(StubSpotifyServerTestCase):
+    """SpotifyResponseCache test case"""
+    def test_SpotifyResponseCache_catalogue_cached(self):
+        """Catalogue responses are shared by every manager whatever their access token"""
+        first = self.build_manager()
+        second = self.build_manager()
+        second.social.extra_data['access_token'] = 'other_token'
+
+        first.query_executor("albums/album0")
+        second.query_executor("albums/album0")
+        first.query_executor("search?", {'q': 'a', 'type': 'track'})
+        second.query_executor("search?", {'type': 'track', 'q': 'a'})
+
+        self.assertEqual(2, len(self.server.requests_ports))
+
+    def test_SpotifyResponseCache_user_data_not_cached(self):
+        """The user's history and uncached endpoints are always requested"""
+        manager = self.build_manager()
+        manager.query_executor("me/player/recently-played")
+        manager.query_executor("me/player/recently-played")
+        manager.query_executor("playlists/playlist0/tracks")
+        manager.query_executor("playlists/playlist0/tracks")
+
+        self.assertEqual(4, len(self.server.requests_ports))
+
+    def test_SpotifyResponseCache_ttl(self):
+        """The time to live depends on the endpoint"""
+        self.assertEqual(24 * 3600, SpotifyResponseCache.get_ttl("albums/album0"))
+        self.assertEqual(6 * 3600, SpotifyResponseCache.get_ttl("artists/artist0/top-tracks?"))
+        self.assertEqual(5 * 60, SpotifyResponseCache.get_ttl("search?"))
+        self.assertEqual(0, SpotifyResponseCache.get_ttl("me/player/recently-played"))
+        self.assertEqual(0, SpotifyResponseCache.get_ttl("tracks?"))
+
+
+def track_payload(index, artists_count=2):
+    """Builds the JSON of a track as returned by the tracks endpoint"""
+    return {
+        'id': "track%d" % index,
+        'name': "Track %d" % index,
+        'artists': [{'id': "artist%d" % (index + i), 'name': "Artist %d" % (index + i)} for i in range(artists_count)],
+        'album': {'id': "album%d" % (index // 10), 'name': "Album %d" % (index // 10)},
+    }
+
+
+def features_payload(index):
+    """Builds the JSON of the audio features of a track as returned by the audio-features endpoint"""
+    value = (index % 10) / 10
+    return {
+        'id': "track%d" % index,
+        'acousticness': value,
+        'danceability': value,
+        'energy': value,
+        'instrumentalness': value,
+        'liveness': value,
+        'valence': value,
+        'speechiness': value,
+        'tempo': 120.0,
+    }
+
+
+def page_payload(items, total, query_dict):
+    """Builds the page of a paginated resource starting at the offset of the query"""
+    offset, limit = query_dict['offset'], query_dict['limit']
+    return {
+        'items': items[offset:offset + limit],
+        'total': total,
+        'next': "next" if offset + limit < total else None,
+    }
+
+
+PLAYLIST_TOTAL = 250
+ALBUM_TOTAL = 60
+
+
+def stub_query_executor(query_path, query_dict=None):
+    """Answers the queries of a request manager without any network call"""
+    if query_path.startswith("playlists/"):
+        items = [{'track': {'id': "track%d" % i}} for i in range(PLAYLIST_TOTAL)]
+        return page_payload(items, PLAYLIST_TOTAL, query_dict)
+    if query_path.startswith("albums/") and not query_path.endswith("/tracks"):
+        album_id = query_path[len("albums/"):]
+        return {'id': album_id, 'name': "Album " + album_id}
+    if query_path.startswith("albums/"):
+        items = [{'id': "track%d" % i} for i in range(ALBUM_TOTAL)]
+        return page_payload(items, ALBUM_TOTAL, query_dict)
+    if query_path == "recommendations?":
+        return {'tracks': [{'id': "track%d" % i} for i in range(900, 900 + query_dict['limit'])]}
+    if query_path == "me/player/recently-played":
+        return {'items': [{'track': {'id': "track%d" % i}} for i in range(700, 720)]}
+    if query_path == "search?":
+        limit = int(query_dict['limit'])
+        return {
+            'tracks': {'items': [{'id': "track%d" % i} for i in range(800, 800 + limit)]},
+            'albums': {'items': [{'id': "search_album%d" % i, 'name': "Album %d" % i} for i in range(limit)]},
+            'artists': {'items': [{'id': "search_artist%d" % i, 'name': "Artist %d" % i} for i in range(limit)]},
+        }
+    if query_path.startswith("users/"):
+        items = [{'id': "playlist%d" % i, 'images': [{'url': "url"}], 'name': "Playlist %d" % i,
+            'owner': {'display_name': "owner"}, 'tracks': {'total': 10}} for i in range(120)]
+        return page_payload(items, 120, query_dict)
+
+    indexes = [int(spotify_id[len("track"):]) for spotify_id in query_dict['ids'].split(',')]
+    if query_path == "tracks?":
+        return {'tracks': [track_payload(index) for index in indexes]}
+    return {'audio_features': [features_payload(index) for index in indexes]}
+
+
+class SongsIngestionTestCase(TestCase):
+    """SpotifyRequestManager.get_songs ingestion test case"""
+    def setUp(self):
+        SpotifyIdCache.clear_all()
+        with mock.patch.object(SpotifyRequestManager, 'ensure_access_token'):
+            self.manager = SpotifyRequestManager(mock.Mock())
+        self.manager.query_executor = stub_query_executor
+
+    def test_get_songs_builds_missing_songs(self):
+        """Missing songs are saved with their artists, album and audio features"""
+        Artist.create("artist1", "Artist 1").save()
+
+        songs = self.manager.get_songs(["spotify:track:track%d" % i for i in range(12)])
+
+        self.assertEqual(12, len(songs))
+        self.assertEqual(12, Song.objects.count())
+        self.assertEqual(13, Artist.objects.count())
+        self.assertEqual(2, Album.objects.count())
+        song = Song.get_song("track3")
+        self.assertEqual(["artist3", "artist4"], sorted(artist.spotify_id for artist in song.artists.all()))
+        self.assertEqual("album0", song.album.spotify_id)
+        self.assertAlmostEqual(0.3, song.audio_features.energy)
+
+    def test_get_songs_joins_features_by_id(self):
+        """Audio features given in another order than the tracks are joined to the right track"""
+        def reversed_features(query_path, query_dict=None):
+            response = stub_query_executor(query_path, query_dict)
+            if query_path == "audio-features?":
+                response['audio_features'].reverse()
+            return response
+        self.manager.query_executor = reversed_features
+
+        self.manager.get_songs(["track%d" % i for i in range(120)])
+
+        for song in Song.objects.select_related('audio_features'):
+            self.assertAlmostEqual(int(song.spotify_id[len("track"):]) % 10 / 10, song.audio_features.energy)
+
+    def test_get_songs_concurrent_chunks(self):
+        """The chunks are requested concurrently, or one at a time when the API throttles us"""
+        threads = set()
+        def recording_executor(query_path, query_dict=None):
+            threads.add(threading.current_thread())
+            return stub_query_executor(query_path, query_dict)
+        self.manager.query_executor = recording_executor
+
+        self.manager.get_songs(["track%d" % i for i in range(200)])
+        self.assertNotIn(threading.current_thread(), threads)
+
+        threads.clear()
+        with mock.patch.object(SpotifyRequestManager, 'is_throttled', return_value=True):
+            self.manager.get_songs(["track%d" % i for i in range(200, 400)])
+        self.assertEqual({threading.current_thread()}, threads)
+
+    def test_get_songs_inserted_meanwhile(self):
+        """Songs inserted by another request during the ingestion are reused instead of raising an IntegrityError"""
+        song = create_song(3)
+        # as if the song had been inserted after we checked the DB
+        get_by_spotify_ids = Song.get_by_spotify_ids
+        lookups = []
+        def stale_lookup(spotify_ids):
+            lookups.append(spotify_ids)
+            return {} if len(lookups) <= 2 else get_by_spotify_ids(spotify_ids)
+
+        with mock.patch.object(Song, 'get_by_spotify_ids', side_effect=stale_lookup):
+            songs = self.manager.get_songs(["track%d" % i for i in range(5)])
+
+        self.assertEqual(5, len(songs))
+        self.assertEqual(5, Song.objects.count())
+        self.assertIn(song.pk, [song.pk for song in songs])
+
+    def test_get_songs_constant_queries_per_chunk(self):
+        """A chunk is ingested with the same number of queries whatever its size"""
+        with self.assertNumQueries(17):
+            self.manager.get_songs(["track%d" % i for i in range(5)])
+        with self.assertNumQueries(17):
+            self.manager.get_songs(["track%d" % i for i in range(100, 150)])
+
+
+class PaginationTestCase(TestCase):
+    """SpotifyRequestManager pagination test case"""
+    def setUp(self):
+        SpotifyIdCache.clear_all()
+        with mock.patch.object(SpotifyRequestManager, 'ensure_access_token'):
+            self.manager = SpotifyRequestManager(mock.Mock())
+        self.manager.query_executor = mock.Mock(side_effect=stub_query_executor)
+
+    def test_get_playlist_reads_every_page(self):
+        """A playlist bigger than a page is fully read"""
+        songs = self.manager.get_playlist("playlist0")
+
+        self.assertEqual({"track%d" % i for i in range(PLAYLIST_TOTAL)}, {song.spotify_id for song in songs})
+        self.assertEqual(PLAYLIST_TOTAL, len(songs))
+        offsets = sorted(call[0][1]['offset'] for call in self.manager.query_executor.call_args_list
+            if call[0][0].startswith("playlists/"))
+        self.assertEqual([0, 100, 200], offsets)
+
+    def test_get_user_playlists_reads_every_page(self):
+        """Users with more than 50 playlists get all of them"""
+        playlists = self.manager.get_user_playlists("user")
+
+        self.assertEqual(["playlist%d" % i for i in range(120)], [playlist['id'] for playlist in playlists])
+        self.assertEqual(3, self.manager.query_executor.call_count)
+
+    @override_settings(SPOTIFY_MAX_CONCURRENCY=4)
+    def test_get_pages_threads_timed(self):
+        """The pages after the first one are requested by threads timing their DB queries and closing their connection"""
+        with mock.patch('synaiapp.services.connection') as thread_connection:
+            self.manager.timings = RequestTimings()
+            pages = list(self.manager.get_pages("users/user/playlists"))
+
+        self.assertEqual(3, len(pages))
+        self.assertEqual(2, thread_connection.execute_wrapper.call_count)
+        thread_connection.execute_wrapper.assert_called_with(self.manager.timings.record_query)
+        self.assertEqual(2, thread_connection.close.call_count)
+
+
+class SpotifyIdCacheTestCase(TestCase):
+    """SpotifyIdCache test case"""
+    def setUp(self):
+        SpotifyIdCache.clear_all()
+        for i in range(50):
+            Artist.create("artist%d" % i, "Artist %d" % i).save()
+        SpotifyIdCache.clear_all()
+        with mock.patch.object(SpotifyRequestManager, 'ensure_access_token'):
+            self.manager = SpotifyRequestManager(mock.Mock())
+
+    def test_get_artists_single_query(self):
+        """Resolving 50 artists takes one query, then none once they are cached"""
+        artist_ids = ["artist%d" % i for i in range(50)]
+        with self.assertNumQueries(1):
+            artists = self.manager.get_artists(artist_ids)
+        self.assertEqual(artist_ids, [artist.spotify_id for artist in artists])
+
+        with self.assertNumQueries(0):
+            pks = Artist.resolve_ids(artist_ids)
+        self.assertEqual({artist.spotify_id: artist.pk for artist in artists}, pks)
+
+    def test_missing_ids_not_cached(self):
+        """A missing id is looked up again since another process may insert it"""
+        with self.assertNumQueries(1):
+            self.assertIsNone(Artist.get_artist("unknown"))
+        Artist.objects.bulk_create([Artist.create("unknown", "Unknown")])
+        artist = Artist.get_artist("unknown")
+        self.assertIsNotNone(artist)
+
+        with self.assertNumQueries(0):
+            self.assertEqual({"unknown": artist.pk}, Artist.resolve_ids(["unknown"]))
+
+    @override_settings(SPOTIFY_ID_CACHE_SIZE=10)
+    def test_cache_bounded(self):
+        """The least recently used ids are evicted"""
+        Artist.resolve_ids(["artist%d" % i for i in range(50)])
+        self.assertEqual(10, len(Artist.id_cache.entries))
+
+
+class UserSummarisedDataTestCase(TestCase):
+    """Analysis.get_user_summarised_data test case"""
+    def setUp(self):
+        self.user = User.objects.create(username="dashboard_user")
+
+    def create_analysis(self, value, songs_len, created):
+        summary = AudioFeatures(**{feature: value for feature in AudioFeatures.FEATURES})
+        summary.save()
+        analysis = Analysis(user=self.user, summarised_audio_features=summary, songs_len=songs_len,
+            datasource_type="album", created=timezone.make_aware(created))
+        analysis.save()
+        stats = AudioFeatures.statistics([summary] * songs_len)
+        UserFeatureStats.add(self.user, timezone.localdate(analysis.created), stats.as_dict())
+        return analysis
+
+    def test_get_user_summarised_data_empty(self):
+        """A user without analysis has no summary"""
+        self.assertIsNone(Analysis.get_user_summarised_data(self.user))
+
+    def test_get_user_summarised_data_by_day(self):
+        """The analyses of a day are averaged, weighted by their number of songs"""
+        self.create_analysis(0.2, 30, datetime(2019, 4, 2, 18))
+        self.create_analysis(0.6, 10, datetime(2019, 4, 2, 9))
+        self.create_analysis(0.5, 5, datetime(2019, 4, 1, 12))
+
+        with self.assertNumQueries(1):
+            dataset = Analysis.get_user_summarised_data(self.user)
+
+        self.assertEqual(["Analysis", "01.04.2019", "02.04.2019"], dataset[0])
+        self.assertEqual(8, len(dataset))
+        self.assertEqual("acousticness", dataset[1][0])
+        self.assertAlmostEqual(0.5, dataset[1][1])
+        self.assertAlmostEqual(0.3, dataset[1][2])
+
+
+class UserFeatureStatsTestCase(TestCase):
+    """UserFeatureStats test case"""
+    def setUp(self):
+        SpotifyIdCache.clear_all()
+        self.user = User.objects.create(username="stats_user")
+        self.songs = [create_song(i) for i in range(10)]
+
+    def test_analyses_update_stats(self):
+        """Each analysis adds its songs to the statistics of the day"""
+        Analysis.analyse_songs_for_user(self.songs[:4], self.user, "album")
+        Analysis.analyse_songs_for_user(self.songs[4:], self.user, "playlist")
+
+        stats = UserFeatureStats.manager.get(user=self.user)
+        self.assertEqual(timezone.localdate(), stats.day)
+        self.assertEqual(10, stats.count)
+        self.assertAlmostEqual(0.45, stats.mean()['energy'])
+        self.assertAlmostEqual(0.0825, stats.variance()['energy'])
+        self.assertAlmostEqual(120, stats.mean()['tempo'])
+        self.assertAlmostEqual(0, stats.variance()['tempo'])
+
+    def test_rebuild(self):
+        """The statistics rebuilt from the songs of the analyses are the same as the running ones"""
+        Analysis.analyse_songs_for_user(self.songs[:4], self.user, "album")
+        Analysis.analyse_songs_for_user(self.songs[2:], self.user, "playlist")
+        running = UserFeatureStats.manager.get(user=self.user)
+
+        UserFeatureStats.rebuild(self.user)
+
+        rebuilt = UserFeatureStats.manager.get(user=self.user)
+        self.assertEqual(running.count, rebuilt.count)
+        for feature in AudioFeatures.FEATURES:
+            self.assertAlmostEqual(running.mean()[feature], rebuilt.mean()[feature])
+            self.assertAlmostEqual(running.variance()[feature], rebuilt.variance()[feature])
+
+    def test_rebuild_duplicate_songs(self):
+        """A song listed twice and a song without audio features are counted the same way by both paths"""
+        no_features = Song.create("track_nofeatures", "No features", None, None)
+        no_features.save()
+        Analysis.analyse_songs_for_user([self.songs[0], self.songs[1], self.songs[1], no_features], self.user, "playlist")
+        running = UserFeatureStats.manager.get(user=self.user)
+        self.assertEqual(2, running.count)
+
+        UserFeatureStats.rebuild(self.user)
+
+        rebuilt = UserFeatureStats.manager.get(user=self.user)
+        self.assertEqual(running.count, rebuilt.count)
+        for feature in AudioFeatures.FEATURES:
+            self.assertAlmostEqual(getattr(running, feature + '_sum'), getattr(rebuilt, feature + '_sum'))
+            self.assertAlmostEqual(getattr(running, feature + '_sumsq'), getattr(rebuilt, feature + '_sumsq'))
+
+
+def create_song(index):
+    """Saves a song with its audio features"""
+    audio_features = AudioFeatures.create(features_payload(index))
+    audio_features.save()
+    song = Song.create("track%d" % index, "Track %d" % index, audio_features, None)
+    song.save()
+    return song
+
+
+class HistoryViewTestCase(TestCase):
+    """HistoryView and AnalysisDatasetView test case"""
+    def setUp(self):
+        SpotifyIdCache.clear_all()
+        self.user = User.objects.create(username="history_user")
+        self.client.force_login(self.user)
+        self.songs = [create_song(i) for i in range(3)]
+        self.analysis = [Analysis.analyse_songs_for_user(self.songs, self.user, "album")[0] for i in range(25)]
+
+    def test_HistoryView_first_page(self):
+        """The newest analyses are displayed first, a page at a time"""
+        response = self.client.get("/history")
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(25, response.context["analysis_len"])
+        self.assertEqual([analysis.pk for analysis in reversed(self.analysis[-10:])], [analysis.pk for analysis in response.context["analysis"]])
+        self.assertEqual(self.analysis[-10].pk, response.context["next_cursor"])
+
+    def test_HistoryView_next_pages(self):
+        """The cursor gives the next page until the last one"""
+        seen = []
+        cursor = ""
+        for page in range(3):
+            response = self.client.get("/history", {'sort': 'desc', 'cursor': cursor} if cursor else {'sort': 'desc'})
+            seen.extend(analysis.pk for analysis in response.context["analysis"])
+            cursor = response.context["next_cursor"]
+
+        self.assertIsNone(cursor)
+        self.assertEqual([analysis.pk for analysis in self.analysis], seen)
+
+    def test_HistoryView_next_pages_filtered(self):
+        """The "More analyses" link keeps the datasource type filter"""
+        playlists = [Analysis.analyse_songs_for_user(self.songs, self.user, "playlist")[0] for i in range(12)]
+        self.analysis.extend(Analysis.analyse_songs_for_user(self.songs, self.user, "album")[0] for i in range(5))
+
+        seen = []
+        url = "/history?type=playlist"
+        while url:
+            response = self.client.get(url)
+            seen.extend(analysis.pk for analysis in response.context["analysis"])
+            link = re.search(r'href="([^"]*)">More analyses', response.content.decode())
+            url = link.group(1) if link else None
+
+        self.assertEqual([analysis.pk for analysis in reversed(playlists)], seen)
+
+    def test_AnalysisDatasetView(self):
+        """The dataset of an analysis is given as JSON and revalidated with its ETag"""
+        url = "/history/%d/dataset" % self.analysis[0].pk
+        response = self.client.get(url)
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(["Feature", "Track 0", "Track 1", "Track 2"], sorted(json.loads(response.content.decode())[0]))
+        self.assertIn("private", response["Cache-Control"])
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(304, response.status_code)
+
+    def test_HistoryView_server_timing(self):
+        """The DB queries and the template rendering of the page are given in its Server-Timing header"""
+        response = self.client.get("/history")
+        self.assertRegex(response['Server-Timing'], r'db;dur=[0-9.]+;desc="[1-9][0-9]* queries"')
+        self.assertRegex(response['Server-Timing'], r'spotify;dur=0.0;desc="0 calls"')
+        self.assertNotRegex(response['Server-Timing'], r'template;dur=0.0,')
+
+    def test_AnalysisDatasetView_other_user(self):
+        """The analyses of other users can't be read"""
+        self.client.force_login(User.objects.create(username="other_user"))
+        response = self.client.get("/history/%d/dataset" % self.analysis[0].pk)
+        self.assertEqual(404, response.status_code)
+
+
+class UserHistoryTestCase(TestCase):
+    """Analysis.get_user_history and get_user_history_page test case"""
+    def setUp(self):
+        SpotifyIdCache.clear_all()
+        self.user = User.objects.create(username="history_user")
+        self.songs = [create_song(i) for i in range(4)]
+
+    def test_get_user_history_fixed_queries(self):
+        """The history is read with the same number of queries whatever its size"""
+        Analysis.analyse_songs_for_user(self.songs, self.user, "album")
+        with self.assertNumQueries(2):
+            history = Analysis.get_user_history(self.user)
+        self.assertEqual(1, len(history))
+
+        for i in range(4):
+            Analysis.analyse_songs_for_user(self.songs[:i + 1], self.user, "album")
+        with self.assertNumQueries(2):
+            history = Analysis.get_user_history(self.user, order=-1)
+            datasets = [entry.history_dataset() for entry in history]
+            names = [[song.name for song in entry.songs] for entry in history]
+
+        self.assertEqual([4, 3, 2, 1, 4], [len(entry.songs) for entry in history])
+        self.assertEqual(["Feature", "Track 0"], sorted(datasets[3][0]))
+        self.assertEqual(["Track 0"], names[3])
+        self.assertIsInstance(history[0].songs, tuple)
+
+    def test_get_history_entry(self):
+        """An analysis of the user is read as a HistoryEntry, the analyses of other users are not"""
+        analysis, _ = Analysis.analyse_songs_for_user(self.songs, self.user, "album")
+        other_user = User.objects.create(username="other_history_user")
+
+        entry = Analysis.get_history_entry(self.user, analysis.pk)
+        self.assertEqual(4, len(entry.songs))
+        self.assertEqual(analysis.summarised_audio_features_id, entry.summarised_audio_features.pk)
+        self.assertIsNone(Analysis.get_history_entry(other_user, analysis.pk))
+
+    def test_get_user_history_page_fixed_queries(self):
+        """A page of history is read with the same number of queries whatever the history size"""
+        for i in range(4):
+            Analysis.analyse_songs_for_user(self.songs[:i + 1], self.user, "album")
+        with self.assertNumQueries(1):
+            page, cursor = Analysis.get_user_history_page(self.user, page_size=2)
+        self.assertEqual([4, 3], [analysis.songs_len for analysis in page])
+
+        # the cursor is read then the page
+        with self.assertNumQueries(2):
+            page, cursor = Analysis.get_user_history_page(self.user, cursor, page_size=2)
+        self.assertEqual([2, 1], [analysis.songs_len for analysis in page])
+        self.assertIsNone(cursor)
+        self.assertEqual(["Feature", "Track 0"], sorted(page[1].history_dataset()[0]))
+
+    def test_get_songs_with_artists_and_album_names_queries(self):
+        """The artists and albums of the songs are fetched once"""
+        album = Album.create("album0", "Album 0")
+        album.save()
+        for song in self.songs:
+            song.album = album
+            song.save()
+
+        songs = list(Song.objects.order_by('pk'))
+        with self.assertNumQueries(2):
+            dataset = list(Song.get_songs_with_artists_and_album_names(songs))
+        self.assertEqual(("Track 0", "", "Album 0"), dataset[0])
+
+
+class AnalysisCreateTestCase(TestCase):
+    """Analysis.create test case"""
+    def setUp(self):
+        SpotifyIdCache.clear_all()
+        self.user = User.objects.create(username="analysis_user")
+        self.songs = [create_song(i) for i in range(20)]
+        self.summary = AudioFeatures.summarise([song.audio_features for song in self.songs])
+        self.summary.save()
+
+    def test_Analysis_create_bulk_links(self):
+        """The songs are linked to the analysis with one insert whatever their number"""
+        with self.assertNumQueries(4):
+            analysis = Analysis.create(self.songs[:2], self.user, self.summary, "album")
+        with self.assertNumQueries(4):
+            analysis = Analysis.create(self.songs + self.songs[:5], self.user, self.summary, "playlist")
+
+        self.assertEqual(25, analysis.songs_len)
+        self.assertEqual(set(song.pk for song in self.songs), set(analysis.songs.values_list('pk', flat=True)))
+
+    def test_bulk_insert_primary_keys(self):
+        """The primary keys of the inserted rows are set, read back by their key or saved one by one without it"""
+        albums = bulk_insert(Album.objects, [Album.create("album%d" % i, "Album %d" % i) for i in range(3)], 'spotify_id')
+        self.assertEqual(["album0", "album1", "album2"], [Album.objects.get(pk=album.pk).spotify_id for album in albums])
+
+        users = bulk_insert(User.objects, [User(username="bulk_user%d" % i) for i in range(3)])
+        self.assertEqual(["bulk_user0", "bulk_user1", "bulk_user2"], [User.objects.get(pk=user.pk).username for user in users])
+
+    def test_AudioFeatures_bulk_save_primary_keys(self):
+        """The features of tracks are read back by their spotify id, even when the track already had some"""
+        AudioFeatures.create(features_payload(20)).save()
+        audio_features = AudioFeatures.bulk_save([AudioFeatures.create(features_payload(i)) for i in range(20, 23)])
+
+        for index, af in enumerate(audio_features):
+            self.assertEqual("track%d" % (20 + index), AudioFeatures.manager.get(pk=af.pk).spotify_id)
+
+    def test_Analysis_create_many(self):
+        """Many analysis are created at once with their summaries"""
+        analysis_list = [(self.songs[:i + 1], self.user, AudioFeatures.summarise([song.audio_features for song in self.songs[:i + 1]]), "album")
+            for i in range(10)]
+
+        # without RETURNING the summaries and the analyses, that have no key to be read back by, are inserted one by one
+        queries = 5 if connection.features.can_return_ids_from_bulk_insert else 27
+        with self.assertNumQueries(queries):
+            analysis = Analysis.create_many(analysis_list)
+
+        self.assertEqual(10, Analysis.manager.filter(user=self.user).count())
+        for i, analy in enumerate(analysis):
+            self.assertEqual(i + 1, analy.songs.count())
+            self.assertIsNotNone(analy.summarised_audio_features.pk)
+
+
+    def test_analyse_songs_without_audio_features(self):
+        """A song without audio features is analysed as zeros instead of failing the analysis"""
+        song = Song.create("track_no_features", "No features", None, None)
+        song.save()
+
+        analysis, audio_features = Analysis.analyse_songs_for_user([self.songs[5], song], self.user, "playlist")
+
+        self.assertEqual([self.songs[5].audio_features, None], audio_features)
+        self.assertEqual(0.25, analysis.summarised_audio_features.energy)
+        self.assertEqual(0, AudioFeatures.features_matrix([None]).sum())
+
+
+class AudioFeaturesSummaryTestCase(TestCase):
+    """AudioFeaturesSummary test case"""
+    def setUp(self):
+        SpotifyIdCache.clear_all()
+        self.user = User.objects.create(username="summary_user")
+        self.songs = [create_song(i) for i in range(10)]
+
+    def test_same_songs_share_summary(self):
+        """Analysing the same songs again, in any order, reuses the summary"""
+        first, _ = Analysis.analyse_songs_for_user(self.songs, self.user, "album")
+        audio_features_count = AudioFeatures.manager.count()
+        second, _ = Analysis.analyse_songs_for_user(list(reversed(self.songs)), self.user, "album")
+
+        self.assertEqual(first.summarised_audio_features_id, second.summarised_audio_features_id)
+        self.assertEqual(audio_features_count, AudioFeatures.manager.count())
+        self.assertEqual(1, AudioFeaturesSummary.manager.count())
+
+        stats = AudioFeaturesSummary.manager.get().get_stats()
+        self.assertEqual(10, stats['count'])
+
+    def test_other_songs_other_summary(self):
+        """Another list of songs, or the same songs listed twice, get their own summary"""
+        first, _ = Analysis.analyse_songs_for_user(self.songs, self.user, "album")
+        second, _ = Analysis.analyse_songs_for_user(self.songs[:5], self.user, "album")
+        third, _ = Analysis.analyse_songs_for_user(self.songs + self.songs[:1], self.user, "playlist")
+
+        self.assertEqual(3, len(set([first.summarised_audio_features_id, second.summarised_audio_features_id, third.summarised_audio_features_id])))
+        self.assertEqual(3, AudioFeaturesSummary.manager.count())
+
+    def test_shared_summary_protected(self):
+        """A summary shared by the analyses of several users can't be deleted with them"""
+        other_user = User.objects.create(username="other_summary_user")
+        first, _ = Analysis.analyse_songs_for_user(self.songs, self.user, "album")
+        second, _ = Analysis.analyse_songs_for_user(self.songs, other_user, "album")
+
+        with self.assertRaises(ProtectedError):
+            first.summarised_audio_features.delete()
+        self.assertEqual(2, Analysis.manager.filter(pk__in=[first.pk, second.pk]).count())
+
+
+class AudioFeaturesVectorTestCase(TestCase):
+    """Packed audio features vectors test case"""
+    def setUp(self):
+        SpotifyIdCache.clear_all()
+        self.user = User.objects.create(username="vector_user")
+        self.songs = [create_song(i) for i in range(5)]
+
+    def test_load_vectors(self):
+        """The vectors of a queryset are the values of its audio features, read without building them"""
+        matrix = AudioFeatures.features_matrix([song.audio_features for song in self.songs])
+        queryset = AudioFeatures.manager.filter(song__in=self.songs).order_by('song__pk')
+
+        with self.assertNumQueries(1):
+            vectors = AudioFeatures.load_vectors(queryset)
+        self.assertEqual((5, 8), vectors.shape)
+        self.assertTrue(np.allclose(matrix, vectors))
+        self.assertTrue(np.allclose(matrix, AudioFeatures.load_vectors(Song.objects.order_by('pk'), 'audio_features__vector')))
+
+        # a row saved before the vectors is read from its columns
+        AudioFeatures.manager.filter(pk=self.songs[0].audio_features.pk).update(vector=None)
+        self.assertTrue(np.allclose(matrix, AudioFeatures.load_vectors(queryset)))
+
+    def test_history_dataset_from_vectors(self):
+        """The dataset of an analysis read from the vectors is the same as the one built from its songs"""
+        analysis, audio_features = Analysis.analyse_songs_for_user(self.songs, self.user, "album")
+
+        with self.assertNumQueries(1):
+            dataset = analysis.history_dataset()
+
+        self.assertEqual(analysis.history_dataset(self.songs), dataset)
+        self.assertEqual(["energy", 0.0, 0.1, 0.2, 0.3, 0.4], dataset[3])
+
+    def test_loaddata_index_fields(self):
+        """The audio features loaded from a fixture have their vector and grid cell"""
+        call_command("loaddata", "audiofeatures", verbosity=0)
+
+        af = AudioFeatures.manager.get(pk=1)
+        self.assertIsNotNone(af.vector)
+        self.assertEqual(AudioFeatures.grid_cell_of(af), af.grid_cell)
+        self.assertEqual(AudioFeatures.pack([getattr(af, feature) for feature in AudioFeatures.FEATURES]), bytes(af.vector))
+
+    def test_repair_index_fields_migration(self):
+        """The rows without vector get their vector and grid cell back, by chunks"""
+        migration = import_module("synaiapp.migrations.0019_audiofeatures_repair_index_fields")
+        audio_features = [AudioFeatures.create(dict(features_payload(i), valence=0.9)) for i in range(migration.CHUNK + 10)]
+        AudioFeatures.bulk_save(audio_features)
+        queryset = AudioFeatures.manager.filter(pk__in=[af.pk for af in audio_features])
+        queryset.update(vector=None, grid_cell=0)
+
+        migration.repair_index_fields(apps, None)
+
+        for af in queryset:
+            self.assertEqual(AudioFeatures.grid_cell_of(af), af.grid_cell)
+            self.assertEqual(AudioFeatures.pack([getattr(af, feature) for feature in AudioFeatures.FEATURES]), bytes(af.vector))
+
+
+class SongSimilarityIndexTestCase(TestCase):
+    """SongSimilarityIndex test case"""
+    def setUp(self):
+        SpotifyIdCache.clear_all()
+        SongSimilarityIndex.reset()
+        self.songs = [create_song(i) for i in range(10)]
+
+    def tearDown(self):
+        SongSimilarityIndex.reset()
+
+    def test_nearest_songs(self):
+        """The closest songs are returned first and the excluded ones are skipped"""
+        index = SongSimilarityIndex.get_index()
+
+        nearest = index.nearest_songs(self.songs[4].audio_features, 3)
+        self.assertEqual(self.songs[4], nearest[0])
+        self.assertEqual(set([self.songs[3], self.songs[5]]), set(nearest[1:]))
+
+        nearest = index.nearest_songs(self.songs[4].audio_features, 2, exclude=[self.songs[4].pk])
+        self.assertEqual(set([self.songs[3], self.songs[5]]), set(nearest))
+
+    def test_new_songs_are_loaded(self):
+        """The songs inserted after the index was loaded are found, and a song is only added once"""
+        index = SongSimilarityIndex.get_index()
+        song = create_song(17)
+
+        self.assertEqual([song], index.nearest_songs(song.audio_features, 1, exclude=[self.songs[7].pk]))
+        index.add([song.pk], AudioFeatures.features_matrix([song.audio_features]))
+        self.assertEqual(11, index.size)
+
+    @override_settings(RECOMMENDATIONS_SOURCE="local")
+    def test_local_recommendations(self):
+        """The local recommendations don't request the API and skip the analysed songs"""
+        user = User.objects.create(username="similarity_user")
+        analysis, audio_features = Analysis.analyse_songs_for_user(self.songs[:3], user, "album")
+        with mock.patch.object(SpotifyRequestManager, 'ensure_access_token'):
+            manager = SpotifyRequestManager(mock.Mock())
+        manager.query_executor = mock.Mock(side_effect=AssertionError("The API must not be requested"))
+
+        recommendations = manager.get_recommendations(analysis, 3)
+
+        self.assertEqual(set(self.songs[3:6]), set(recommendations))
+
+
+class FeatureBoxTestCase(TestCase):
+    """Song.in_feature_box and the "box" recommendations test case"""
+    def setUp(self):
+        SpotifyIdCache.clear_all()
+        self.songs = [create_song(i) for i in range(10)]
+        with mock.patch.object(SpotifyRequestManager, 'ensure_access_token'):
+            self.manager = SpotifyRequestManager(mock.Mock())
+        self.manager.query_executor = stub_query_executor
+
+    def test_grid_cells(self):
+        """The grid cell of audio features is one of the cells overlapping a box around them"""
+        self.assertEqual(0, self.songs[0].audio_features.grid_cell)
+        self.assertEqual(255, AudioFeatures.grid_cell_of(AudioFeatures.create(features_payload(9))))
+        self.assertEqual(256, len(AudioFeatures.grid_cells({})))
+
+        bounds = {'energy': (0.3, 0.6), 'valence': (0.1, 0.2)}
+        cells = AudioFeatures.grid_cells(bounds)
+        self.assertEqual(2 * 4 * 4, len(cells))
+        self.assertIn(self.songs[5].audio_features.grid_cell, AudioFeatures.grid_cells({'energy': (0.5, 0.5)}))
+
+    def test_in_feature_box(self):
+        """The songs in the box are the ones whose features are within the bounds"""
+        bounds = {'energy': (0.3, 0.6), 'danceability': (0.2, 0.5), 'liveness': (0, 1)}
+        songs = Song.in_feature_box(bounds)
+        self.assertEqual(set(self.songs[3:6]), set(songs))
+        self.assertEqual(set(self.songs), set(Song.in_feature_box({})))
+
+    @override_settings(RECOMMENDATIONS_SOURCE="box")
+    def test_box_recommendations(self):
+        """The songs of the DB in the box are recommended, the API is requested only if there aren't enough of them"""
+        user = User.objects.create(username="box_user")
+        analysis, audio_features = Analysis.analyse_songs_for_user(self.songs[4:6], user, "album")
+
+        with mock.patch.object(self.manager, 'query_executor', side_effect=AssertionError("The API must not be requested")):
+            recommendations = self.manager.get_recommendations(analysis, 4)
+        self.assertEqual(set([2, 3, 6, 7]), set(int(song.spotify_id[len("track"):]) for song in recommendations))
+
+        # the closest songs of the box come first
+        with mock.patch.object(self.manager, 'query_executor', side_effect=AssertionError("The API must not be requested")):
+            recommendations = self.manager.get_recommendations(analysis, 2)
+        self.assertEqual(set([3, 6]), set(int(song.spotify_id[len("track"):]) for song in recommendations))
+
+        recommendations = self.manager.get_recommendations(analysis, 10)
+        self.assertEqual(["track%d" % i for i in range(900, 910)], sorted(song.spotify_id for song in recommendations))
+
+
+@override_settings(ANALYSIS_JOBS_MODE="sync")
+class AnalyseViewTestCase(TestCase):
+    """AnalyseView and AnalyseJobView test case"""
+    def setUp(self):
+        SpotifyIdCache.clear_all()
+        self.user = User.objects.create(username="analyse_user")
+        UserSocialAuth.objects.create(user=self.user, provider="spotify", uid="analyse_user",
+            extra_data={'access_token': 'token', 'auth_time': int(time.time()), 'expires': 3600})
+        self.client.force_login(self.user)
+
+        self.query_executor = mock.patch.object(SpotifyRequestManager, 'query_executor', side_effect=stub_query_executor)
+        self.query_executor.start()
+
+    def tearDown(self):
+        self.query_executor.stop()
+
+    def test_AnalyseView_job_done(self):
+        """The analysis is enqueued then its progress and results are polled"""
+        response = self.client.get("/analyse", {'id': "album0000000000000", 'name': "My album", 'type': "album"})
+        self.assertEqual(200, response.status_code)
+        status_url = response.json()['status_url']
+
+        response = self.client.get(status_url)
+        job = response.json()
+        self.assertEqual(AnalysisJob.DONE, job['status'])
+        self.assertEqual(2, job['pages_fetched'])
+        self.assertEqual(ALBUM_TOTAL, job['songs_ingested'])
+        self.assertIn("My album", job['html'])
+        self.assertIn("track900", job['html'])
+        self.assertEqual(ALBUM_TOTAL, Analysis.manager.get(user=self.user).songs_len)
+
+    def test_AnalyseView_job_failed(self):
+        """A failed job is reported with its error"""
+        SpotifyRequestManager.query_executor.side_effect = SpotifyAPIError("Spotify API is temporarily unavailable", 503)
+        response = self.client.get("/analyse", {'id': "album0000000000000", 'name': "My album", 'type': "album"})
+
+        response = self.client.get(response.json()['status_url'])
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(AnalysisJob.FAILED, response.json()['status'])
+        # the exception is logged, not shown
+        self.assertEqual(AnalysisJob.FAILED_MESSAGE, response.json()['error'])
+
+    @override_settings(ANALYSIS_JOBS_MODE="thread")
+    def test_AnalyseJobView_stale_job(self):
+        """A job lost by a restart is failed when it is polled or by run_analysis_jobs"""
+        jobs = [AnalysisJob.create(self.user, "album", "album0000000000000", "") for i in range(3)]
+        AnalysisJob.manager.filter(pk__in=[jobs[0].pk, jobs[1].pk]).update(updated=timezone.now() - timedelta(hours=1))
+
+        response = self.client.get("/analyse/%d" % jobs[0].pk)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(AnalysisJob.FAILED_MESSAGE, response.json()['error'])
+
+        self.assertEqual(1, AnalysisJob.fail_stale())
+        self.assertEqual([AnalysisJob.FAILED, AnalysisJob.FAILED, AnalysisJob.PENDING],
+            [AnalysisJob.manager.get(pk=job.pk).status for job in jobs])
+
+    def test_throttled_view_answers_503(self):
+        """A view giving up because of the rate limits answers 503 with the Retry-After delay"""
+        SpotifyRequestManager.query_executor.side_effect = SpotifyAPIError("Spotify API rate limit reached", 429, 7)
+        response = self.client.get("/feed")
+        self.assertEqual(503, response.status_code)
+        self.assertEqual("7", response['Retry-After'])
+
+    def test_AnalyseJobView_other_user(self):
+        """The jobs of other users can't be read"""
+        job = AnalysisJob.create(User.objects.create(username="other_user"), "album", "album0000000000000", "")
+        response = self.client.get("/analyse/%d" % job.pk)
+        self.assertEqual(404, response.status_code)
+
+    @override_settings(ANALYSIS_JOBS_MODE="worker")
+    def test_AnalysisWorker_run_pending(self):
+        """In worker mode the job waits for the worker"""
+        job = AnalysisWorker.enqueue(self.user, "album", "album0000000000000", "My album")
+        self.assertEqual(AnalysisJob.PENDING, AnalysisJob.manager.get(pk=job.pk).status)
+
+        self.assertTrue(AnalysisWorker.run_pending())
+        self.assertFalse(AnalysisWorker.run_pending())
+        self.assertEqual(AnalysisJob.DONE, AnalysisJob.manager.get(pk=job.pk).status)
+
+
+@override_settings(ANALYSIS_JOBS_MODE="sync", SPOTIFY_RETRY_BACKOFF=0.01, SPOTIFY_RATE_LIMIT=1000, SPOTIFY_RATE_BURST=1000)
+class FakeSpotifyServerTestCase(TestCase):
+    """The views against FakeSpotifyServer test case"""
+    def setUp(self):
+        SpotifyIdCache.clear_all()
+        self.server = FakeSpotifyServer().start()
+        self.settings_override = override_settings(SPOTIFY_BASE_URL=self.server.url)
+        self.settings_override.enable()
+        SpotifySession.close()
+        SpotifyRequestScheduler.reset()
+        caches['spotify'].clear()
+
+        user = User.objects.create(username="fake_user")
+        UserSocialAuth.objects.create(user=user, provider="spotify", uid="fake_user",
+            extra_data={'access_token': 'token', 'auth_time': int(time.time()), 'expires': 3600})
+        self.client.force_login(user)
+
+    def tearDown(self):
+        SpotifySession.close()
+        self.settings_override.disable()
+        self.server.stop()
+
+    def analyse(self, size):
+        response = self.client.get("/analyse", {'id': FakeSpotifyCatalogue.playlist_id(size), 'name': "Playlist", 'type': "playlist"})
+        return self.client.get(response.json()['status_url'])
+
+    def test_analyse_playlist(self):
+        """A playlist of the fake API is analysed with a request by page and two by chunk of tracks"""
+        response = self.analyse(120)
+
+        self.assertEqual(AnalysisJob.DONE, response.json()['status'])
+        self.assertEqual(120, response.json()['songs_ingested'])
+        self.assertEqual(2, self.server.calls['playlist'])
+        # 3 chunks of the playlist and 1 of the recommendations
+        self.assertEqual(4, self.server.calls['tracks'])
+        self.assertEqual(4, self.server.calls['audio-features-multiple'])
+        self.assertEqual(1, self.server.calls['recommendations'])
+
+    def test_server_timing(self):
+        """The Spotify calls and the DB queries of a request are given in its Server-Timing header and in the metrics"""
+        Metrics.clear()
+        response = self.client.get("/analyse", {'id': FakeSpotifyCatalogue.playlist_id(10), 'name': "Playlist", 'type': "playlist"})
+
+        server_timing = response['Server-Timing']
+        self.assertRegex(server_timing, r'spotify;dur=[0-9.]+;desc="%d calls"' % self.server.calls_count())
+        self.assertRegex(server_timing, r'spotify-playlist;dur=[0-9.]+;desc="1 calls"')
+        self.assertRegex(server_timing, r'db;dur=[0-9.]+;desc="[1-9][0-9]* queries"')
+        self.assertRegex(server_timing, r'total;dur=[0-9.]+')
+
+        with override_settings(METRICS_TOKEN="scraper"):
+            metrics = self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer scraper").content.decode()
+        self.assertIn('synai_spotify_request_duration_seconds_count{endpoint="playlist"} 1', metrics)
+        self.assertIn('synai_request_duration_seconds_count{view="analyse"} 1', metrics)
+
+    def test_metrics_token(self):
+        """The metrics are only exposed to the scraper holding the token"""
+        self.assertEqual(404, self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer ").status_code)
+        with override_settings(METRICS_TOKEN="scraper"):
+            self.assertEqual(404, self.client.get("/metrics").status_code)
+            self.assertEqual(404, self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer other").status_code)
+            self.assertEqual(200, self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer scraper").status_code)
+
+    def test_throttled(self):
+        """The 429 of the fake API are retried then reported"""
+        self.server.throttle_rate = 1
+        response = self.analyse(10)
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(AnalysisJob.FAILED, response.json()['status'])
+        self.assertEqual(settings.SPOTIFY_MAX_RETRIES + 1, self.server.throttled['playlist'])
+
+
+class SyntheticDataTestCase(TestCase):
+    """generate_synthetic_data and benchmark_models commands test case"""
+    def setUp(self):
+        SpotifyIdCache.clear_all()
+
+    def test_generate_and_benchmark(self):
+        """A synthetic catalogue and history are generated then the models are timed on them"""
+        call_command("generate_synthetic_data", songs=300, users=3, analyses=4, analysis_songs=10, batch=100, stdout=io.StringIO())
+
+        self.assertEqual(300, Song.objects.count())
+        self.assertEqual(12, Analysis.manager.count())
+        for analysis in Analysis.manager.annotate(songs_count=Count('songs')):
+            self.assertEqual(analysis.songs_len, analysis.songs_count)
+        self.assertEqual(300, Song.objects.filter(artists__isnull=False).distinct().count())
+        self.assertEqual(sum(analysis.songs_len for analysis in Analysis.manager.all()), UserFeatureStats.manager.aggregate(count=Sum('count'))['count'])
+
+        with tempfile.NamedTemporaryFile(mode='r', suffix=".json") as output:
+            call_command("benchmark_models", sizes=[100], repeat=1, output=output.name, stdout=io.StringIO())
+            report = json.load(output)
+        self.assertEqual(300, report['songs'])
+        self.assertIn(("AudioFeatures.summarise", 100), [(result['name'], result['size']) for result in report['results']])
+        self.assertIn("Analysis.get_user_history", [result['name'] for result in report['results']])
+        self.assertIn("Analysis.get_user_history_page", [result['name'] for result in report['results']])
+
+
+class SingleFlightTestCase(TestCase):
+    """SingleFlight test case"""
+    def test_SingleFlight_concurrent_calls_shared(self):
+        """Concurrent calls with the same key run the function once"""
+        single_flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return ["song"]
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(single_flight.do(("album", "id"), fetch)))
+        leader.start()
+        started.wait(5)
+        followers = [threading.Thread(target=lambda: results.append(single_flight.do(("album", "id"), fetch))) for i in range(3)]
+        for follower in followers:
+            follower.start()
+        time.sleep(0.05)
+        release.set()
+        for thread in [leader] + followers:
+            thread.join(5)
+
+        self.assertEqual(1, len(calls))
+        self.assertEqual([["song"]] * 4, results)
+        self.assertEqual({}, single_flight.calls)
+
+    def test_SingleFlight_exception_shared(self):
+        """A failed call raises its exception and is not remembered"""
+        single_flight = SingleFlight()
+        with self.assertRaises(ValueError):
+            single_flight.do("key", mock.Mock(side_effect=ValueError))
+        self.assertEqual(1, single_flight.do("key", lambda: 1))
+
+
+def query_chunks(size):
+    """Number of chunks of MAX_REQ_IDS ids the songs of a request are asked to the API by"""
+    return -(-size // settings.MAX_REQ_IDS)
+
+
+# The maximum numbers of SQL queries and Spotify calls of each view and entry point, as functions of the size of its input
+# (the number of songs, analyses, ...), a change making one of them grow faster fails QueryBudgetTestCase
+# The songs missing from the DB are ingested with 17 queries and 2 Spotify calls (tracks and audio features) by chunk
+QUERY_BUDGETS = {
+    'get_songs': {'queries': lambda songs: 17 * query_chunks(songs), 'spotify_calls': lambda songs: 2 * query_chunks(songs)},
+    'Analysis.create': {'queries': lambda songs: 4, 'spotify_calls': lambda songs: 0},
+    'Analysis.analyse_songs_for_user': {'queries': lambda songs: 18, 'spotify_calls': lambda songs: 0},
+    'get_user_history': {'queries': lambda analyses: 2, 'spotify_calls': lambda analyses: 0},
+    'get_user_history_page': {'queries': lambda analyses: 2, 'spotify_calls': lambda analyses: 0},
+    'get_user_summarised_data': {'queries': lambda days: 1, 'spotify_calls': lambda days: 0},
+    # a page of tracks by chunk then the ingestion of the recommendations
+    '/analyse': {'queries': lambda songs: 40 + 17 * (query_chunks(songs) + 1), 'spotify_calls': lambda songs: 3 * query_chunks(songs) + 3},
+    '/history': {'queries': lambda analyses: 4, 'spotify_calls': lambda analyses: 0},
+    '/history/<id>/dataset': {'queries': lambda songs: 4, 'spotify_calls': lambda songs: 0},
+    '/dashboard': {'queries': lambda days: 3, 'spotify_calls': lambda days: 0},
+    '/feed': {'queries': lambda songs: 6 + 17 * query_chunks(songs), 'spotify_calls': lambda songs: 1 + 2 * query_chunks(songs)},
+    # the tracks found are ingested, the albums and artists are bulk inserted
+    '/search_results': {'queries': lambda items: 17 + 17 * query_chunks(items), 'spotify_calls': lambda items: 1 + 2 * query_chunks(items)},
+}
+
+
+def normalise_sql(sql):
+    """The SQL of a query without its values, so the same query run for other rows is counted as a duplicate"""
+    sql = re.sub(r"'[^']*'|\b\d+(\.\d+)?\b", "?", sql)
+    # the lists of values of any length are the same
+    return re.sub(r"\((\?, )+\?\)", "(...)", sql)
+
+
+@override_settings(ANALYSIS_JOBS_MODE="sync", SPOTIFY_MAX_CONCURRENCY=1, RECOMMENDATIONS_SOURCE="spotify")
+class QueryBudgetTestCase(TestCase):
+    """QUERY_BUDGETS test case, the Spotify API is answered by stub_query_executor"""
+    def setUp(self):
+        SpotifyIdCache.clear_all()
+        SongSimilarityIndex.reset()
+        self.user = User.objects.create(username="budget_user", first_name="Budget")
+        UserSocialAuth.objects.create(user=self.user, provider="spotify", uid="budget_user",
+            extra_data={'access_token': 'token', 'auth_time': int(time.time()), 'expires': 3600})
+        self.client.force_login(self.user)
+
+        self.query_executor = mock.patch.object(SpotifyRequestManager, 'query_executor', side_effect=stub_query_executor)
+        self.query_executor.start()
+        with mock.patch.object(SpotifyRequestManager, 'ensure_access_token'):
+            self.manager = SpotifyRequestManager(mock.Mock())
+
+    def tearDown(self):
+        self.query_executor.stop()
+
+    @contextmanager
+    def assertWithinBudget(self, name, size):
+        """
+        Fails if the block runs more SQL queries or Spotify calls than the budget of name for an input of the given size
+        The queries run more than once (with other values) are listed in the failure message
+        """
+        max_queries = QUERY_BUDGETS[name]['queries'](size)
+        max_calls = QUERY_BUDGETS[name]['spotify_calls'](size)
+        calls_before = SpotifyRequestManager.query_executor.call_count
+        with CaptureQueriesContext(connection) as context:
+            yield
+        calls = SpotifyRequestManager.query_executor.call_count - calls_before
+        queries = [query['sql'] for query in context.captured_queries]
+
+        errors = []
+        if(len(queries) > max_queries):
+            errors.append("%d SQL queries for a budget of %d" % (len(queries), max_queries))
+        if(calls > max_calls):
+            errors.append("%d Spotify calls for a budget of %d" % (calls, max_calls))
+        if(len(errors) != 0):
+            duplicated = ["%5d x %s" % (count, sql) for sql, count in Counter(normalise_sql(sql) for sql in queries).most_common() if count > 1]
+            self.fail("%s (size %d) is over budget: %s\nDuplicated queries:\n%s" % (name, size, ", ".join(errors), "\n".join(duplicated) or "none"))
+
+    def analyse(self, songs_count, days=1):
+        """Creates the analyses of songs_count new songs, one by day over the last days"""
+        first = 1000 + Song.objects.count()
+        songs = [create_song(i) for i in range(first, first + songs_count)]
+        analysis_list = []
+        for day in range(days):
+            analysis, audio_features = Analysis.analyse_songs_for_user(songs, self.user, "album")
+            Analysis.manager.filter(pk=analysis.pk).update(created=timezone.now() - timedelta(days=day))
+            analysis_list.append(analysis)
+        UserFeatureStats.rebuild(self.user)
+        return analysis_list
+
+    def test_budget_failure_lists_duplicated_queries(self):
+        """A block over its budget fails with its duplicated queries"""
+        songs = [create_song(i) for i in range(3)]
+        with self.assertRaises(AssertionError) as context:
+            with self.assertWithinBudget('Analysis.create', 3):
+                [Song.objects.get(pk=song.pk).audio_features for song in songs]
+        self.assertIn("SQL queries for a budget", str(context.exception))
+        self.assertRegex(str(context.exception), r'3 x SELECT .* FROM "synaiapp_song" WHERE "synaiapp_song"."id" = \?')
+
+    def test_get_songs_budget(self):
+        """Missing songs are ingested by chunk, existing ones are read with one query"""
+        for size in (5, 50, 120):
+            spotify_ids = ["track%d" % i for i in range(size * 10, size * 11)]
+            with self.assertWithinBudget('get_songs', size):
+                self.manager.get_songs(spotify_ids)
+            # the songs are in the DB now
+            with self.assertWithinBudget('get_songs', size):
+                self.manager.get_songs(spotify_ids)
+
+    def test_Analysis_create_budget(self):
+        """An analysis is created with the same queries whatever its number of songs"""
+        for size in (1, 30):
+            songs = [create_song(i) for i in range(size * 10, size * 11)]
+            summary = AudioFeatures.summarise([song.audio_features for song in songs])
+            summary.save()
+            with self.assertWithinBudget('Analysis.create', size):
+                Analysis.create(songs, self.user, summary, "album")
+
+    def test_analyse_songs_for_user_budget(self):
+        """The audio features of the songs are not read again"""
+        for size in (1, 60):
+            songs = [create_song(i) for i in range(size * 10, size * 11)]
+            songs = list(Song.get_by_spotify_ids([song.spotify_id for song in songs]).values())
+            with self.assertWithinBudget('Analysis.analyse_songs_for_user', size):
+                Analysis.analyse_songs_for_user(songs, self.user, "album")
+
+    def test_get_user_history_budget(self):
+        """The history and its datasets are read with the same queries whatever its length"""
+        for size in (1, 15):
+            Analysis.manager.filter(user=self.user).delete()
+            self.analyse(3, size)
+            with self.assertWithinBudget('get_user_history', size):
+                [entry.history_dataset() for entry in Analysis.get_user_history(self.user)]
+
+    def test_get_user_history_page_budget(self):
+        """A page of history is read with the same queries whatever the history length"""
+        for size in (1, 25):
+            Analysis.manager.filter(user=self.user).delete()
+            cursor = self.analyse(3, size)[0].pk
+            with self.assertWithinBudget('get_user_history_page', size):
+                Analysis.get_user_history_page(self.user, cursor, page_size=settings.HISTORY_PAGE_SIZE)
+
+    def test_get_user_summarised_data_budget(self):
+        """The summary is read from the statistics of the days"""
+        for size in (1, 10):
+            self.analyse(2, size)
+            with self.assertWithinBudget('get_user_summarised_data', size):
+                Analysis.get_user_summarised_data(self.user)
+
+    def test_AnalyseView_budget(self):
+        """An analysis ingests its songs by chunk"""
+        for datasource_type, size in (("album", ALBUM_TOTAL), ("playlist", PLAYLIST_TOTAL)):
+            with self.assertWithinBudget('/analyse', size):
+                response = self.client.get("/analyse", {'id': "%s0000000000000" % datasource_type, 'name': "Budget", 'type': datasource_type})
+                response = self.client.get(response.json()['status_url'])
+            self.assertEqual(AnalysisJob.DONE, response.json()['status'])
+
+    def test_HistoryView_budget(self):
+        """A page of history is read with the same queries whatever the number of analyses"""
+        for size in (1, 25):
+            Analysis.manager.filter(user=self.user).delete()
+            self.analyse(3, size)
+            with self.assertWithinBudget('/history', size):
+                self.assertEqual(200, self.client.get("/history").status_code)
+
+    def test_AnalysisDatasetView_budget(self):
+        """The dataset of an analysis is read with the same queries whatever its number of songs"""
+        for size in (1, 100):
+            analysis = self.analyse(size)[0]
+            with self.assertWithinBudget('/history/<id>/dataset', size):
+                self.assertEqual(200, self.client.get("/history/%d/dataset" % analysis.pk).status_code)
+
+    def test_DashboardView_budget(self):
+        """The dashboard is read with the same queries whatever the number of days"""
+        for size in (1, 10):
+            self.analyse(2, size)
+            with self.assertWithinBudget('/dashboard', size):
+                self.assertEqual(200, self.client.get("/dashboard").status_code)
+
+    def test_FeedView_budget(self):
+        """The songs of the history are ingested then read from the DB"""
+        for attempt in range(2):
+            with self.assertWithinBudget('/feed', 20):
+                self.assertEqual(200, self.client.get("/feed").status_code)
+
+    def test_SearchResultsView_budget(self):
+        """The songs, albums and artists found are resolved by bulk"""
+        for attempt in range(2):
+            with self.assertWithinBudget('/search_results', 5):
+                self.assertEqual(200, self.client.get("/search_results", {'search_input': "budget"}).status_code)
+
+
+def query_plan(queryset):
+    """The lines of the SQLite query plan of a queryset"""
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+        return [row[-1] for row in cursor.fetchall()]
+
+
+@skipUnless(connection.vendor == "sqlite", "The query plans are the SQLite ones")
+class QueryPlanTestCase(TestCase):
+    """Indexes of the history and dashboard access paths test case"""
+    def setUp(self):
+        SpotifyIdCache.clear_all()
+        self.user = User.objects.create(username="plan_user")
+        other = User.objects.create(username="other_user")
+        artist = Artist.create("artist0", "Artist 0")
+        artist.save()
+        self.songs = [create_song(i) for i in range(5)]
+        for song in self.songs:
+            song.artists.add(artist)
+        for user in (self.user, other):
+            for datasource_type in ("album", "playlist"):
+                Analysis.analyse_songs_for_user(self.songs, user, datasource_type)
+        self.analysis = Analysis.manager.filter(user=self.user).first()
+
+    def assertSearches(self, plan, table, index=None):
+        """The table is searched (with the index if one is given), never scanned, and no temporary sort is needed"""
+        lines = "\n".join(plan)
+        self.assertNotRegex(lines, r'SCAN (TABLE )?%s\b' % table)
+        self.assertRegex(lines, r'SEARCH (TABLE )?%s USING (COVERING )?INDEX %s' % (table, index or ""))
+        self.assertNotIn("TEMP B-TREE", lines)
+
+    def test_history_page_plan(self):
+        """A page of history is read in the order of the (user, created) index, the cursor is sought in the index"""
+        queryset = Analysis.manager.filter(user=self.user).order_by('-created', '-pk')
+        self.assertSearches(query_plan(queryset[:11]), "synaiapp_analysis", "analysis_user_created_idx")
+
+        queryset = queryset.filter(Q(created__lt=self.analysis.created) | Q(created=self.analysis.created, pk__lt=self.analysis.pk),
+            created__lte=self.analysis.created)
+        plan = query_plan(queryset[:11])
+        self.assertSearches(plan, "synaiapp_analysis", "analysis_user_created_idx")
+        self.assertIn("created<?", "\n".join(plan))
+
+    def test_history_page_by_type_plan(self):
+        """The history of a datasource type is read with the (user, datasource_type, created) index"""
+        queryset = Analysis.manager.filter(user=self.user, datasource_type="album").order_by('-created', '-pk')
+        self.assertSearches(query_plan(queryset[:11]), "synaiapp_analysis", "analysis_user_type_idx")
+
+    def test_history_songs_plan(self):
+        """The songs of the analyses and the artists of the songs are found by their through table indexes"""
+        self.assertSearches(query_plan(Song.objects.filter(analysis__in=[self.analysis.pk])), "synaiapp_analysis_songs")
+        self.assertSearches(query_plan(Artist.objects.filter(song__in=[song.pk for song in self.songs])), "synaiapp_song_artists")
+
+    def test_dashboard_plan(self):
+        """The statistics of the days of a user are read in the order of their unique index"""
+        queryset = UserFeatureStats.manager.filter(user=self.user, count__gt=0).order_by('day')
+        self.assertSearches(query_plan(queryset), "synaiapp_userfeaturestats")
+
+    def test_pending_jobs_plan(self):
+        """The oldest pending job is found with the (status, created) index"""
+        queryset = AnalysisJob.manager.filter(status=AnalysisJob.PENDING).order_by('created')
+        self.assertSearches(query_plan(queryset[:1]), "synaiapp_analysisjob", "analysisjob_status_idx")
+
+    def test_HistoryView_datasource_type(self):
+        """The history can be filtered by datasource type"""
+        self.client.force_login(self.user)
+        response = self.client.get("/history", {'type': "playlist"})
+
+        self.assertEqual(1, response.context["analysis_len"])
+        self.assertEqual(["playlist"], [analysis.datasource_type for analysis in response.context["analysis"]])
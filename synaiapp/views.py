@@ -1,6 +1,14 @@
 from urllib import request
 
-from django.shortcuts import render
+from django.conf import settings
+from django.db.models import prefetch_related_objects
+from django.http import Http404, HttpResponse, JsonResponse
+from django.shortcuts import render, get_object_or_404
+from django.template.loader import render_to_string
+from django.urls import reverse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.crypto import constant_time_compare
+from django.utils.http import quote_etag
 from django.views import generic, View
 from django.views.generic import ListView
 from rest_framework.exceptions import ValidationError
@@ -13,6 +21,8 @@ from social_django.models import UserSocialAuth
 
 # Services
 from .services import SpotifyRequestManager
+from .jobs import AnalysisWorker
+from .metrics import Metrics
 
 # Python utils
 import re
@@ -21,7 +31,7 @@ import re
 import logging
 logger = logging.getLogger(__name__)
 
-from .models import Song, AudioFeatures, Analysis, Album
+from .models import Song, AudioFeatures, Analysis, AnalysisJob, Album
 
 def home(request):
     if request.user.is_authenticated:
@@ -66,19 +76,53 @@ class HistoryView(generic.TemplateView):
     def get(self, request, *args, **kwargs):
         context = super().get_context_data()
         sort_by = request.GET.get('sort','')
-        if sort_by:
-            analysis, songs, audio_features = Analysis.get_user_history(self.request.user)
-        else:
-            analysis, songs, audio_features = Analysis.get_user_history(self.request.user, order=-1)
+        order = 1 if sort_by else -1
+
+        cursor = request.GET.get('cursor')
+        if cursor is not None and not cursor.isdigit():
+            raise ValidationError
+
+        # the history can be filtered by datasource type
+        datasource_type = request.GET.get('type') or None
+        if datasource_type is not None and datasource_type not in AnalyseView.datasource_types:
+            raise ValidationError
+
+        analysis, next_cursor = Analysis.get_user_history_page(self.request.user, cursor, order, settings.HISTORY_PAGE_SIZE, datasource_type)
+
+        analysis_list = Analysis.manager.filter(user=self.request.user)
+        if datasource_type is not None:
+            analysis_list = analysis_list.filter(datasource_type=datasource_type)
 
         context["analysis"] = analysis
-        context["analysis_len"] = len(analysis)
-        context["songs"] = songs
+        context["analysis_len"] = analysis_list.count()
+        context["sort"] = sort_by
+        context["datasource_type"] = datasource_type
+        context["next_cursor"] = next_cursor
 
-        # for graphs use
-        context["analysis_dataset"] = dict(zip([analy.id for analy in analysis], [analy.history_dataset(analy.songs.all()) for analy in analysis]))
+        # the graphs datasets are requested by the page to the AnalysisDatasetView
         return render(request, HistoryView.template_name, context)
 
+@method_decorator(login_required, name='dispatch')
+class AnalysisDatasetView(View):
+    """
+    Give the history dataset of an analysis as JSON
+    An analysis never changes so it can be cached by the browser and revalidated with its ETag
+    """
+    def get(self, request, analysis_id, *args, **kwargs):
+        analysis = Analysis.manager.filter(pk=analysis_id, user=request.user).first()
+        if analysis is None:
+            raise Http404
+
+        etag = quote_etag("analysis-%d" % analysis_id)
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            # the songs are read as packed vectors, without building their audio features
+            response = JsonResponse(analysis.history_dataset(), safe=False)
+
+        response['ETag'] = etag
+        patch_cache_control(response, private=True, max_age=settings.HISTORY_DATASET_MAX_AGE)
+        return response
+
 class DashboardView(generic.TemplateView):
     template_name = "dashboard.html"
 
@@ -104,55 +148,76 @@ class SearchResultsView(generic.TemplateView):
         search_result = manager.search_item(search_input, ['track', 'album', 'artist'])
 
         context['tracks'] = search_result['tracks']
+        # the artists of the tracks are displayed
+        prefetch_related_objects(context['tracks'], 'artists')
         context['albums'] = search_result['albums']
         context['artists'] = search_result['artists']
 
         return context
 
-class AnalyseResultsView(generic.TemplateView):
-    template_name = "_items/analyse_results.html"
-
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
-        manager = request_manager_factory(self.request)
-
-        self.request_type = {
-            'song': lambda song_id: manager.get_songs([song_id]),
-            'playlist': lambda playlist_id: manager.get_playlist(playlist_id),
-            'artist': lambda artist_id: manager.get_artist_top_songs(artist_id),
-            'history': manager.get_current_user_history(),
-            'album': lambda album_id: manager.get_album_tracks(album_id)
-        }
+@method_decorator(login_required, name='dispatch')
+class AnalyseView(View):
+    """
+    Enqueue the analysis of a datasource and return the job id and the url to poll its progress
+    """
+    datasource_types = ['song', 'playlist', 'artist', 'history', 'album']
 
+    def get(self, request, *args, **kwargs):
         datasource_id = self.request.GET.get('id')
         datasource_name = self.request.GET.get('name')
         datasource_type = self.request.GET.get('type')
 
-        # Request the songs depending the datasource
         if datasource_type == "history":
-            songs = self.request_type['history']
+            datasource_id = None
             datasource_name = 'Recently played'
         else :
             # Verify ID integrity (15-30 char in base 62)
-            match = re.match('[a-zA-Z0-9]{15,30}', datasource_id)
-            if match is None:
-                raise ValidationError
-            
-            try:
-                songs = self.request_type[datasource_type](datasource_id)
-            except KeyError:
+            match = re.match('[a-zA-Z0-9]{15,30}', datasource_id or '')
+            if match is None or datasource_type not in AnalyseView.datasource_types:
                 raise ValidationError
 
-        # Analyse the songs ! 
-        analysis, audio_features = Analysis.analyse_songs_for_user(songs, self.request.user, datasource_type)
+        job = AnalysisWorker.enqueue(self.request.user, datasource_type, datasource_id, datasource_name)
+
+        return JsonResponse({
+            'job': job.pk,
+            'status_url': reverse('analyse_job', args=[job.pk]),
+        })
+
+@method_decorator(login_required, name='dispatch')
+class AnalyseJobView(View):
+    """
+    Give the progress of an analysis job, and the rendered results once it is done
+    A failed job is a state of the job like the others, it is given with its error and a 200
+    """
+    template_name = "_items/analyse_results.html"
+
+    def get(self, request, job_id, *args, **kwargs):
+        job = get_object_or_404(AnalysisJob.manager.select_related('analysis__summarised_audio_features'), pk=job_id, user=request.user)
+        # the thread running the job may have been lost by a restart
+        if job.is_stale():
+            job.fail(AnalysisJob.FAILED_MESSAGE)
+
+        data = {
+            'status': job.status,
+            'pages_fetched': job.pages_fetched,
+            'songs_ingested': job.songs_ingested,
+        }
+        if job.status == AnalysisJob.DONE:
+            data['html'] = render_to_string(AnalyseJobView.template_name, self.get_results_context(job), request)
+        elif job.status == AnalysisJob.FAILED:
+            data['error'] = job.error
+
+        return JsonResponse(data)
+
+    def get_results_context(self, job):
+        context = {}
 
         # For graph use
-        context["audio_features"] = audio_features
-        context["stats"] = analysis.summarised_audio_features.as_array()
+        context["stats"] = job.analysis.summarised_audio_features.as_array()
         context["stats_headers"] = AudioFeatures.features_headers()
-        context["name"] = datasource_name
+        context["name"] = job.datasource_name
 
-        context["recommandations"] = manager.get_recommendations(analysis)
+        context["recommandations"] = job.recommendations.all()
 
         return context
     
@@ -169,4 +234,14 @@ class PlaylistEntriesView(generic.TemplateView):
         context['user_playlists'] = manager.get_user_playlists(user_id)
         
         return context
-    
+
+class MetricsView(View):
+    """
+    Expose the request, Spotify, DB and template histograms in the Prometheus text format
+    The scraper authenticates with the METRICS_TOKEN setting in an "Authorization: Bearer" header, without it the view doesn't exist
+    """
+    def get(self, request, *args, **kwargs):
+        token = settings.METRICS_TOKEN
+        if not token or not constant_time_compare(request.META.get('HTTP_AUTHORIZATION', ''), "Bearer " + token):
+            raise Http404
+        return HttpResponse(Metrics.expose(), content_type="text/plain; version=0.0.4")